@@ -56,7 +56,11 @@ setuptools.setup(
     include_package_data=True,
     zip_safe=False,
     #install_requires=['numpy', 'scipy', 'bih', 'gmsh-sdk<=4.5.1'],
-    install_requires=['numpy', 'scipy', 'bih', 'gmsh-sdk'],
+    install_requires=['numpy', 'scipy', 'gmsh-sdk'],
+    extras_require={
+        # optional BIH tree, bgem.bspline.patch_index is used otherwise
+        'bih': ['bih'],
+    },
     python_requires='>=3',
     # extras_require={
     #     # eg:
@@ -157,6 +157,15 @@ def curve_from_bs( curve):
     c._bs_curve = curve
     return c
 
+def curves_from_bs_set(curve_set):
+    """
+    Make BREP writer curves (2d or 3d) from all curves of the bspline CurveSet.
+    :param curve_set: bs.CurveSet object
+    :return: List of Curve2D or Curve3D objects.
+    """
+    return [curve_from_bs(curve) for curve in curve_set.curves()]
+
+
 class Curve3D:
     """
     Defines a 3D curve as B-spline. We shall work only with B-splines of degree 2.
@@ -5,16 +5,26 @@ These classes provide just basic functionality:
 - evaluation of XYZ for UV
 - evaluation and xy<->uv functions accepting np.arrays,
 - evaluation of derivatives
+Serialization see 'bspline_io'.
 In future:
 - use de Boor algorithm for evaluation of curves and surfaces
-- serialization and deserialization using JSONdata - must make it an installable module
-- implement degree increasing and knot insertion
 """
 
-import bih
 import numpy as np
 import numpy.linalg as la
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.spatial
+from scipy.special import binom
 import copy
+import concurrent.futures
+try:
+    import bih
+except ImportError:
+    # Use PatchIndex instead of the BIH tree.
+    bih = None
+
+from .patch_index import PatchIndex
 
 
 __author__ = 'Jan Brezina <jan.brezina@tul.cz>, Jiri Hnidek <jiri.hnidek@tul.cz>, Jiri Kopal <jiri.kopal@tul.cz>'
@@ -88,6 +98,8 @@ class SplineBasis:
         self.n_intervals = self.size - self.degree
         # Number of subintervals ( assuming multiplicities only on ends. )
 
+        self.eval_base_vector = self.eval_vector
+        self.eval_diff_base_vector = self.eval_diff_vector
         # Set optimized functions for specific degrees.
         if self.degree == 2:
             self.eval_base_vector = self._eval_vector_deg_2
@@ -133,6 +145,20 @@ class SplineBasis:
 
             self.domain[0]
 
+    def check_array(self, t_points, rtol = 1e-10):
+        """
+        Vectorized version of 'check'. Check that all 't_points' are inside basis domain, fix small perturbations.
+        :param t_points: array N x float
+        :return: array N x float, parameters snapped to the domain.
+        """
+        t_points = np.asarray(t_points, dtype=float)
+        tol = (np.abs(t_points) + 1e-4) * rtol
+        out_of_domain = np.logical_or(t_points < self.domain[0] - tol, t_points > self.domain[1] + tol)
+        if np.any(out_of_domain):
+            t = t_points[out_of_domain][0]
+            raise IndexError("Evaluate spline, t={}, out of domain: {}.".format(t, self.domain))
+        return np.clip(t_points, self.domain[0], self.domain[1])
+
     def find_knot_interval(self, t):
         """
         Find the first non-empty knot interval containing the value 't'.
@@ -147,6 +173,17 @@ class SplineBasis:
         assert 0 <= idx <= self.n_intervals, "Evaluation out of spline domain; t: {} min: {} max: {}".format(t, self.knots[0], self.knots[-1])
         return min(idx, self.n_intervals - 1)   # deals with t == self.knots[-1]
 
+    def find_knot_interval_array(self, t_points):
+        """
+        Vectorized version of 'find_knot_interval', single 'searchsorted' for all points.
+        :param t_points: array N x float, must be within knots limits.
+        :return: array N x int, indices of the first nonzero basis function for every point.
+        """
+        idx = np.searchsorted(self.knots[self.degree: -self.degree -1], t_points, side='right') - 1
+        assert np.all(0 <= idx) and np.all(idx <= self.n_intervals), \
+            "Evaluation out of spline domain; min: {} max: {}".format(self.knots[0], self.knots[-1])
+        return np.minimum(idx, self.n_intervals - 1)   # deals with t == self.knots[-1]
+
     def knot_interval_bounds(self, i_interval):
         """
         Bounds for given knot interval.
@@ -249,10 +286,7 @@ class SplineBasis:
         :param t: Where to evaluate.
         :return: Numpy array of three values.
         """
-        values = []
-        for ib in range(i_base, i_base + self.degree + 1):
-            values.append( self.eval(ib, t))
-        return values
+        return self.eval_ders_vector(i_base, t, 0)[0]
 
 
     def eval_diff_vector(self, i_base, t):
@@ -262,17 +296,271 @@ class SplineBasis:
         :param t: Where to evaluate.
         :return: Numpy array of three values.
         """
-        values = []
-        for ib in range(i_base, i_base + self.degree + 1):
-            values.append( self.eval_diff(ib, t))
-        return values
+        return self.eval_ders_vector(i_base, t, 1)[1]
+
+
+    def eval_ders_vector(self, i_base, t, n_ders):
+        """
+        Values and derivatives up to order 'n_ders' of the nonzero basis functions on given subinterval.
+        Non-recursive triangular scheme, see Piegl, Tiller: The NURBS Book, algorithm A2.3.
+        :param i_base: Interval in which 't' belongs, see 'find_knot_interval'.
+        :param t: Where to evaluate.
+        :param n_ders: Maximal order of the derivative.
+        :return: Numpy array (n_ders + 1) x (degree + 1); row k contains k-th derivatives.
+        """
+        deg = self.degree
+        ders = np.zeros((n_ders + 1, deg + 1))
+        n_ders = min(n_ders, deg)
+        # knots[i_base + 1 : i_base + 2 * deg + 1], i.e. knots around the interval
+        knots = self.knots[i_base + 1: i_base + 2 * deg + 1].tolist()
+        left = [0.0] + [t - knots[deg - j] for j in range(1, deg + 1)]
+        right = [0.0] + [knots[deg - 1 + j] - t for j in range(1, deg + 1)]
+
+        # ndu: upper triangle - basis functions, lower triangle - knot differences
+        ndu = [[1.0] * (deg + 1) for j in range(deg + 1)]
+        for j in range(1, deg + 1):
+            saved = 0.0
+            for r in range(j):
+                ndu[j][r] = right[r + 1] + left[j - r]
+                temp = ndu[r][j - 1] / ndu[j][r]
+                ndu[r][j] = saved + right[r + 1] * temp
+                saved = left[j - r] * temp
+            ndu[j][j] = saved
+        ders[0, :] = [ndu[j][deg] for j in range(deg + 1)]
+
+        for r in range(deg + 1):
+            s1, s2 = 0, 1
+            a = [[0.0] * (deg + 1), [0.0] * (deg + 1)]
+            a[0][0] = 1.0
+            for k in range(1, n_ders + 1):
+                d = 0.0
+                rk, pk = r - k, deg - k
+                if r >= k:
+                    a[s2][0] = a[s1][0] / ndu[pk + 1][rk]
+                    d = a[s2][0] * ndu[rk][pk]
+                j1 = 1 if rk >= -1 else -rk
+                j2 = k - 1 if r - 1 <= pk else deg - r
+                for j in range(j1, j2 + 1):
+                    a[s2][j] = (a[s1][j] - a[s1][j - 1]) / ndu[pk + 1][rk + j]
+                    d += a[s2][j] * ndu[rk + j][pk]
+                if r <= pk:
+                    a[s2][k] = -a[s1][k - 1] / ndu[pk + 1][r]
+                    d += a[s2][k] * ndu[r][pk]
+                ders[k, r] = d
+                s1, s2 = s2, s1
+
+        factor = deg
+        for k in range(1, n_ders + 1):
+            ders[k, :] *= factor
+            factor *= (deg - k)
+        return ders
+
+
+    def eval_vector_array(self, i_base, t_points):
+        """
+        Vectorized version of 'eval_vector'.
+        :param i_base: array N x int, intervals of the points, see 'find_knot_interval_array'.
+        :param t_points: array N x float, evaluation points.
+        :return: Numpy array N x (degree + 1), values of the nonzero basis functions in every point.
+        """
+        return self.eval_ders_vector_array(i_base, t_points, 0)[:, 0, :]
+
+
+    def eval_ders_vector_array(self, i_base, t_points, n_ders):
+        """
+        Vectorized version of 'eval_ders_vector', the triangular scheme is evaluated for all points at once.
+        :param i_base: array N x int, intervals of the points, see 'find_knot_interval_array'.
+        :param t_points: array N x float, evaluation points.
+        :param n_ders: Maximal order of the derivative.
+        :return: Numpy array N x (n_ders + 1) x (degree + 1); [:, k, :] are k-th derivatives.
+        """
+        i_base = np.asarray(i_base, dtype=int)
+        t_points = np.asarray(t_points, dtype=float)
+        deg = self.degree
+        n_points = len(t_points)
+        if n_points == 1:
+            # Single point, e.g. Newton iterations, the scalar kernel is faster.
+            return self.eval_ders_vector(i_base[0], t_points[0], n_ders)[None, :, :]
+        # left[j] = t - knots[span + 1 - j],  right[j] = knots[span + j] - t;  span = i_base + deg
+        j_range = np.arange(deg + 1)
+        left = t_points - self.knots[i_base[:, None] + deg + 1 - j_range].T
+        right = self.knots[i_base[:, None] + deg + j_range].T - t_points
+        return _eval_ders_triangular(left, right, n_ders)
+
+    def collocation_matrix(self, t_points):
+        """
+        Sparse collocation matrix of the basis for given points, i.e. B[i, j] = b_j(t_i).
+        :param t_points: array N x float, evaluation points, checked and fixed to the domain.
+        :return: scipy.sparse.csr_matrix N x size, (degree + 1) nonzeros per row.
+        """
+        t_points = self.check_array(t_points)
+        i_base = self.find_knot_interval_array(t_points)
+        values = self.eval_vector_array(i_base, t_points)
+        n_points, n_loc = values.shape
+        cols = i_base[:, None] + np.arange(n_loc)
+        indptr = np.arange(0, n_points * n_loc + 1, n_loc)
+        return scipy.sparse.csr_matrix((values.ravel(), cols.ravel(), indptr), shape=(n_points, self.size))
+
+
+    def greville_points(self):
+        """
+        Greville abscissae, i.e. averages of 'degree' consecutive knots, one point per basis function.
+        :return: Numpy array of 'size' points.
+        """
+        if self.degree == 0:
+            return (self.knots[:-1] + self.knots[1:]) / 2
+        i_knots = np.arange(self.size)[:, None] + np.arange(1, self.degree + 1)
+        return np.mean(self.knots[i_knots], axis=1)
+
+
+    def refine_poles(self, poles, new_knots, axis=0):
+        """
+        Knot refinement, insert all 'new_knots' at once (Oslo/Boehm),
+        see Piegl, Tiller: The NURBS Book, algorithm A5.4.
+        All the other axes of 'poles' are processed at once.
+        :param poles: array with 'size' items along 'axis'; for rational splines the poles must be weighted
+            (homogeneous coordinates).
+        :param new_knots: array of knots to insert, must be inside the domain; repeat a knot to increase its multiplicity.
+        :param axis: Axis of 'poles' corresponding to this basis.
+        :return: (refined SplineBasis, refined poles with size + len(new_knots) items along 'axis')
+        """
+        poles = np.moveaxis(np.asarray(poles, dtype=float), axis, 0)
+        assert poles.shape[0] == self.size
+        new_knots = np.sort(np.asarray(new_knots, dtype=float))
+        if len(new_knots) == 0:
+            return SplineBasis(self.degree, self.knots), np.moveaxis(poles.copy(), 0, axis)
+        assert self.domain[0] <= new_knots[0] and new_knots[-1] <= self.domain[1], \
+            "Inserted knots out of domain: {}".format(self.domain)
+        p, knots = self.degree, self.knots
+        n = self.size - 1
+        m = n + p + 1
+        r = len(new_knots) - 1
+        a = self.find_knot_interval(new_knots[0]) + p
+        b = self.find_knot_interval(new_knots[r]) + p + 1
+
+        new_poles = np.empty((n + r + 2,) + poles.shape[1:])
+        new_poles[:a - p + 1] = poles[:a - p + 1]
+        new_poles[b + r:] = poles[b - 1:]
+        ref_knots = np.empty(m + r + 2)
+        ref_knots[:a + 1] = knots[:a + 1]
+        ref_knots[b + p + r + 1:] = knots[b + p:]
+
+        i, k = b + p - 1, b + p + r
+        for x in new_knots[::-1]:
+            while x <= knots[i] and i > a:
+                new_poles[k - p - 1] = poles[i - p - 1]
+                ref_knots[k] = knots[i]
+                k -= 1
+                i -= 1
+            new_poles[k - p - 1] = new_poles[k - p]
+            for l in range(1, p + 1):
+                ind = k - p + l
+                alpha = ref_knots[k + l] - x
+                if alpha == 0.0:
+                    new_poles[ind - 1] = new_poles[ind]
+                else:
+                    alpha = alpha / (ref_knots[k + l] - knots[i - p + l])
+                    new_poles[ind - 1] = alpha * new_poles[ind - 1] + (1.0 - alpha) * new_poles[ind]
+            ref_knots[k] = x
+            k -= 1
+        return SplineBasis(p, ref_knots), np.moveaxis(new_poles, 0, axis)
+
+
+    def insert_knot(self, poles, t, mult=1, axis=0):
+        """
+        Insert the knot 't' 'mult' times.
+        :param poles: array with 'size' items along 'axis', weighted for rational splines.
+        :param t: Knot to insert, inside the domain.
+        :param mult: Number of insertions.
+        :param axis: Axis of 'poles' corresponding to this basis.
+        :return: (new SplineBasis, new poles), see 'refine_poles'.
+        """
+        return self.refine_poles(poles, [t] * mult, axis)
+
+
+    def split_poles(self, poles, t, axis=0):
+        """
+        Split the spline at the parameter 't', the knot 't' is inserted up to multiplicity 'degree',
+        the pole at 't' is shared by both parts.
+        :param poles: array with 'size' items along 'axis', weighted for rational splines.
+        :param t: Split point, interior of the domain.
+        :param axis: Axis of 'poles' corresponding to this basis.
+        :return: ((left SplineBasis, left poles), (right SplineBasis, right poles))
+        """
+        p = self.degree
+        assert p > 0
+        assert self.domain[0] < t < self.domain[1], "Split point t={} out of domain: {}".format(t, self.domain)
+        mult = np.count_nonzero(self.knots == t)
+        assert mult <= p
+        ref_basis, ref_poles = self.insert_knot(poles, t, p - mult, axis)
+        ref_poles = np.moveaxis(ref_poles, axis, 0)
+        # ref_knots[j: j + p] == t
+        j = np.searchsorted(ref_basis.knots, t, side='left')
+        left_basis = SplineBasis(p, np.concatenate((ref_basis.knots[:j + p], [t])))
+        right_basis = SplineBasis(p, np.concatenate(([t], ref_basis.knots[j:])))
+        left_poles = np.moveaxis(ref_poles[:j], 0, axis)
+        right_poles = np.moveaxis(ref_poles[j - 1:], 0, axis)
+        return (left_basis, left_poles), (right_basis, right_poles)
+
+
+    def elevate_degree(self, poles, times=1, axis=0):
+        """
+        Raise degree of the spline by 'times', multiplicity of every knot is raised by 'times' as well,
+        so the spline is preserved exactly. New poles are obtained by interpolation in the Greville points
+        of the elevated basis. Interior knots must have multiplicity at most 'degree' (continuous spline),
+        otherwise the Greville points of the elevated basis coincide.
+        :param poles: array with 'size' items along 'axis', weighted for rational splines.
+        :param times: Degree increment.
+        :param axis: Axis of 'poles' corresponding to this basis.
+        :return: (elevated SplineBasis, new poles)
+        """
+        poles = np.moveaxis(np.asarray(poles, dtype=float), axis, 0)
+        assert poles.shape[0] == self.size
+        if times == 0:
+            return SplineBasis(self.degree, self.knots), np.moveaxis(poles.copy(), 0, axis)
+        for q, mult in self.pack_knots():
+            if self.domain[0] < q < self.domain[1]:
+                assert mult <= self.degree, "Discontinuous spline, knot {} with multiplicity {}.".format(q, mult)
+        packed_knots = [(q, mult + times) for q, mult in self.pack_knots()]
+        new_basis = SplineBasis.make_from_packed_knots(self.degree + times, packed_knots)
+
+        points = new_basis.greville_points()
+        values = self.collocation_matrix(points).dot(poles.reshape(self.size, -1))
+        new_poles = scipy.sparse.linalg.spsolve(new_basis.collocation_matrix(points).tocsc(), values)
+        new_poles = new_poles.reshape((new_basis.size,) + poles.shape[1:])
+        return new_basis, np.moveaxis(new_poles, 0, axis)
+
+
+    def _bezier_decomposition(self, poles):
+        """
+        Raise multiplicity of all interior knots to the degree, so that the poles of every
+        knot interval form the Bezier control polygon of the spline on that interval.
+        :param poles: array size x ...; for rational splines the poles must be weighted.
+        :return: (bezier_poles, bounds)
+            bezier_poles - array n_intervals x (degree + 1) x ...
+            bounds - array n_intervals x 2, parameter range of the Bezier segment of every interval.
+        Empty knot intervals get the segment of the preceding nonempty interval.
+        """
+        p = self.degree
+        values, mults = np.unique(self.knots, return_counts=True)
+        interior = np.logical_and(values > self.domain[0], values < self.domain[1])
+        n_insert = np.maximum(p - mults[interior], 0)
+        ref_basis, ref_poles = self.refine_poles(poles, np.repeat(values[interior], n_insert))
+
+        ref_knots = ref_basis.knots
+        i_nonempty = np.nonzero(ref_knots[p + 1: p + 1 + ref_basis.n_intervals] > ref_knots[p: p + ref_basis.n_intervals])[0]
+        nonempty = self.knots[p + 1: p + 1 + self.n_intervals] > self.knots[p: p + self.n_intervals]
+        i_segment = np.maximum(np.cumsum(nonempty) - 1, 0)
+        i_start = i_nonempty[i_segment]
+        bezier_poles = ref_poles[i_start[:, None] + np.arange(p + 1)]
+        bounds = np.stack((ref_knots[i_start + p], ref_knots[i_start + p + 1]), axis=1)
+        return bezier_poles, bounds
 
 
     """
     Specializations.
     TODO:
     - Try usage of scipy evaluation, compare speed with optimized eval_vector and diff_eval_vector.
-    - Generalize optimized evaluation of eval_vector (If scipy is not faster), De Boor algortihm, Hoschek 4.3.3.
     - Optimize eval and eval_diff - without recursion, based on combinatorGeneralize optimized evaluation of eval_vector (If scipy is not faster)
     """
     def _eval_vector_deg_2(self, i_int, t):
@@ -339,6 +627,259 @@ class SplineBasis:
         return basis_values
 
 
+def _eval_ders_triangular(left, right, n_ders):
+    """
+    Triangular scheme of the nonzero basis functions and their derivatives (A2.3), vectorized over the points.
+    :param left: array (degree + 1) x N, left[j] = t - knots[span + 1 - j].
+    :param right: array (degree + 1) x N, right[j] = knots[span + j] - t.
+    :param n_ders: Maximal order of the derivative.
+    :return: Numpy array N x (n_ders + 1) x (degree + 1); [:, k, :] are k-th derivatives.
+    """
+    deg, n_points = left.shape[0] - 1, left.shape[1]
+    ders = np.zeros((n_points, n_ders + 1, deg + 1))
+    n_ders = min(n_ders, deg)
+
+    ndu = np.ones((deg + 1, deg + 1, n_points))
+    for j in range(1, deg + 1):
+        saved = 0.0
+        for r in range(j):
+            ndu[j, r] = right[r + 1] + left[j - r]
+            temp = ndu[r, j - 1] / ndu[j, r]
+            ndu[r, j] = saved + right[r + 1] * temp
+            saved = left[j - r] * temp
+        ndu[j, j] = saved
+    ders[:, 0, :] = ndu[:, deg, :].T
+
+    a = np.zeros((2, deg + 1, n_points))
+    for r in range(deg + 1):
+        s1, s2 = 0, 1
+        a[0, 0] = 1.0
+        for k in range(1, n_ders + 1):
+            d = np.zeros(n_points)
+            rk, pk = r - k, deg - k
+            if r >= k:
+                a[s2, 0] = a[s1, 0] / ndu[pk + 1, rk]
+                d = a[s2, 0] * ndu[rk, pk]
+            j1 = 1 if rk >= -1 else -rk
+            j2 = k - 1 if r - 1 <= pk else deg - r
+            for j in range(j1, j2 + 1):
+                a[s2, j] = (a[s1, j] - a[s1, j - 1]) / ndu[pk + 1, rk + j]
+                d = d + a[s2, j] * ndu[rk + j, pk]
+            if r <= pk:
+                a[s2, k] = -a[s1, k - 1] / ndu[pk + 1, r]
+                d = d + a[s2, k] * ndu[r, pk]
+            ders[:, k, r] = d
+            s1, s2 = s2, s1
+
+    factor = deg
+    for k in range(1, n_ders + 1):
+        ders[:, k, :] *= factor
+        factor *= (deg - k)
+    return ders
+
+
+def _to_weighted(poles, dim):
+    """
+    Rational poles [x*, w] (unweighted coordinates, weight in the last item) to homogeneous coordinates [w*x*, w].
+    """
+    weights = poles[..., dim:]
+    return np.concatenate((poles[..., 0:dim] * weights, weights), axis=-1)
+
+
+def _from_weighted(poles, dim):
+    """
+    Inverse of '_to_weighted'.
+    """
+    weights = poles[..., dim:]
+    return np.concatenate((poles[..., 0:dim] / weights, weights), axis=-1)
+
+
+def _interval_samples(basis, n_samples):
+    """
+    Parameters of 'n_samples' equidistant points on every knot interval of the 'basis', including the interval ends.
+    :return: array n_intervals x n_samples
+    """
+    i_knots = np.arange(basis.n_intervals) + basis.degree
+    t_min, t_max = basis.knots[i_knots], basis.knots[i_knots + 1]
+    s = np.linspace(0.0, 1.0, n_samples)
+    return t_min[:, None] + s * (t_max - t_min)[:, None]
+
+
+PROJECT_MAX_PAIRS = 2 ** 18
+# Bound of the number of (point, patch) pairs of the candidate search in 'project_points',
+# points are processed by chunks of PROJECT_MAX_PAIRS // n_patches.
+
+
+def _project_by_chunks(project_fn, points, n_patches, chunk_size=None):
+    """
+    Apply the projection function to chunks of points, bounds the size of the candidate arrays.
+    :param project_fn: Function: array M x D -> tuple of arrays with M rows.
+    :param points: array N x D
+    :param n_patches: Number of patches (knot intervals) of the curve/surface.
+    :param chunk_size: Number of points in a chunk, by default given by PROJECT_MAX_PAIRS.
+    :return: tuple of concatenated results
+    """
+    if chunk_size is None:
+        chunk_size = max(1, PROJECT_MAX_PAIRS // max(n_patches, 1))
+    if len(points) <= chunk_size:
+        return project_fn(points)
+    results = [project_fn(points[i: i + chunk_size]) for i in range(0, len(points), chunk_size)]
+    return tuple(np.concatenate(items) for items in zip(*results))
+
+
+def _closest_candidates(points, patch_samples, patch_index, max_candidates):
+    """
+    Initial guesses for the closest point projection.
+    The nearest sample of every point gives an upper bound 'r' of its distance to the curve/surface,
+    patches with boxes intersecting the box [point - r, point + r] are candidates. At most 'max_candidates'
+    patches are used: the patch of the nearest sample and the patches with the smallest distance of the box
+    from the point.
+    Every local minimum of the distance to the samples of a candidate patch is an initial guess.
+    :param points: array N x D
+    :param patch_samples: array n_patches x n_samples x ... x D, grids of sample points of the patches.
+    :param patch_index: PatchIndex of the patch boxes.
+    :param max_candidates: Maximal number of candidate patches of a point.
+    :return: (i_points, i_patches, i_local); initial guesses sorted by the point,
+        i_local are indices of the samples within the patch grid, array M x (patch_samples.ndim - 2).
+    """
+    dim = patch_samples.shape[-1]
+    grid_axes = tuple(range(1, patch_samples.ndim - 1))
+    tree = scipy.spatial.cKDTree(patch_samples.reshape(-1, dim))
+    dist, i_nearest = tree.query(points)
+    radius = (dist * (1.0 + 1e-8) + 1e-12)[:, None]
+    indptr, i_patches = patch_index.find_boxes(np.stack((points - radius, points + radius), axis=1))
+    i_points = np.repeat(np.arange(len(points)), np.diff(indptr))
+
+    # k nearest patches by the distance of the box, the patch of the nearest sample first
+    boxes = patch_index.boxes[i_patches]
+    box_dist = la.norm(np.maximum(0.0, np.maximum(boxes[:, 0, :] - points[i_points],
+                                                  points[i_points] - boxes[:, 1, :])), axis=1)
+    nearest_patch = i_nearest // np.prod(patch_samples.shape[1:-1])
+    box_dist[i_patches == nearest_patch[i_points]] = -1.0
+    order = np.lexsort((box_dist, i_points))
+    rank = np.arange(len(order)) - indptr[i_points[order]]
+    keep = np.sort(order[rank < max_candidates])
+    i_points, i_patches = i_points[keep], i_patches[keep]
+
+    point_shape = (len(i_points),) + (1,) * len(grid_axes) + (dim,)
+    sample_dist = np.sum((patch_samples[i_patches] - points[i_points].reshape(point_shape)) ** 2, axis=-1)
+    is_min = np.ones(sample_dist.shape, dtype=bool)
+    for axis in grid_axes:
+        pad = [(0, 0)] * sample_dist.ndim
+        pad[axis] = (1, 1)
+        padded = np.pad(sample_dist, pad, constant_values=np.inf)
+        lower = np.take(padded, np.arange(0, sample_dist.shape[axis]), axis=axis)
+        upper = np.take(padded, np.arange(2, sample_dist.shape[axis] + 2), axis=axis)
+        is_min &= np.logical_and(sample_dist <= lower, sample_dist <= upper)
+    i_pair, *i_local = np.nonzero(is_min)
+    return i_points[i_pair], i_patches[i_pair], np.stack(i_local, axis=1)
+
+
+def _select_closest(i_points, dist, n_points):
+    """
+    Select the closest candidate for every point.
+    :param i_points: array M x int, sorted point indices of candidates, every point has a candidate.
+    :param dist: array M x float, distances of the candidates.
+    :param n_points: Number of points.
+    :return: array n_points x int, indices of the selected candidates.
+    """
+    order = np.lexsort((dist, i_points))
+    first = np.searchsorted(i_points[order], np.arange(n_points))
+    return order[first]
+
+
+def _damped_step(eval_fn, points, x, delta, bounds, max_halving=10):
+    """
+    Step of the damped Newton method for the closest point projection.
+    The step is restricted to the parameter domain and halved until the distance to 'points' decreases.
+    :param eval_fn: Vectorized evaluation function, array N x P of parameters -> array N x D
+    :param points: array N x D, projected points.
+    :param x: array N x P, current parameters.
+    :param delta: array N x P, full Newton step.
+    :param bounds: (min, max), arrays P x float, parameter domain.
+    :param max_halving: Maximal number of step halving.
+    :return: array N x P, new parameters; unchanged for points, where the step fails.
+    """
+    dist = np.sum((eval_fn(x) - points) ** 2, axis=1)
+    x_new = np.clip(x + delta, bounds[0], bounds[1])
+    i_check = np.arange(len(x))
+    for i in range(max_halving + 1):
+        new_dist = np.sum((eval_fn(x_new[i_check]) - points[i_check]) ** 2, axis=1)
+        i_check = i_check[new_dist > dist[i_check]]
+        if len(i_check) == 0:
+            break
+        delta[i_check] /= 2
+        x_new[i_check] = np.clip(x[i_check] + delta[i_check], bounds[0], bounds[1])
+    x_new[i_check] = x[i_check]
+    return x_new
+
+
+EVAL_CHUNK_SIZE = 2 ** 16
+# Maximal number of points evaluated at once by 'eval_array' methods, bounds the size of the temporaries.
+
+
+def _chunked_eval(eval_fn, points, n_workers=1, chunk_size=None):
+    """
+    Evaluate a function of point arrays by chunks, possibly in parallel threads.
+    Numpy kernels release GIL, so the chunks are evaluated concurrently. The thread pool lives just for the call.
+    :param eval_fn: Function: array M x ... -> array M x ...
+    :param points: array N x ...
+    :param n_workers: Number of threads, the chunks are evaluated sequentially for n_workers=1.
+    :param chunk_size: Maximal number of points in a chunk, EVAL_CHUNK_SIZE by default.
+    :return: Concatenated results of the chunks.
+    """
+    chunk_size = EVAL_CHUNK_SIZE if chunk_size is None else chunk_size
+    n_points = len(points)
+    if n_points <= chunk_size:
+        return eval_fn(points)
+    chunks = [points[i: i + chunk_size] for i in range(0, n_points, chunk_size)]
+    if n_workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(eval_fn, chunks))
+    else:
+        results = [eval_fn(chunk) for chunk in chunks]
+    return np.concatenate(results)
+
+
+_ARC_GAUSS = np.polynomial.legendre.leggauss(8)
+# Gauss-Legendre rule for the arc length integration.
+_ARC_RTOL = 1e-12
+# Relative tolerance of the arc length table.
+_ARC_MAX_LEVEL = 30
+# Maximal number of bisections of a knot interval in the arc length table.
+
+
+def _bernstein_array(degree, bounds, t_points):
+    """
+    Bernstein polynomials of given degree on the Bezier segments.
+    :param degree: Degree of the polynomials.
+    :param bounds: array N x 2, parameter range of the segment of every point.
+    :param t_points: array N x float
+    :return: Numpy array N x (degree + 1).
+    """
+    s = (np.asarray(t_points, dtype=float) - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+    k = np.arange(degree + 1)
+    return binom(degree, k) * s[:, None] ** k * (1.0 - s[:, None]) ** (degree - k)
+
+
+def _window_boxes(poles, window_shape):
+    """
+    Bounding boxes of all windows of the pole grid, min and max over the shifted slices of the grid.
+    :param poles: array n_u x n_v x D
+    :param window_shape: (w_u, w_v)
+    :return: array (n_u - w_u + 1) x (n_v - w_v + 1) x 2 x D; [..., 0, :] min corners, [..., 1, :] max corners.
+    """
+    w_u, w_v = window_shape
+    n_u, n_v = poles.shape[0] - w_u + 1, poles.shape[1] - w_v + 1
+    box_min = poles[0:n_u, 0:n_v].copy()
+    box_max = box_min.copy()
+    for i in range(w_u):
+        for j in range(w_v):
+            np.minimum(box_min, poles[i:i + n_u, j:j + n_v], out=box_min)
+            np.maximum(box_max, poles[i:i + n_u, j:j + n_v], out=box_max)
+    return np.stack((box_min, box_max), axis=2)
+
+
 class Curve:
     """
     Defines a D-dim B-spline curve.
@@ -357,19 +898,21 @@ class Curve:
         basis = SplineBasis(degree, knots)
         return cls(basis, poles, rational)
 
-    def __init__(self, basis, poles, rational = False):
+    def __init__(self, basis, poles, rational = False, copy=True):
         """
         Construct a B-spline curve.
         :param poles: Numpy array N x (D+r) of poles (control points). N is number of poles, D is dimension of the curve, 'r' is 1 for rational curves.
          For rational case, poles[:, D] are weights of the control points.
         :param basis: SplineBasis object.
         :param rational: True for rational B-spline, i.e. NURB. Use weighted poles.
+        :param copy: Copy the poles. Use False to keep a float array as is, e.g. a read-only memmap view,
+            the caller must not modify it then.
         """
 
         self.basis = basis
         # Spline basis.
 
-        self.poles = np.array(poles, dtype=float)  # N x D
+        self.poles = np.array(poles, dtype=float) if copy else np.asarray(poles, dtype=float)  # N x D
         assert self.poles.shape[0] == self.basis.size
         # Spline poles.
 
@@ -381,13 +924,20 @@ class Curve:
 
         if rational:
             # precomputations
-            self._weights = poles[:, self.dim]
-            self._poles = (poles[:, 0:self.dim].T * self._weights ).T
+            self._weights = self.poles[:, self.dim]
+            self._poles = (self.poles[:, 0:self.dim].T * self._weights ).T
 
         # BIH tree
+        self._box_array = None
         self._boxes = None
         self._tree = None
+        self._patch_index = None
 
+        self._bezier = None
+        # Cached Bezier decomposition, see 'bezier_poles'.
+
+        self._arc_table = None
+        # Cached arc length table, see 'length'.
 
     def eval_local(self, t, it):
         """
@@ -420,14 +970,337 @@ class Curve:
         return self.eval_local(t, it)
 
 
-    def eval_array(self, t_points):
+    def eval_array(self, t_points, n_workers=1, chunk_size=None):
         """
         Evaluate in array of t-points.
         :param t_points: array N x float
+        :param n_workers, chunk_size: Large arrays are evaluated by chunks in parallel threads, see '_chunked_eval'.
         :return: Numpy array N x D, D is dimension of the curve.
         """
-        return np.array( [ self.eval(t) for t in t_points] )
+        t_points = np.atleast_1d(np.asarray(t_points, dtype=float))
+        return _chunked_eval(self._eval_array_chunk, t_points, n_workers, chunk_size)
+
+    def _eval_array_chunk(self, t_points):
+        t_points = self.basis.check_array(t_points)
+        it = self.basis.find_knot_interval_array(t_points)
+        t_base_vec = self.basis.eval_vector_array(it, t_points)
+        # indices of poles for nonzero basis functions, N x (degree + 1)
+        i_poles = it[:, None] + np.arange(self.basis.degree + 1)
+
+        if self.rational:
+            top_value = np.einsum('ni,nid->nd', t_base_vec, self._poles[i_poles, :])
+            bot_value = np.einsum('ni,ni->n', t_base_vec, self._weights[i_poles])
+            return top_value / bot_value[:, None]
+        else:
+            return np.einsum('ni,nid->nd', t_base_vec, self.poles[i_poles, :])
+
+
+    def eval_derivs(self, t_points, order=1):
+        """
+        Evaluate the curve and its derivatives in array of t-points.
+        :param t_points: array N x float
+        :param order: Maximal order of derivatives.
+        :return: Numpy array N x (order + 1) x D; [:, k, :] is the k-th derivative, [:, 0, :] are the curve points.
+        """
+        t_points = self.basis.check_array(t_points)
+        it = self.basis.find_knot_interval_array(t_points)
+        return self.eval_derivs_local(t_points, it, order)
+
+    def eval_derivs_local(self, t_points, it_points, order=1):
+        """
+        Evaluate the curve and its derivatives for given knot subintervals.
+        Rational curves are differentiated by the quotient rule, see Piegl, Tiller: The NURBS Book, A4.2.
+        :param t_points: array N x float, evaluation points.
+        :param it_points: array N x int, indices of knot subintervals (see doc of 'find_knot_interval')
+        :param order: Maximal order of derivatives.
+        :return: Numpy array N x (order + 1) x D.
+        """
+        it_points = np.asarray(it_points, dtype=int)
+        t_ders = self.basis.eval_ders_vector_array(it_points, t_points, order)
+        i_poles = it_points[:, None] + np.arange(self.basis.degree + 1)
+
+        if not self.rational:
+            return np.einsum('nki,nid->nkd', t_ders, self.poles[i_poles, :])
+
+        a_ders = np.einsum('nki,nid->nkd', t_ders, self._poles[i_poles, :])
+        w_ders = np.einsum('nki,ni->nk', t_ders, self._weights[i_poles])
+        ders = np.empty_like(a_ders)
+        for k in range(order + 1):
+            value = a_ders[:, k, :].copy()
+            for i in range(1, k + 1):
+                value -= binom(k, i) * w_ders[:, i, None] * ders[:, k - i, :]
+            ders[:, k, :] = value / w_ders[:, 0, None]
+        return ders
+
+    def eval_tangents(self, t_points):
+        """
+        Unit tangent vectors of the curve.
+        :param t_points: array N x float
+        :return: Numpy array N x D.
+        """
+        diff = self.eval_derivs(t_points, 1)[:, 1, :]
+        return diff / la.norm(diff, axis=1)[:, None]
+
+    def _weighted_poles(self):
+        """ Poles in homogeneous coordinates for the rational curve, plain poles otherwise. """
+        return _to_weighted(self.poles, self.dim) if self.rational else self.poles
 
+    def _make_from_weighted(self, basis, poles):
+        """ New curve from the basis and poles in homogeneous coordinates. """
+        if self.rational:
+            poles = _from_weighted(poles, self.dim)
+        return Curve(basis, poles, self.rational)
+
+    def insert_knot(self, t, mult=1):
+        """
+        Insert knot 't' 'mult' times, the curve geometry is not changed.
+        :param t: New knot.
+        :param mult: Number of insertions.
+        :return: New Curve.
+        """
+        return self._make_from_weighted(*self.basis.insert_knot(self._weighted_poles(), t, mult))
+
+    def refine(self, new_knots):
+        """
+        Insert all 'new_knots' at once, the curve geometry is not changed.
+        :param new_knots: Array of knots, repeated knots are inserted repeatedly.
+        :return: New Curve.
+        """
+        return self._make_from_weighted(*self.basis.refine_poles(self._weighted_poles(), new_knots))
+
+    def split(self, t):
+        """
+        Split the curve at the parameter 't'.
+        :param t: Split point, interior of the parameter domain.
+        :return: (left Curve, right Curve)
+        """
+        left, right = self.basis.split_poles(self._weighted_poles(), t)
+        return self._make_from_weighted(*left), self._make_from_weighted(*right)
+
+    def elevate_degree(self, times=1):
+        """
+        Raise degree of the curve, the curve geometry is not changed.
+        :param times: Degree increment.
+        :return: New Curve.
+        """
+        return self._make_from_weighted(*self.basis.elevate_degree(self._weighted_poles(), times))
+
+    def project_points(self, points, n_samples=6, max_it=30, tol=1e-12, max_candidates=4, chunk_size=None):
+        """
+        Closest point projection (point inversion) of many points at once.
+        Initial guesses are the local minima of the distance to the samples of the candidate knot intervals,
+        found using 'patch_index'.
+        All candidates are then refined at once by the damped Newton method for the minimum
+        of the squared distance and the closest result is selected.
+        :param points: array N x D
+        :param n_samples: Number of samples per knot interval.
+        :param max_it: Maximal number of Newton iterations.
+        :param tol: Tolerance of the parameter update relative to the domain size.
+        :param max_candidates: Maximal number of candidate intervals of a point, nearest by the box distance.
+        :param chunk_size: Number of points processed at once, see '_project_by_chunks'.
+        :return: (t_points, distances, intervals); arrays N x float, N x float, N x int
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, self.dim)
+        t_samples = _interval_samples(self.basis, n_samples)
+        samples = self.eval_array(t_samples.ravel()).reshape(self.basis.n_intervals, n_samples, self.dim)
+
+        def project_chunk(points):
+            i_points, i_patches, i_local = _closest_candidates(points, samples, self.patch_index, max_candidates)
+            t_init = t_samples[i_patches, i_local[:, 0]]
+            t_points = self._project_newton(points[i_points], t_init, max_it, tol)
+
+            dist = la.norm(self.eval_array(t_points) - points[i_points], axis=1)
+            i_best = _select_closest(i_points, dist, len(points))
+            return t_points[i_best], dist[i_best]
+
+        t_points, dist = _project_by_chunks(project_chunk, points, self.basis.n_intervals, chunk_size)
+        return t_points, dist, self.basis.find_knot_interval_array(t_points)
+
+    def _project_newton(self, points, t_points, max_it, tol):
+        """
+        Batched damped Newton method for the closest points on the curve.
+        :param points: array N x D
+        :param t_points: array N x float, initial guess.
+        :return: array N x float
+        """
+        bounds = (self.basis.domain[0:1], self.basis.domain[1:2])
+        eval_fn = lambda t: self.eval_array(t[:, 0])
+        t_points = np.array(t_points, dtype=float)[:, None]
+        active = np.arange(len(points))
+        for i in range(max_it):
+            if len(active) == 0:
+                break
+            t, p = t_points[active], points[active]
+            ders = self.eval_derivs(t[:, 0], 2)
+            diff = ders[:, 0, :] - p
+            grad = np.sum(ders[:, 1, :] * diff, axis=1)
+            jtj = np.sum(ders[:, 1, :] ** 2, axis=1)
+            hess = jtj + np.sum(ders[:, 2, :] * diff, axis=1)
+            # positive second derivative of the distance, fall back to Gauss-Newton
+            hess = np.where(hess > 1e-3 * jtj, hess, jtj)
+            hess = np.where(hess > 0, hess, 1.0)
+            t_new = _damped_step(eval_fn, p, t, (-grad / hess)[:, None], bounds)
+            t_points[active] = t_new
+            active = active[np.abs(t_new - t)[:, 0] > tol * self.basis.domain_size]
+        return t_points[:, 0]
+
+    def _get_bezier(self):
+        """
+        Bezier decomposition of the curve, computed on the first call by knot insertion.
+        :return: (poles, bounds, boxes)
+            poles - n_intervals x (degree + 1) x (D + r), weighted poles of the Bezier segments
+            bounds - n_intervals x 2, parameter range of the segments
+            boxes - n_intervals x 2 x D, min and max corners of the segment control polygons
+        """
+        if self._bezier is None:
+            bezier_poles, bounds = self.basis._bezier_decomposition(self._weighted_poles())
+            coords = bezier_poles[:, :, 0:self.dim]
+            if self.rational:
+                coords = coords / bezier_poles[:, :, self.dim:]
+            boxes = np.stack((np.amin(coords, axis=1), np.amax(coords, axis=1)), axis=1)
+            self._bezier = (np.ascontiguousarray(bezier_poles), bounds, boxes)
+        return self._bezier
+
+    @property
+    def bezier_poles(self):
+        """
+        Poles of the Bezier segments, one segment per knot interval.
+        :return: Numpy array n_intervals x (degree + 1) x (D + r), same convention as 'poles'.
+        """
+        bezier_poles = self._get_bezier()[0]
+        return _from_weighted(bezier_poles, self.dim) if self.rational else bezier_poles
+
+    @property
+    def bezier_boxes(self):
+        """
+        Bounding boxes of the Bezier segments, tighter than the boxes of the B-spline pole windows.
+        :return: Numpy array n_intervals x 2 x D; [:, 0, :] min corners, [:, 1, :] max corners.
+        """
+        return self._get_bezier()[2]
+
+    def eval_bezier_local(self, t_points, it_points):
+        """
+        Evaluate the curve using the Bezier decomposition, no knot lookup.
+        :param t_points: array N x float, evaluation points.
+        :param it_points: array N x int, indices of knot subintervals (see doc of 'find_knot_interval')
+        :return: Numpy array N x D.
+        """
+        bezier_poles, bounds, _ = self._get_bezier()
+        it_points = np.asarray(it_points, dtype=int)
+        t_base_vec = _bernstein_array(self.basis.degree, bounds[it_points], t_points)
+        values = np.einsum('ni,nid->nd', t_base_vec, bezier_poles[it_points])
+        if self.rational:
+            return values[:, 0:self.dim] / values[:, self.dim:]
+        return values
+
+    def _gauss_length(self, t_begin, t_end):
+        """
+        Lengths of the curve segments by the Gauss-Legendre quadrature of |C'(t)|.
+        :param t_begin, t_end: arrays N, bounds of the segments, within single knot interval for full accuracy.
+        :return: array N
+        """
+        gauss_points, gauss_weights = _ARC_GAUSS
+        half = (t_end - t_begin) / 2
+        t_points = ((t_begin + t_end) / 2)[:, None] + half[:, None] * gauss_points
+        speed = la.norm(self.eval_derivs(t_points.ravel(), order=1)[:, 1, :], axis=1).reshape(t_points.shape)
+        return half * np.dot(speed, gauss_weights)
+
+    def _get_arc_table(self):
+        """
+        Arc length table, computed on the first call by adaptive Gauss quadrature.
+        Every knot interval is bisected until the quadrature of halves match the quadrature of the whole,
+        all segments of a bisection level are integrated at once.
+        :return: (t_nodes, s_nodes); parameters of the segment bounds and arc lengths in them, arrays N + 1.
+        """
+        if self._arc_table is None:
+            i_begin, i_end = self.basis.knots_idx_range
+            breaks = np.unique(self.basis.knots[i_begin: i_end + 1])
+            t_begin, t_end = breaks[:-1], breaks[1:]
+            lengths = self._gauss_length(t_begin, t_end)
+            tol = _ARC_RTOL * max(np.sum(lengths), np.finfo(float).tiny)
+            done_begin, done_lengths = [], []
+            for level in range(_ARC_MAX_LEVEL):
+                if len(t_begin) == 0:
+                    break
+                t_mid = (t_begin + t_end) / 2
+                left, right = self._gauss_length(t_begin, t_mid), self._gauss_length(t_mid, t_end)
+                converged = np.abs(left + right - lengths) <= tol
+                done_begin.extend([t_begin[converged], t_mid[converged]])
+                done_lengths.extend([left[converged], right[converged]])
+                t_begin = np.concatenate((t_begin[~converged], t_mid[~converged]))
+                t_end = np.concatenate((t_mid[~converged], t_end[~converged]))
+                lengths = np.concatenate((left[~converged], right[~converged]))
+            done_begin.append(t_begin)
+            done_lengths.append(lengths)
+
+            t_nodes = np.concatenate(done_begin)
+            order = np.argsort(t_nodes)
+            t_nodes = np.append(t_nodes[order], breaks[-1])
+            s_nodes = np.concatenate(([0.0], np.cumsum(np.concatenate(done_lengths)[order])))
+            self._arc_table = (t_nodes, s_nodes)
+        return self._arc_table
+
+    def length(self):
+        """
+        Length of the curve.
+        """
+        return self._get_arc_table()[1][-1]
+
+    def arc_length(self, t_points):
+        """
+        Arc length from the curve start.
+        :param t_points: array N x float
+        :return: array N
+        """
+        t_nodes, s_nodes = self._get_arc_table()
+        t_points = self.basis.check_array(t_points)
+        i_seg = np.clip(np.searchsorted(t_nodes, t_points, side='right') - 1, 0, len(t_nodes) - 2)
+        return s_nodes[i_seg] + self._gauss_length(t_nodes[i_seg], t_points)
+
+    def t_at_length(self, s_points, max_it=20):
+        """
+        Inverse of 'arc_length'. Safeguarded Newton iterations within segments of the arc length table.
+        :param s_points: array N, arc lengths in [0, length].
+        :param max_it: Maximal number of Newton iterations.
+        :return: array N of parameters.
+        """
+        t_nodes, s_nodes = self._get_arc_table()
+        total = s_nodes[-1]
+        s_points = np.clip(np.asarray(s_points, dtype=float), 0.0, total)
+        i_seg = np.clip(np.searchsorted(s_nodes, s_points, side='right') - 1, 0, len(t_nodes) - 2)
+        t_lo, t_hi = t_nodes[i_seg], t_nodes[i_seg + 1]
+        s_lo, s_hi = s_nodes[i_seg], s_nodes[i_seg + 1]
+        ds = s_hi - s_lo
+        t_points = t_lo + np.where(ds > 0, (s_points - s_lo) / np.where(ds > 0, ds, 1.0), 0.0) * (t_hi - t_lo)
+        t_seg_begin = t_lo.copy()
+
+        tol = _ARC_RTOL * total
+        active = np.arange(len(t_points))
+        for it in range(max_it):
+            t = t_points[active]
+            residual = s_lo[active] + self._gauss_length(t_seg_begin[active], t) - s_points[active]
+            converged = np.abs(residual) <= tol
+            active, t, residual = active[~converged], t[~converged], residual[~converged]
+            if len(active) == 0:
+                break
+            # keep the root bracket
+            above = residual > 0
+            t_hi[active[above]] = t[above]
+            t_lo[active[~above]] = t[~above]
+            speed = la.norm(self.eval_derivs(t, order=1)[:, 1, :], axis=1)
+            t_new = t - residual / np.where(speed > 0, speed, 1.0)
+            outside = np.logical_or(speed <= 0, np.logical_or(t_new <= t_lo[active], t_new >= t_hi[active]))
+            t_new[outside] = (t_lo[active[outside]] + t_hi[active[outside]]) / 2
+            t_points[active] = t_new
+        return t_points
+
+    def equal_length_params(self, n_points):
+        """
+        Parameters of the points dividing the curve into segments of equal arc length.
+        :param n_points: Number of points including the curve end points.
+        :return: array n_points
+        """
+        return self.t_at_length(np.linspace(0.0, self.length(), n_points))
 
     def aabb(self):
         """
@@ -436,32 +1309,202 @@ class Curve:
         """
         return np.array( [np.amin(self.poles, axis=0), np.amax(self.poles, axis=0)] )
 
-    def bounding_boxes(self):
+    @property
+    def box_array(self):
         """
-        Compute bounding boxes and construct BIH tree for a given curve
-        :param self:
-        :return:
+        Bounding boxes of the pole windows of all knot intervals.
+        :return: Numpy array n_intervals x 2 x D; [:, 0, :] min corners, [:, 1, :] max corners.
+        """
+        if self._box_array is None:
+            self._box_array = _window_boxes(self.poles[:, None, 0:self.dim], (self.basis.degree + 1, 1))[:, 0]
+        return self._box_array
+
+    @property
+    def patch_index(self):
         """
-        tree = bih.BIH()
-        boxes = [bih.AABB(self.poles[it:it + 3, :].tolist()) for it in range(self.basis.n_intervals)]
-        tree.add_boxes(boxes)
-        tree.construct()
+        Numpy lookup of the boxes in 'box_array', allows vectorized queries for many boxes.
+        :return: PatchIndex
+        """
+        if self._patch_index is None:
+            self._patch_index = PatchIndex(self.box_array)
+        return self._patch_index
 
-        self._tree = tree
-        self._boxes = boxes
+    def bounding_boxes(self):
+        """
+        Set bounding boxes and the box tree of the curve intervals,
+        the tree is the PatchIndex with the same 'find_box', 'find_point' interface as the BIH tree.
+        """
+        self._tree, self._boxes = self.patch_index, self.box_array
 
     @property
     def boxes(self):
-        if self._boxes == None:
+        if self._boxes is None:
             self.bounding_boxes()
         return self._boxes
 
     @property
     def tree(self):
-        if self._tree == None:
+        if self._tree is None:
             self.bounding_boxes()
         return self._tree
 
+
+class CurveSet:
+    """
+    Set of many B-spline curves of common degree and dimension stored in packed arrays.
+    Curves with different knot vectors are padded, knots by the last knot, poles by zeros.
+    All curves are evaluated at once in a batch of parameters, without per curve overhead.
+    """
+
+    @classmethod
+    def from_curves(cls, curves):
+        """
+        Pack given curves. Set is rational if any of the curves is rational, unit weights are used for the others.
+        :param curves: List of K Curve objects of common degree and dimension.
+        :return: CurveSet
+        """
+        curves = list(curves)
+        assert len(curves) > 0
+        degree, dim = curves[0].basis.degree, curves[0].dim
+        rational = any(curve.rational for curve in curves)
+        n_poles = np.array([curve.basis.size for curve in curves])
+        n_knots = n_poles + degree + 1
+        knots = np.empty((len(curves), np.max(n_knots)))
+        poles = np.zeros((len(curves), np.max(n_poles), dim + rational))
+        for k, curve in enumerate(curves):
+            assert curve.basis.degree == degree and curve.dim == dim, "Curves of different degree or dimension."
+            knots[k, :n_knots[k]] = curve.basis.knots
+            knots[k, n_knots[k]:] = curve.basis.knots[-1]
+            poles[k, :n_poles[k], :curve.poles.shape[1]] = curve.poles
+            if rational and not curve.rational:
+                poles[k, :n_poles[k], dim] = 1.0
+        return cls(degree, knots, poles, n_poles, rational)
+
+    def __init__(self, degree, knots, poles, n_poles=None, rational=False, copy=True):
+        """
+        Construct the set from packed arrays.
+        :param degree: Common degree of the curves.
+        :param knots: Knot vectors, array K x M padded by the last knot, or single knot vector M shared by all curves.
+        :param poles: array K x N x (D+r), poles padded by zeros. For rational curves poles[:, :, D] are weights,
+            see Curve.
+        :param n_poles: array K, number of poles of the curves, N for all curves by default.
+        :param rational: True for rational curves.
+        :param copy: Copy the knots and poles, use False to keep float arrays as they are.
+        """
+        self.poles = np.array(poles, dtype=float) if copy else np.asarray(poles, dtype=float)
+        n_curves, max_poles, pole_dim = self.poles.shape
+        # Packed poles, K x N x (D+r).
+
+        self.degree = degree
+        self.rational = rational
+        self.dim = pole_dim - rational
+        # Common degree, rationality and dimension of the curves.
+
+        knots = np.array(knots, dtype=float) if copy else np.asarray(knots, dtype=float)
+        if knots.ndim == 1:
+            knots = np.broadcast_to(knots, (n_curves, len(knots)))
+        self.knots = knots
+        # Packed knot vectors, K x M.
+
+        if n_poles is None:
+            n_poles = np.full(n_curves, max_poles)
+        self.n_poles = np.asarray(n_poles, dtype=int)
+        assert np.all(self.n_poles + degree + 1 <= self.knots.shape[1])
+
+        self.domain = np.stack((self.knots[:, degree], self.knots[np.arange(n_curves), self.n_poles]), axis=1)
+        # Domains of the curves, K x 2.
+
+        self.basis = None
+        if np.all(self.n_poles == max_poles) and np.all(self.knots == self.knots[0]):
+            self.basis = SplineBasis(degree, self.knots[0, :max_poles + degree + 1])
+        # Common basis, if all curves have the same knot vector.
+
+        self._weighted = _to_weighted(self.poles, self.dim) if rational else self.poles
+
+    def __len__(self):
+        return len(self.poles)
+
+    def _check_array(self, t_points, rtol=1e-10):
+        """
+        Same as SplineBasis.check_array, for domains of all curves.
+        """
+        lo, hi = self.domain[:, 0, None], self.domain[:, 1, None]
+        tol = (np.abs(t_points) + 1e-4) * rtol
+        out_of_domain = np.logical_or(t_points < lo - tol, t_points > hi + tol)
+        if np.any(out_of_domain):
+            k, i = np.argwhere(out_of_domain)[0]
+            raise IndexError("Evaluate spline {}, t={}, out of domain: {}.".format(k, t_points[k, i], self.domain[k]))
+        return np.clip(t_points, lo, hi)
+
+    def _find_spans(self, t_points):
+        """
+        Knot spans of the points for every curve, knots[k, span] <= t < knots[k, span + 1].
+        Single 'searchsorted' in the packed knots, the rows (and their points) are shifted to disjoint ranges
+        [2k * width, (2k + 1) * width]. Rounding of the shift is monotone, so the points equal to a knot stay in
+        its span.
+        :param t_points: array K x N
+        :return: array K x N int
+        """
+        n_curves, n_knots = self.knots.shape
+        origin = self.knots[:, 0, None]
+        width = max(np.max(self.knots[:, -1] - self.knots[:, 0]), 1.0)
+        shift = np.arange(n_curves)[:, None] * 2 * width - origin
+        span = np.searchsorted((self.knots + shift).ravel(), (t_points + shift).ravel(), side='right')
+        return span.reshape(t_points.shape) - np.arange(n_curves)[:, None] * n_knots - 1
+
+    def eval_array(self, t_points):
+        """
+        Evaluate all curves in a batch of parameters.
+        :param t_points: array N, common parameters for all curves, or array K x N, parameters for every curve.
+        :return: array K x N x D
+        """
+        t_points = np.asarray(t_points, dtype=float)
+        n_curves = len(self)
+        if t_points.ndim == 1:
+            t_points = np.broadcast_to(t_points, (n_curves, len(t_points)))
+        assert t_points.shape[0] == n_curves
+        deg = self.degree
+        if self.basis is not None:
+            t_flat = self.basis.check_array(t_points.ravel())
+            i_base = self.basis.find_knot_interval_array(t_flat)
+            values = self.basis.eval_vector_array(i_base, t_flat).reshape(t_points.shape + (deg + 1,))
+            i_base = i_base.reshape(t_points.shape)
+        else:
+            t_points = self._check_array(t_points)
+            span = np.clip(self._find_spans(t_points), deg, self.n_poles[:, None] - 1)
+            # left[j] = t - knots[span + 1 - j],  right[j] = knots[span + j] - t;  in the flat packed knots
+            flat_span = (span + np.arange(n_curves)[:, None] * self.knots.shape[1]).ravel()
+            j_range = np.arange(deg + 1)[:, None]
+            flat_knots, t_flat = self.knots.ravel(), t_points.ravel()
+            left = t_flat - flat_knots[flat_span + 1 - j_range]
+            right = flat_knots[flat_span + j_range] - t_flat
+            values = _eval_ders_triangular(left, right, 0)[:, 0, :].reshape(t_points.shape + (deg + 1,))
+            i_base = span - deg
+
+        i_poles = i_base[:, :, None] + np.arange(deg + 1)
+        local_poles = self._weighted[np.arange(n_curves)[:, None, None], i_poles]
+        points = np.einsum('knj,knjd->knd', values, local_poles)
+        if self.rational:
+            return points[:, :, 0:self.dim] / points[:, :, self.dim:]
+        return points
+
+    def curve(self, k):
+        """
+        Single curve of the set, poles are not copied.
+        :param k: Index of the curve.
+        :return: Curve
+        """
+        n = self.n_poles[k]
+        basis = SplineBasis(self.degree, self.knots[k, :n + self.degree + 1])
+        return Curve(basis, self.poles[k, :n], self.rational)
+
+    def curves(self):
+        """
+        :return: List of all curves of the set, see 'curve'.
+        """
+        return [self.curve(k) for k in range(len(self))]
+
+
 class Surface:
     """
     Defines D-dim B-spline surface.
@@ -484,7 +1527,7 @@ class Surface:
         return cls((u_basis, v_basis), poles, rational)
 
 
-    def __init__(self, basis, poles, rational=False):
+    def __init__(self, basis, poles, rational=False, copy=True):
         """
         Construct a B-spline surface.
         :param poles: Numpy array Nu x Nv x (D+r) of poles (control points).
@@ -493,18 +1536,24 @@ class Surface:
             For rational case, poles[:, :, D] are weights of the control points.
         :param basis: (u_basis, v_basis) SplineBasis objects for U and V parameter axis.
         :param rational: True for rational B-spline, i.e. NURB. Use weighted poles.
+        :param copy: Copy the poles. Use False to keep a float array as is, e.g. a read-only memmap view
+            (see bspline_io.load), the caller must not modify it then.
         """
         self.basis = list(basis)
         # Surface basis for U and V axis.
 
-        self.poles = np.array(poles, dtype=float)
+        self.poles = np.array(poles, dtype=float) if copy else np.asarray(poles, dtype=float)
         self.dim = len(self.poles[0,0,:]) - rational
         # Surface dimension, D.
 
         # BIH tree
+        self._box_array = None
         self._boxes = None
         self._tree = None
+        self._patch_index = None
 
+        self._bezier = None
+        # Cached Bezier decomposition, see 'bezier_poles'.
 
         # Surface poles matrix: Nu x Nv x (D+r)
         assert self.poles.shape == (self.u_basis.size, self.v_basis.size, self.dim + rational)
@@ -513,8 +1562,8 @@ class Surface:
         # Rational surface indicator.
         if rational:
             # precomputations
-            self._weights = poles[:, :, self.dim]
-            self._poles = (poles[:, :, 0:self.dim].T * self._weights.T ).T
+            self._weights = self.poles[:, :, self.dim]
+            self._poles = (self.poles[:, :, 0:self.dim].T * self._weights.T ).T
 
     @property
     def u_basis(self):
@@ -570,14 +1619,323 @@ class Surface:
         poles = copy.copy(self.poles)
         return Surface( ( u_basis, v_basis), poles)
 
-    def eval_array(self, uv_points):
+    def eval_array(self, uv_points, n_workers=1, chunk_size=None):
         """
         Evaluate in array of uv-points.
         :param uv_points: numpy array N x [u, v]
+        :param n_workers, chunk_size: Large arrays are evaluated by chunks in parallel threads, see '_chunked_eval'.
         :return: Numpy array N x D; D is dimension of the curve.
         """
+        uv_points = np.asarray(uv_points, dtype=float)
         assert uv_points.shape[1] == 2
-        return np.array([self.eval(u, v) for u, v in uv_points])
+        return _chunked_eval(self._eval_array_chunk, uv_points, n_workers, chunk_size)
+
+    def _eval_array_chunk(self, uv_points):
+        u_points = self.u_basis.check_array(uv_points[:, 0])
+        v_points = self.v_basis.check_array(uv_points[:, 1])
+        iu = self.u_basis.find_knot_interval_array(u_points)
+        iv = self.v_basis.find_knot_interval_array(v_points)
+        u_base_vec = self.u_basis.eval_vector_array(iu, u_points)
+        v_base_vec = self.v_basis.eval_vector_array(iv, v_points)
+        # indices of the pole blocks of the nonzero basis functions, N x du x 1 and N x 1 x dv
+        i_u_poles = (iu[:, None] + np.arange(self.u_basis.degree + 1))[:, :, None]
+        i_v_poles = (iv[:, None] + np.arange(self.v_basis.degree + 1))[:, None, :]
+
+        if self.rational:
+            top_value = np.einsum('ni,nj,nijd->nd', u_base_vec, v_base_vec, self._poles[i_u_poles, i_v_poles, :])
+            bot_value = np.einsum('ni,nj,nij->n', u_base_vec, v_base_vec, self._weights[i_u_poles, i_v_poles])
+            return top_value / bot_value[:, None]
+        else:
+            return np.einsum('ni,nj,nijd->nd', u_base_vec, v_base_vec, self.poles[i_u_poles, i_v_poles, :])
+
+    def eval_derivs(self, uv_points, order=1):
+        """
+        Evaluate the surface and its partial derivatives in array of uv-points.
+        :param uv_points: numpy array N x [u, v]
+        :param order: Maximal order of derivatives in every parameter.
+        :return: Numpy array N x (order + 1) x (order + 1) x D;
+            [:, k, l, :] is the derivative of order k in U and of order l in V, [:, 0, 0, :] are the surface points.
+        """
+        uv_points = np.asarray(uv_points, dtype=float)
+        assert uv_points.shape[1] == 2
+        u_points = self.u_basis.check_array(uv_points[:, 0])
+        v_points = self.v_basis.check_array(uv_points[:, 1])
+        iu = self.u_basis.find_knot_interval_array(u_points)
+        iv = self.v_basis.find_knot_interval_array(v_points)
+        return self.eval_derivs_local(np.stack((u_points, v_points), axis=1), np.stack((iu, iv), axis=1), order)
+
+    def eval_derivs_local(self, uv_points, iuv_points, order=1):
+        """
+        Evaluate the surface and its partial derivatives for given knot subintervals.
+        Rational surfaces are differentiated by the quotient rule, see Piegl, Tiller: The NURBS Book, A4.4.
+        :param uv_points: numpy array N x [u, v]
+        :param iuv_points: numpy array N x [iu, iv], knot subintervals of the points.
+        :param order: Maximal order of derivatives in every parameter.
+        :return: Numpy array N x (order + 1) x (order + 1) x D.
+        """
+        iuv_points = np.asarray(iuv_points, dtype=int)
+        iu, iv = iuv_points[:, 0], iuv_points[:, 1]
+        u_ders = self.u_basis.eval_ders_vector_array(iu, uv_points[:, 0], order)
+        v_ders = self.v_basis.eval_ders_vector_array(iv, uv_points[:, 1], order)
+        i_u_poles = (iu[:, None] + np.arange(self.u_basis.degree + 1))[:, :, None]
+        i_v_poles = (iv[:, None] + np.arange(self.v_basis.degree + 1))[:, None, :]
+
+        # optimize: contract pairwise, the direct three operand sum is several times slower
+        if not self.rational:
+            return np.einsum('nki,nlj,nijd->nkld', u_ders, v_ders, self.poles[i_u_poles, i_v_poles, :], optimize=True)
+
+        a_ders = np.einsum('nki,nlj,nijd->nkld', u_ders, v_ders, self._poles[i_u_poles, i_v_poles, :], optimize=True)
+        w_ders = np.einsum('nki,nlj,nij->nkl', u_ders, v_ders, self._weights[i_u_poles, i_v_poles], optimize=True)
+        ders = np.empty_like(a_ders)
+        for k in range(order + 1):
+            for l in range(order + 1):
+                value = a_ders[:, k, l, :].copy()
+                for j in range(1, l + 1):
+                    value -= binom(l, j) * w_ders[:, 0, j, None] * ders[:, k, l - j, :]
+                for i in range(1, k + 1):
+                    value -= binom(k, i) * w_ders[:, i, 0, None] * ders[:, k - i, l, :]
+                    for j in range(1, l + 1):
+                        value -= binom(k, i) * binom(l, j) * w_ders[:, i, j, None] * ders[:, k - i, l - j, :]
+                ders[:, k, l, :] = value / w_ders[:, 0, 0, None]
+        return ders
+
+    def eval_normals(self, uv_points):
+        """
+        Unit normal vectors of a 3d surface, oriented as cross product of the U and V tangents.
+        :param uv_points: numpy array N x [u, v]
+        :return: Numpy array N x 3.
+        """
+        assert self.dim == 3
+        ders = self.eval_derivs(uv_points, 1)
+        normals = np.cross(ders[:, 1, 0, :], ders[:, 0, 1, :])
+        return normals / la.norm(normals, axis=1)[:, None]
+
+    def _weighted_poles(self):
+        """ Poles in homogeneous coordinates for the rational surface, plain poles otherwise. """
+        return _to_weighted(self.poles, self.dim) if self.rational else self.poles
+
+    def _make_from_weighted(self, basis, poles):
+        """ New surface from the (u_basis, v_basis) and poles in homogeneous coordinates. """
+        if self.rational:
+            poles = _from_weighted(poles, self.dim)
+        return Surface(basis, poles, self.rational)
+
+    def insert_knot(self, t, axis, mult=1):
+        """
+        Insert knot 't' 'mult' times into the U (axis=0) or V (axis=1) knot vector, the geometry is not changed.
+        :param t: New knot.
+        :param axis: 0 for U, 1 for V parameter.
+        :param mult: Number of insertions.
+        :return: New Surface.
+        """
+        knots = [[], []]
+        knots[axis] = [t] * mult
+        return self.refine(*knots)
+
+    def refine(self, u_knots=(), v_knots=()):
+        """
+        Insert all 'u_knots' and 'v_knots' at once, the geometry is not changed.
+        :param u_knots: Array of knots for U parameter, repeated knots are inserted repeatedly.
+        :param v_knots: Array of knots for V parameter.
+        :return: New Surface.
+        """
+        u_basis, poles = self.u_basis.refine_poles(self._weighted_poles(), u_knots, axis=0)
+        v_basis, poles = self.v_basis.refine_poles(poles, v_knots, axis=1)
+        return self._make_from_weighted((u_basis, v_basis), poles)
+
+    def split(self, t, axis):
+        """
+        Split the surface along the U (axis=0) or V (axis=1) isoline at parameter 't'.
+        :param t: Split point, interior of the parameter domain.
+        :param axis: 0 for U, 1 for V parameter.
+        :return: (Surface for parameters < t, Surface for parameters > t)
+        """
+        left, right = self.basis[axis].split_poles(self._weighted_poles(), t, axis)
+        parts = []
+        for basis, poles in [left, right]:
+            surf_basis = list(self.basis)
+            surf_basis[axis] = basis
+            parts.append(self._make_from_weighted(surf_basis, poles))
+        return tuple(parts)
+
+    def elevate_degree(self, u_times=0, v_times=0):
+        """
+        Raise degree of the surface, the geometry is not changed.
+        :param u_times: Degree increment for U parameter.
+        :param v_times: Degree increment for V parameter.
+        :return: New Surface.
+        """
+        u_basis, poles = self.u_basis.elevate_degree(self._weighted_poles(), u_times, axis=0)
+        v_basis, poles = self.v_basis.elevate_degree(poles, v_times, axis=1)
+        return self._make_from_weighted((u_basis, v_basis), poles)
+
+    def project_points(self, xyz_points, n_samples=4, max_it=30, tol=1e-12, max_candidates=4, chunk_size=None):
+        """
+        Closest point projection (point inversion) of many points at once.
+        Initial guesses are the local minima of the distance to the samples of the candidate patches,
+        found using 'patch_index'.
+        All candidates are then refined at once by the damped Newton method for the minimum
+        of the squared distance and the closest result is selected.
+        :param xyz_points: array N x D
+        :param n_samples: Number of samples per knot interval in U and V.
+        :param max_it: Maximal number of Newton iterations.
+        :param tol: Tolerance of the parameter update relative to the domain size.
+        :param max_candidates: Maximal number of candidate patches of a point, nearest by the box distance.
+        :param chunk_size: Number of points processed at once, see '_project_by_chunks'.
+        :return: (uv_points, distances, patch_ids); arrays N x 2, N x float, N x int
+        """
+        points = np.asarray(xyz_points, dtype=float).reshape(-1, self.dim)
+        n_u_int, n_v_int = self.u_basis.n_intervals, self.v_basis.n_intervals
+        u_samples = _interval_samples(self.u_basis, n_samples)
+        v_samples = _interval_samples(self.v_basis, n_samples)
+        # n_patches x n_samples x n_samples x D, ordered by patch ids
+        samples = self.eval_grid(u_samples.ravel(), v_samples.ravel())
+        samples = samples.reshape(n_u_int, n_samples, n_v_int, n_samples, self.dim).transpose(0, 2, 1, 3, 4)
+        samples = samples.reshape(n_u_int * n_v_int, n_samples, n_samples, self.dim)
+
+        def project_chunk(points):
+            i_points, i_patches, i_local = _closest_candidates(points, samples, self.patch_index, max_candidates)
+            iu, iv = np.divmod(i_patches, n_v_int)
+            uv_init = np.stack((u_samples[iu, i_local[:, 0]], v_samples[iv, i_local[:, 1]]), axis=1)
+            uv_points = self._project_newton(points[i_points], uv_init, max_it, tol)
+
+            dist = la.norm(self.eval_array(uv_points) - points[i_points], axis=1)
+            i_best = _select_closest(i_points, dist, len(points))
+            return uv_points[i_best], dist[i_best]
+
+        uv_points, dist = _project_by_chunks(project_chunk, points, n_u_int * n_v_int, chunk_size)
+        iu = self.u_basis.find_knot_interval_array(uv_points[:, 0])
+        iv = self.v_basis.find_knot_interval_array(uv_points[:, 1])
+        return uv_points, dist, self.patch_pos2id(iu, iv)
+
+    def _project_newton(self, points, uv_points, max_it, tol):
+        """
+        Batched damped Newton method for the closest points on the surface.
+        :param points: array N x D
+        :param uv_points: array N x 2, initial guess.
+        :return: array N x 2
+        """
+        bounds = np.array([self.u_basis.domain, self.v_basis.domain]).T
+        step_tol = tol * np.array([self.u_basis.domain_size, self.v_basis.domain_size])
+        uv_points = np.array(uv_points, dtype=float)
+        active = np.arange(len(points))
+        for i in range(max_it):
+            if len(active) == 0:
+                break
+            uv, p = uv_points[active], points[active]
+            ders = self.eval_derivs(uv, 2)
+            diff = ders[:, 0, 0, :] - p
+            s_u, s_v = ders[:, 1, 0, :], ders[:, 0, 1, :]
+            g_u, g_v = np.sum(s_u * diff, axis=1), np.sum(s_v * diff, axis=1)
+            # Hessian of the half squared distance [[a, b], [b, c]]
+            a = np.sum(s_u * s_u, axis=1) + np.sum(ders[:, 2, 0, :] * diff, axis=1)
+            b = np.sum(s_u * s_v, axis=1) + np.sum(ders[:, 1, 1, :] * diff, axis=1)
+            c = np.sum(s_v * s_v, axis=1) + np.sum(ders[:, 0, 2, :] * diff, axis=1)
+            # shift to positive definite matrix
+            min_eig = (a + c) / 2 - np.sqrt(((a - c) / 2) ** 2 + b ** 2)
+            eps = 1e-3 * (np.sum(s_u * s_u, axis=1) + np.sum(s_v * s_v, axis=1)) + 1e-300
+            shift = np.where(min_eig < eps, eps - min_eig, 0.0)
+            a, c = a + shift, c + shift
+            det = a * c - b * b
+            delta = -np.stack((c * g_u - b * g_v, a * g_v - b * g_u), axis=1) / det[:, None]
+            # minimize only along the boundary, if the descent direction points out of the domain
+            grad = np.stack((g_u, g_v), axis=1)
+            fixed = np.logical_or(np.logical_and(uv <= bounds[0], grad > 0), np.logical_and(uv >= bounds[1], grad < 0))
+            delta[fixed[:, 0], 1] = -g_v[fixed[:, 0]] / c[fixed[:, 0]]
+            delta[fixed[:, 1], 0] = -g_u[fixed[:, 1]] / a[fixed[:, 1]]
+            delta[fixed] = 0.0
+            uv_new = _damped_step(self.eval_array, p, uv, delta, bounds)
+            uv_points[active] = uv_new
+            active = active[np.any(np.abs(uv_new - uv) > step_tol, axis=1)]
+        return uv_points
+
+    def _get_bezier(self):
+        """
+        Bezier decomposition of the surface, computed on the first call by knot insertion in U and V.
+        :return: (poles, u_bounds, v_bounds, boxes)
+            poles - n_patches x (u_degree + 1) x (v_degree + 1) x (D + r), weighted poles of the Bezier patches,
+                    patches ordered by 'patch_pos2id'
+            u_bounds, v_bounds - n_intervals x 2, parameter ranges of the patches in U and V
+            boxes - n_patches x 2 x D, min and max corners of the patch control nets
+        """
+        if self._bezier is None:
+            # U direction: n_u_intervals x (u_degree + 1) x Nv x (D + r)
+            poles, u_bounds = self.u_basis._bezier_decomposition(self._weighted_poles())
+            # V direction: n_v_intervals x (v_degree + 1) x n_u_intervals x (u_degree + 1) x (D + r)
+            poles, v_bounds = self.v_basis._bezier_decomposition(poles.transpose(2, 0, 1, 3))
+            n_u_int, n_v_int = self.u_basis.n_intervals, self.v_basis.n_intervals
+            du, dv = self.u_basis.degree + 1, self.v_basis.degree + 1
+            bezier_poles = poles.transpose(2, 0, 3, 1, 4).reshape(n_u_int * n_v_int, du, dv, -1)
+
+            coords = bezier_poles[:, :, :, 0:self.dim]
+            if self.rational:
+                coords = coords / bezier_poles[:, :, :, self.dim:]
+            boxes = np.stack((np.amin(coords, axis=(1, 2)), np.amax(coords, axis=(1, 2))), axis=1)
+            self._bezier = (np.ascontiguousarray(bezier_poles), u_bounds, v_bounds, boxes)
+        return self._bezier
+
+    @property
+    def bezier_poles(self):
+        """
+        Poles of the Bezier patches, one patch per pair of knot intervals.
+        :return: Numpy array n_patches x (u_degree + 1) x (v_degree + 1) x (D + r), same convention as 'poles'.
+        """
+        bezier_poles = self._get_bezier()[0]
+        return _from_weighted(bezier_poles, self.dim) if self.rational else bezier_poles
+
+    @property
+    def bezier_boxes(self):
+        """
+        Bounding boxes of the Bezier patches, tighter than the boxes of the B-spline pole windows.
+        :return: Numpy array n_patches x 2 x D; [:, 0, :] min corners, [:, 1, :] max corners.
+        """
+        return self._get_bezier()[3]
+
+    def eval_bezier_local(self, uv_points, iuv_points):
+        """
+        Evaluate the surface using the Bezier decomposition, no knot lookup.
+        :param uv_points: numpy array N x [u, v]
+        :param iuv_points: numpy array N x [iu, iv], knot subintervals of the points.
+        :return: Numpy array N x D.
+        """
+        bezier_poles, u_bounds, v_bounds, _ = self._get_bezier()
+        uv_points = np.asarray(uv_points, dtype=float)
+        iuv_points = np.asarray(iuv_points, dtype=int)
+        iu, iv = iuv_points[:, 0], iuv_points[:, 1]
+        u_base_vec = _bernstein_array(self.u_basis.degree, u_bounds[iu], uv_points[:, 0])
+        v_base_vec = _bernstein_array(self.v_basis.degree, v_bounds[iv], uv_points[:, 1])
+        patch_poles = bezier_poles[self.patch_pos2id(iu, iv)]
+        values = np.einsum('ni,nj,nijd->nd', u_base_vec, v_base_vec, patch_poles)
+        if self.rational:
+            return values[:, 0:self.dim] / values[:, self.dim:]
+        return values
+
+    def eval_grid(self, u_points, v_points):
+        """
+        Evaluate on the tensor grid given by u_points x v_points.
+        Uses separable structure: B_u . P . B_v^T with sparse collocation matrices B_u, B_v.
+        :param u_points: array Nu x float
+        :param v_points: array Nv x float
+        :return: Numpy array Nu x Nv x D; D is dimension of the surface.
+        """
+        u_mat = self.u_basis.collocation_matrix(u_points)
+        v_mat = self.v_basis.collocation_matrix(v_points)
+        if self.rational:
+            poles = np.concatenate((self._poles, self._weights[:, :, None]), axis=2)
+        else:
+            poles = self.poles
+        n_u, n_v, n_d = poles.shape
+        n_u_points, n_v_points = u_mat.shape[0], v_mat.shape[0]
+
+        # B_u . P  ->  Nu x n_v x D
+        values = u_mat.dot(poles.reshape(n_u, n_v * n_d)).reshape(n_u_points, n_v, n_d)
+        # (B_u . P) . B_v^T  ->  Nu x Nv x D
+        values = v_mat.dot(values.transpose(1, 0, 2).reshape(n_v, n_u_points * n_d))
+        values = values.reshape(n_v_points, n_u_points, n_d).transpose(1, 0, 2)
+        if self.rational:
+            return values[:, :, 0:self.dim] / values[:, :, self.dim:]
+        else:
+            return values
 
     def aabb(self):
         """
@@ -588,43 +1946,44 @@ class Surface:
         return np.array( [np.amin(self.poles, axis=(0,1)), np.amax(self.poles, axis=(0,1))] )
 
 
-    def bounding_boxes(self):
+    @property
+    def box_array(self):
         """
-        Compute bounding boxes and construct BIH tree for a given surface
-        :param surf:
-        :return:
+        Bounding boxes of the pole windows of all patches, ordered by 'patch_pos2id'.
+        :return: Numpy array n_patches x 2 x D; [:, 0, :] min corners, [:, 1, :] max corners.
         """
-        tree = bih.BIH()
-        n_patch = self.u_basis.n_intervals * self.v_basis.n_intervals
-
-        patch_poles = np.zeros([9, 3, n_patch])
-        i_patch = 0
-        for iu in range(self.u_basis.n_intervals):
-            for iv in range(self.v_basis.n_intervals):
-                n_points = 0
-                for i in range(0, 3):
-                    for j in range(0, 3):
-                        patch_poles[n_points, :, i_patch] = self.poles[iu + i, iv + j, :]
-                        n_points += 1
-                assert i_patch == self.patch_pos2id(iu, iv)
-                i_patch += 1
+        if self._box_array is None:
+            window_shape = (self.u_basis.degree + 1, self.v_basis.degree + 1)
+            box_array = _window_boxes(self.poles[:, :, 0:self.dim], window_shape)
+            self._box_array = box_array.reshape(-1, 2, self.dim)
+        return self._box_array
 
-        boxes = [bih.AABB(patch_poles[:, :, p].tolist()) for p in range(n_patch)]
-        tree.add_boxes(boxes)
-        tree.construct()
+    @property
+    def patch_index(self):
+        """
+        Numpy lookup of the boxes in 'box_array', allows vectorized queries for many boxes.
+        :return: PatchIndex
+        """
+        if self._patch_index is None:
+            self._patch_index = PatchIndex(self.box_array)
+        return self._patch_index
 
-        self._tree = tree
-        self._boxes = boxes
+    def bounding_boxes(self):
+        """
+        Set bounding boxes and the box tree of the surface patches,
+        the tree is the PatchIndex with the same 'find_box', 'find_point' interface as the BIH tree.
+        """
+        self._tree, self._boxes = self.patch_index, self.box_array
 
     @property
     def boxes(self):
-        if self._boxes == None:
+        if self._boxes is None:
             self.bounding_boxes()
         return self._boxes
 
     @property
     def tree(self):
-        if self._tree == None:
+        if self._tree is None:
             self.bounding_boxes()
         return self._tree
 
@@ -827,11 +2186,9 @@ class Z_Surface:
 
     def _bilinear_uv_to_xy(self, uv_points):
         assert uv_points.shape[1] == 2, "Size: {}".format(uv_points.shape)
-        xy_list = []
-        for u,v in uv_points:
-            weights = np.array([ (1-u)*v, (1-u)*(1-v), u*(1-v), u*v ])
-            xy_list.append( self.quad.T.dot(weights) )
-        return np.array(xy_list)
+        u, v = uv_points[:, 0], uv_points[:, 1]
+        weights = np.stack([ (1-u)*v, (1-u)*(1-v), u*(1-v), u*v ], axis=1)
+        return np.dot(weights, self.quad)
 
     """
     def xy_to_uv(self, xy_points):
@@ -846,9 +2203,76 @@ class Z_Surface:
         return  np.dot((xy_points - self._xy_shift), self._mat_xy_to_uv.T)
 
 
-    def _bilinear_xy_to_uv(self, xy_points):
+    def _bilinear_xy_to_uv(self, xy_points, max_it=10):
+        """
+        Inverse of the bilinear map: xy = q1 + u * e + v * f + u * v * g.
+        Closed form solution of the quadratic equation for 'v', refined by few Newton iterations.
+        Newton iterations from the quad center are used where the closed form fails.
+        """
         assert xy_points.shape[1] == 2
-        assert False, "Not implemented yet."
+
+        def cross(a, b):
+            return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+        q0, q1, q2, q3 = self.quad
+        e, f, g = q2 - q1, q0 - q1, q3 - q2 - q0 + q1
+        h = xy_points - q1
+        scale = np.max(np.abs(self.quad - q1))
+
+        k2 = cross(g, f)
+        k1 = cross(e, f) + cross(h, g)
+        k0 = cross(h, e)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if abs(k2) < 1e-12 * scale * scale:
+                # trapezoid, linear equation for v
+                v_roots = (-k0 / k1)[:, None]
+            else:
+                w = np.sqrt(k1 * k1 - 4 * k0 * k2)
+                v_roots = np.stack([(-k1 - w) / (2 * k2), (-k1 + w) / (2 * k2)], axis=1)
+            # u from the better conditioned coordinate of: u * (e + v * g) = h - v * f
+            denom = e + v_roots[:, :, None] * g
+            numer = h[:, None, :] - v_roots[:, :, None] * f
+            i_coord = np.argmax(np.abs(denom), axis=2)[:, :, None]
+            u_roots = np.take_along_axis(numer, i_coord, axis=2)[:, :, 0] / np.take_along_axis(denom, i_coord, axis=2)[:, :, 0]
+
+        # select root closest to the unit square
+        uv_roots = np.stack([u_roots, v_roots], axis=2)
+        out_dist = np.max(np.maximum(-uv_roots, uv_roots - 1.0), axis=2)
+        out_dist[np.isnan(out_dist)] = np.inf
+        i_root = np.argmin(out_dist, axis=1)
+        uv_points = uv_roots[np.arange(len(i_root)), i_root, :]
+        failed = np.logical_not(np.all(np.isfinite(uv_points), axis=1))
+        uv_points[failed, :] = 0.5
+
+        # Newton refinement
+        tol = 1e-14 * scale
+        active = np.arange(len(uv_points))
+        for i in range(max_it):
+            u, v = uv_points[active, 0], uv_points[active, 1]
+            residual = q1 + u[:, None] * e + v[:, None] * f + (u * v)[:, None] * g - xy_points[active]
+            converged = np.max(np.abs(residual), axis=1) <= tol
+            active, residual, u, v = active[~converged], residual[~converged], u[~converged], v[~converged]
+            if len(active) == 0:
+                break
+            j_u = e + v[:, None] * g
+            j_v = f + u[:, None] * g
+            det = cross(j_u, j_v)
+            uv_points[active, 0] -= cross(residual, j_v) / det
+            uv_points[active, 1] -= cross(j_u, residual) / det
+        return uv_points
+
+    def uv_to_xy_jacobian(self, uv_points):
+        """
+        Jacobian matrices of the UV -> XY mapping, valid for both linear and bilinear case.
+        :param uv_points: numpy array N x [u, v]
+        :return: numpy array N x 2 x 2; [:, :, 0] derivatives by U, [:, :, 1] derivatives by V.
+        """
+        assert uv_points.shape[1] == 2
+        q0, q1, q2, q3 = self.quad
+        e, f, g = q2 - q1, q0 - q1, q3 - q2 - q0 + q1
+        j_u = e + uv_points[:, 1, None] * g
+        j_v = f + uv_points[:, 0, None] * g
+        return np.stack((j_u, j_v), axis=2)
 
 
     def eval(self, u, v):
@@ -864,14 +2288,18 @@ class Z_Surface:
         return np.array( [x, y, z] )
 
 
-    def eval_array(self, uv_points):
+    def eval_array(self, uv_points, n_workers=1, chunk_size=None):
         """
         Evaluate a B-spline surface in array of UV points.
         :param uv_points: numpy array N x [u, v]
+        :param n_workers, chunk_size: Large arrays are evaluated by chunks in parallel threads, see '_chunked_eval'.
         :return: array N x D; D - is dimension given by dimension of poles.
         """
         assert uv_points.shape[1] == 2
-        z_points = self.z_surface.eval_array(uv_points)
+        return _chunked_eval(self._eval_array_chunk, uv_points, n_workers, chunk_size)
+
+    def _eval_array_chunk(self, uv_points):
+        z_points = self.z_surface._eval_array_chunk(uv_points)
         if self._have_z_mat:
             z_points *= self._z_mat[0]
             z_points += self._z_mat[1]
@@ -880,6 +2308,24 @@ class Z_Surface:
         return np.concatenate( (xy_points, z_points), axis = 1)
 
 
+    def eval_grid(self, u_points, v_points):
+        """
+        Evaluate a B-spline surface on the tensor grid u_points x v_points.
+        :param u_points: array Nu x float
+        :param v_points: array Nv x float
+        :return: array Nu x Nv x 3
+        """
+        z_points = self.z_surface.eval_grid(u_points, v_points)
+        if self._have_z_mat:
+            z_points *= self._z_mat[0]
+            z_points += self._z_mat[1]
+
+        U, V = np.meshgrid(u_points, v_points, indexing='ij')
+        uv_points = np.stack([U.ravel(), V.ravel()], axis=1)
+        xy_points = self.uv_to_xy(uv_points).reshape(U.shape[0], U.shape[1], 2)
+        return np.concatenate( (xy_points, z_points), axis = 2)
+
+
     def eval_xy_array(self, xy_points):
         """
         Evaluate a B-spline surface in array of XY points.
@@ -931,6 +2377,450 @@ class Z_Surface:
 
 
 
+class SurfaceEvalPlan:
+    """
+    Evaluation of many surfaces with common basis in a fixed set of UV points.
+    Sparse collocation matrix B of the tensor product basis is precomputed, so that
+    evaluation of a surface is just a sparse-dense product B @ poles. Poles of several
+    surfaces are stacked to evaluate them all by a single product.
+    """
+
+    @classmethod
+    def make_xy(cls, z_surface, xy_points):
+        """
+        Plan for the evaluation in XY points mapped through the XY transform of given Z_Surface.
+        :param z_surface: Z_Surface object, provides basis and XY <-> UV mapping.
+        :param xy_points: numpy array N x [x, y]
+        :return: SurfaceEvalPlan object.
+        """
+        uv_points = z_surface.xy_to_uv(xy_points)
+        return cls((z_surface.u_basis, z_surface.v_basis), uv_points)
+
+    def __init__(self, basis, uv_points, derivatives=False):
+        """
+        Precompute the collocation matrix.
+        :param basis: (u_basis, v_basis) SplineBasis objects for U and V parameter axis.
+        :param uv_points: numpy array N x [u, v]
+        :param derivatives: Precompute also collocation matrices of the U and V derivatives.
+        """
+        self.basis = list(basis)
+        # Surface basis for U and V axis.
+
+        uv_points = np.asarray(uv_points, dtype=float)
+        assert uv_points.shape[1] == 2
+        self.n_points = uv_points.shape[0]
+        # Number of evaluation points.
+
+        u_basis, v_basis = self.basis
+        u_points = u_basis.check_array(uv_points[:, 0])
+        v_points = v_basis.check_array(uv_points[:, 1])
+        iu = u_basis.find_knot_interval_array(u_points)
+        iv = v_basis.find_knot_interval_array(v_points)
+        n_ders = 1 if derivatives else 0
+        u_ders = u_basis.eval_ders_vector_array(iu, u_points, n_ders)
+        v_ders = v_basis.eval_ders_vector_array(iv, v_points, n_ders)
+        i_u_poles = iu[:, None] + np.arange(u_basis.degree + 1)
+        i_v_poles = iv[:, None] + np.arange(v_basis.degree + 1)
+
+        # Row-wise Kronecker product, column index of the pole [iu, iv] is iu * Nv + iv.
+        n_loc = (u_basis.degree + 1) * (v_basis.degree + 1)
+        cols = (i_u_poles[:, :, None] * v_basis.size + i_v_poles[:, None, :]).ravel()
+        indptr = np.arange(0, self.n_points * n_loc + 1, n_loc)
+        shape = (self.n_points, u_basis.size * v_basis.size)
+
+        def tensor_matrix(u_base_vec, v_base_vec):
+            data = (u_base_vec[:, :, None] * v_base_vec[:, None, :]).ravel()
+            return scipy.sparse.csr_matrix((data, cols, indptr), shape=shape)
+
+        self.matrix = tensor_matrix(u_ders[:, 0, :], v_ders[:, 0, :])
+        # Collocation matrix N x (Nu * Nv).
+        self.diff_matrices = None
+        if derivatives:
+            self.diff_matrices = (tensor_matrix(u_ders[:, 1, :], v_ders[:, 0, :]),
+                                  tensor_matrix(u_ders[:, 0, :], v_ders[:, 1, :]))
+        # Collocation matrices of the U and V derivatives, N x (Nu * Nv).
+
+    @property
+    def u_basis(self):
+        return self.basis[0]
+
+    @property
+    def v_basis(self):
+        return self.basis[1]
+
+    def eval(self, poles):
+        """
+        Evaluate B @ poles.
+        :param poles: numpy array Nu x Nv x ... ; any trailing dimensions, e.g. D or (K, D) for K stacked surfaces.
+        :return: numpy array N x ...
+        """
+        poles = np.asarray(poles, dtype=float)
+        assert poles.shape[0:2] == (self.u_basis.size, self.v_basis.size)
+        values = self.matrix.dot(poles.reshape(self.matrix.shape[1], -1))
+        return values.reshape((self.n_points,) + poles.shape[2:])
+
+    def eval_diff(self, poles):
+        """
+        Evaluate U and V derivatives B_u @ poles, B_v @ poles. The plan must be created with 'derivatives=True'.
+        :param poles: numpy array Nu x Nv x ... ; see 'eval'.
+        :return: (u_ders, v_ders); numpy arrays N x ...
+        """
+        assert self.diff_matrices is not None, "Evaluation plan without derivatives."
+        poles = np.asarray(poles, dtype=float)
+        assert poles.shape[0:2] == (self.u_basis.size, self.v_basis.size)
+        flat_poles = poles.reshape(self.matrix.shape[1], -1)
+        return tuple(mat.dot(flat_poles).reshape((self.n_points,) + poles.shape[2:]) for mat in self.diff_matrices)
+
+    def has_basis(self, surface):
+        """
+        True if the surface has the same basis as the plan.
+        """
+        return all(plan_basis.degree == surf_basis.degree and np.array_equal(plan_basis.knots, surf_basis.knots)
+                   for plan_basis, surf_basis in zip(self.basis, (surface.u_basis, surface.v_basis)))
+
+    def _check_basis(self, surface):
+        assert self.has_basis(surface), "Surface basis differs from the basis of the evaluation plan."
+
+    def eval_surfaces(self, surfaces):
+        """
+        Evaluate several Surfaces with the basis of the plan by single sparse-dense product.
+        :param surfaces: List of K Surface objects of common dimension D.
+        :return: numpy array K x N x D
+        """
+        dim = surfaces[0].dim
+        any_rational = any(surf.rational for surf in surfaces)
+        stacked_poles = []
+        for surf in surfaces:
+            self._check_basis(surf)
+            assert surf.dim == dim
+            if surf.rational:
+                # homogeneous coordinates
+                stacked_poles.append(np.concatenate((surf._poles, surf._weights[:, :, None]), axis=2))
+            elif any_rational:
+                stacked_poles.append(np.concatenate((surf.poles, np.ones(surf.poles.shape[0:2] + (1,))), axis=2))
+            else:
+                stacked_poles.append(surf.poles)
+        values = self.eval(np.stack(stacked_poles, axis=2)).transpose(1, 0, 2)
+        if any_rational:
+            return values[:, :, 0:dim] / values[:, :, dim:]
+        else:
+            return values
+
+    def z_eval_surfaces(self, z_surfaces):
+        """
+        Evaluate Z coordinate of several Z_Surfaces with the basis of the plan by single sparse-dense product.
+        Z transforms of the surfaces are applied, XY transforms are ignored, the UV points are used.
+        :param z_surfaces: List of K Z_Surface objects.
+        :return: numpy array K x N
+        """
+        z_values = self.eval_surfaces([z_surf.z_surface for z_surf in z_surfaces])[:, :, 0]
+        for k, z_surf in enumerate(z_surfaces):
+            if z_surf._have_z_mat:
+                z_values[k] *= z_surf._z_mat[0]
+                z_values[k] += z_surf._z_mat[1]
+        return z_values
+
+
+def _points_in_polygon(points, polygon):
+    """
+    Vectorized point in polygon test, even-odd rule.
+    :param points: numpy array N x 2
+    :param polygon: numpy array M x 2, vertices of the polygon.
+    :return: bool array N
+    """
+    a = np.asarray(polygon, dtype=float)
+    b = np.roll(a, -1, axis=0)
+    x, y = points[:, 0, None], points[:, 1, None]
+    crossing = (a[:, 1] > y) != (b[:, 1] > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = a[:, 0] + (y - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+    return np.sum(np.logical_and(crossing, x < x_cross), axis=1) % 2 == 1
+
+
+def _clip_polygon(polygon, convex):
+    """
+    Clip a polygon by a convex polygon (Sutherland-Hodgman).
+    The result of a nonconvex polygon may contain degenerate edges along the boundary of the convex one,
+    which does not change the integrals over it.
+    :param polygon: numpy array M x 2, vertices of the clipped polygon.
+    :param convex: numpy array K x 2, vertices of the convex polygon, counterclockwise.
+    :return: numpy array L x 2, vertices of the intersection, same orientation as 'polygon'.
+    """
+    result = polygon
+    for a, b in zip(convex, np.roll(convex, -1, axis=0)):
+        if len(result) == 0:
+            break
+        normal = np.array([a[1] - b[1], b[0] - a[0]])
+        # Inner normal of the edge a -> b.
+        dist = (result - a) @ normal
+        next_points, next_dist = np.roll(result, -1, axis=0), np.roll(dist, -1)
+        inside = dist >= 0
+        crossing = inside != (next_dist >= 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(crossing, dist / (dist - next_dist), 0.0)
+        isec = result + t[:, None] * (next_points - result)
+        # Every edge p -> q contributes p if inside and the intersection if crossing.
+        points = np.stack((result, isec), axis=1).reshape(-1, 2)
+        result = points[np.stack((inside, crossing), axis=1).ravel()]
+    return result
+
+
+def _segments_cut_quads(a, b, quads):
+    """
+    Separating axis test of segments and convex quadrilaterals.
+    :param a, b: Segment end points, arrays N x 2.
+    :param quads: Counterclockwise vertices of the quadrilaterals, array N x 4 x 2.
+    :return: bool array N, True if the segment intersects the quadrilateral.
+    """
+    edges = np.roll(quads, -1, axis=1) - quads
+    axes = np.concatenate((edges, (b - a)[:, None, :]), axis=1)[:, :, ::-1] * [1, -1]
+    # Normals of the quadrilateral edges and of the segment.
+    quad_proj = np.einsum('nkd,nid->nki', axes, quads)
+    seg_proj = np.stack((np.einsum('nkd,nd->nk', axes, a), np.einsum('nkd,nd->nk', axes, b)), axis=2)
+    separated = np.logical_or(np.max(quad_proj, axis=2) < np.min(seg_proj, axis=2),
+                              np.max(seg_proj, axis=2) < np.min(quad_proj, axis=2))
+    return ~np.any(separated, axis=1)
+
+
+def _polygon_quadrature(polygon, gauss_points, gauss_weights):
+    """
+    Gauss quadrature over a polygon, collapsed tensor product rules on the triangles of a fan.
+    The fan triangles have signed areas, so the rule is valid for nonconvex polygons as well.
+    :param polygon: numpy array M x 2, counterclockwise vertices.
+    :param gauss_points, gauss_weights: Gauss-Legendre rule on [-1, 1].
+    :return: (points, weights); numpy arrays N x 2 and N
+    """
+    s, w = (gauss_points + 1) / 2, gauss_weights / 2
+    a, b, c = polygon[0], polygon[1:-1], polygon[2:]
+    ab, bc = b - a, c - b
+    double_area = ab[:, 0] * (c - a)[:, 1] - ab[:, 1] * (c - a)[:, 0]
+    s_grid, t_grid = np.meshgrid(s, s, indexing='ij')
+    # p = a + s (b - a) + s t (c - b), jacobian = s * 2 * area
+    points = a + s_grid[None, :, :, None] * ab[:, None, None, :] + (s_grid * t_grid)[None, :, :, None] * bc[:, None, None, :]
+    weights = double_area[:, None, None] * (s_grid * np.outer(w, w))[None, :, :]
+    return points.reshape(-1, 2), weights.ravel()
+
+
+class ZSurfaceQuadrature:
+    """
+    Gauss quadrature over the XY domain of Z_Surfaces, optionally restricted by a polygon mask.
+    Quadrature points are placed patch-wise and the basis functions are precomputed in the points (SurfaceEvalPlan),
+    so integrals of many surfaces with common basis and XY quad (e.g. stochastic realizations of the layer
+    interfaces) are evaluated by a single sparse-dense product. Other surfaces are evaluated in the XY points
+    of the quadrature.
+    All integral methods accept single Z_Surface (returning float) or list of K Z_Surfaces (returning array K).
+    """
+    def __init__(self, z_surface, order=None, polygon=None, n_sub=1):
+        """
+        Construct quadrature points and weights.
+        :param z_surface: Reference Z_Surface, provides the basis and the UV <-> XY mapping.
+        :param order: Number of Gauss points per patch and axis, default is (max degree + 1).
+        :param polygon: Optional mask, numpy array M x 2 of the polygon vertices in XY. Subpatches inside
+            the polygon keep their Gauss points, subpatches cut by the polygon boundary are clipped and
+            integrated by Gauss rules on the triangles of the clipped polygon (points are mapped back to UV).
+        :param n_sub: Every patch is split into n_sub x n_sub subpatches.
+        """
+        u_basis, v_basis = z_surface.u_basis, z_surface.v_basis
+        if order is None:
+            order = max(u_basis.degree, v_basis.degree) + 1
+        gauss_points, gauss_weights = np.polynomial.legendre.leggauss(order)
+
+        def axis_rule(basis):
+            i_begin, i_end = basis.knots_idx_range
+            breaks = np.unique(basis.knots[i_begin: i_end + 1])
+            sizes = np.repeat(np.diff(breaks) / n_sub, n_sub)
+            starts = np.repeat(breaks[:-1], n_sub) + np.tile(np.arange(n_sub), len(breaks) - 1) * sizes
+            t_points = starts[:, None] + sizes[:, None] * (gauss_points + 1) / 2
+            weights = sizes[:, None] * gauss_weights / 2
+            return t_points.ravel(), weights.ravel(), np.stack((starts, starts + sizes), axis=1)
+
+        u_points, u_weights, u_cells = axis_rule(u_basis)
+        v_points, v_weights, v_cells = axis_rule(v_basis)
+        uv_points = np.stack(np.meshgrid(u_points, v_points, indexing='ij'), axis=2).reshape(-1, 2)
+        uv_weights = np.outer(u_weights, v_weights).ravel()
+
+        xy_points = z_surface.uv_to_xy(uv_points)
+        jacobian = z_surface.uv_to_xy_jacobian(uv_points)
+        weights = uv_weights * np.abs(la.det(jacobian))
+        if polygon is not None:
+            uv_points, xy_points, jacobian, weights = self._clip_by_polygon(
+                z_surface, np.asarray(polygon, dtype=float), order, u_cells, v_cells,
+                uv_points, xy_points, jacobian, weights)
+
+        self.uv_points = uv_points
+        self.xy_points = xy_points
+        # Quadrature points.
+        self.weights = weights
+        # Quadrature weights in XY.
+        self.n_points = len(weights)
+        self.quad = np.array(z_surface.quad)
+        # XY quad of the reference surface.
+        self.plan = SurfaceEvalPlan((u_basis, v_basis), uv_points, derivatives=True)
+        # Precomputed basis functions and their derivatives in the quadrature points.
+        self._jac_inv = la.inv(jacobian)
+        # Inverse of the UV -> XY jacobian, N x 2 x 2.
+
+    @staticmethod
+    def _clip_by_polygon(z_surface, polygon, order, u_cells, v_cells, uv_points, xy_points, jacobian, weights):
+        """
+        Restrict the quadrature points to the polygon.
+        Subpatches not touched by the polygon edges (bounding box test) are either inside or outside as a whole,
+        the cut subpatches (XY quadrilaterals) are clipped and get the polygon quadrature of the intersection.
+        :param u_cells, v_cells: Bounds of the subpatches, arrays n_u x 2, n_v x 2.
+        :return: uv_points, xy_points, jacobian, weights
+        """
+        n_u, n_v = len(u_cells), len(v_cells)
+        i_u, i_v = np.meshgrid(np.arange(n_u), np.arange(n_v), indexing='ij')
+        i_u, i_v = i_u.ravel(), i_v.ravel()
+        uv_corners = np.stack((
+            np.stack((u_cells[i_u, 0], v_cells[i_v, 0]), axis=1), np.stack((u_cells[i_u, 1], v_cells[i_v, 0]), axis=1),
+            np.stack((u_cells[i_u, 1], v_cells[i_v, 1]), axis=1), np.stack((u_cells[i_u, 0], v_cells[i_v, 1]), axis=1)),
+            axis=1)
+        corners = z_surface.uv_to_xy(uv_corners.reshape(-1, 2)).reshape(-1, 4, 2)
+        diag_a, diag_b = corners[:, 2] - corners[:, 0], corners[:, 3] - corners[:, 1]
+        clockwise = diag_a[:, 0] * diag_b[:, 1] - diag_a[:, 1] * diag_b[:, 0] < 0
+        corners[clockwise] = corners[clockwise, ::-1]
+
+        edge_a, edge_b = polygon, np.roll(polygon, -1, axis=0)
+        edge_min, edge_max = np.minimum(edge_a, edge_b), np.maximum(edge_a, edge_b)
+        cell_min, cell_max = np.min(corners, axis=1), np.max(corners, axis=1)
+        i_cell, i_edge = np.nonzero(np.all(np.logical_and(cell_min[:, None, :] <= edge_max[None, :, :],
+                                                          edge_min[None, :, :] <= cell_max[:, None, :]), axis=2))
+        touch = _segments_cut_quads(edge_a[i_edge], edge_b[i_edge], corners[i_cell])
+        cut = np.zeros(len(corners), dtype=bool)
+        cut[i_cell[touch]] = True
+        inside = np.logical_and(~cut, _points_in_polygon(np.mean(corners, axis=1), polygon))
+
+        point_u, point_v = np.divmod(np.arange(len(uv_points)), n_v * order)
+        point_cell = (point_u // order) * n_v + point_v // order
+        keep = inside[point_cell]
+        uv_points, xy_points, jacobian, weights = uv_points[keep], xy_points[keep], jacobian[keep], weights[keep]
+
+        gauss_points, gauss_weights = np.polynomial.legendre.leggauss(order)
+        orientation = np.sign(np.sum(edge_a[:, 0] * edge_b[:, 1] - edge_a[:, 1] * edge_b[:, 0]))
+        cut_xy, cut_weights, cut_cells = [], [], []
+        for i_cell in np.flatnonzero(cut):
+            clipped = _clip_polygon(polygon, corners[i_cell])
+            if len(clipped) < 3:
+                continue
+            points, cell_weights = _polygon_quadrature(clipped, gauss_points, gauss_weights)
+            cut_xy.append(points)
+            cut_weights.append(orientation * cell_weights)
+            cut_cells.append(np.full(len(points), i_cell))
+        if not cut_xy:
+            return uv_points, xy_points, jacobian, weights
+
+        cut_xy, cut_weights, cut_cells = np.concatenate(cut_xy), np.concatenate(cut_weights), np.concatenate(cut_cells)
+        cut_uv = z_surface.xy_to_uv(cut_xy)
+        # keep the points in their subpatch despite the rounding
+        cut_uv[:, 0] = np.clip(cut_uv[:, 0], u_cells[i_u[cut_cells], 0], u_cells[i_u[cut_cells], 1])
+        cut_uv[:, 1] = np.clip(cut_uv[:, 1], v_cells[i_v[cut_cells], 0], v_cells[i_v[cut_cells], 1])
+        return (np.concatenate((uv_points, cut_uv)), np.concatenate((xy_points, cut_xy)),
+                np.concatenate((jacobian, z_surface.uv_to_xy_jacobian(cut_uv))),
+                np.concatenate((weights, cut_weights)))
+
+    @staticmethod
+    def _as_list(z_surfaces):
+        if isinstance(z_surfaces, Z_Surface):
+            return [z_surfaces], True
+        return list(z_surfaces), False
+
+    def _use_plan(self, z_surf):
+        return self.plan.has_basis(z_surf) and np.allclose(z_surf.quad, self.quad)
+
+    def area(self):
+        """
+        Area of the XY domain (intersected with the polygon mask).
+        """
+        return np.sum(self.weights)
+
+    def integrate(self, values):
+        """
+        Integrate values given in the quadrature points.
+        :param values: numpy array N or K x N
+        :return: float or array K
+        """
+        return np.dot(values, self.weights)
+
+    def z_values(self, z_surfaces):
+        """
+        Z coordinates of the surfaces in the quadrature points.
+        :param z_surfaces: List of K Z_Surface objects.
+        :return: numpy array K x N
+        """
+        z_values = np.empty((len(z_surfaces), self.n_points))
+        i_plan = [k for k, z_surf in enumerate(z_surfaces) if self._use_plan(z_surf)]
+        if i_plan:
+            z_values[i_plan] = self.plan.z_eval_surfaces([z_surfaces[k] for k in i_plan])
+        for k, z_surf in enumerate(z_surfaces):
+            if k not in i_plan:
+                z_values[k] = z_surf.z_eval_xy_array(self.xy_points)
+        return z_values
+
+    def z_gradients(self, z_surfaces):
+        """
+        XY gradients of Z coordinates of the surfaces in the quadrature points.
+        :param z_surfaces: List of K Z_Surface objects.
+        :return: numpy array K x N x 2
+        """
+        gradients = np.empty((len(z_surfaces), self.n_points, 2))
+        i_plan = [k for k, z_surf in enumerate(z_surfaces)
+                  if self._use_plan(z_surf) and not z_surf.z_surface.rational]
+        if i_plan:
+            poles = np.stack([z_surfaces[k].z_surface.poles[:, :, 0] for k in i_plan], axis=2)
+            z_scale = np.array([z_surfaces[k]._z_mat[0] for k in i_plan])
+            u_ders, v_ders = self.plan.eval_diff(poles)
+            uv_grad = np.stack((u_ders.T, v_ders.T), axis=2) * z_scale[:, None, None]
+            # grad_xy = J^{-T} grad_uv
+            gradients[i_plan] = np.einsum('nji,knj->kni', self._jac_inv, uv_grad)
+        for k, z_surf in enumerate(z_surfaces):
+            if k not in i_plan:
+                uv_points = z_surf.xy_to_uv(self.xy_points)
+                derivs = z_surf.z_surface.eval_derivs(uv_points, order=1)
+                uv_grad = np.stack((derivs[:, 1, 0, 0], derivs[:, 0, 1, 0]), axis=1) * z_surf._z_mat[0]
+                jac_inv = la.inv(z_surf.uv_to_xy_jacobian(uv_points))
+                gradients[k] = np.einsum('nji,nj->ni', jac_inv, uv_grad)
+        return gradients
+
+    def z_integral(self, z_surfaces):
+        """
+        Integral of Z over the XY domain.
+        :param z_surfaces: Z_Surface or list of K Z_Surfaces.
+        :return: float or numpy array K
+        """
+        z_surfaces, single = self._as_list(z_surfaces)
+        result = self.integrate(self.z_values(z_surfaces))
+        return result[0] if single else result
+
+    def surface_area(self, z_surfaces):
+        """
+        Area of the surfaces over the XY domain, integral of sqrt(1 + |grad z|^2).
+        :param z_surfaces: Z_Surface or list of K Z_Surfaces.
+        :return: float or numpy array K
+        """
+        z_surfaces, single = self._as_list(z_surfaces)
+        gradients = self.z_gradients(z_surfaces)
+        result = self.integrate(np.sqrt(1.0 + np.sum(gradients ** 2, axis=2)))
+        return result[0] if single else result
+
+    def volume(self, top, bottom, clip=True):
+        """
+        Volume between two surfaces over the XY domain.
+        :param top: Z_Surface or list of K Z_Surfaces.
+        :param bottom: Z_Surface or list of K Z_Surfaces, single surface is used for all top surfaces.
+        :param clip: Use only positive thickness (top - bottom), i.e. crossing layers have zero volume.
+            Integral of the signed thickness is computed for clip=False.
+        :return: float or numpy array K
+        """
+        top, single = self._as_list(top)
+        bottom, single_bottom = self._as_list(bottom)
+        thickness = self.z_values(top) - self.z_values(bottom)
+        if clip:
+            thickness = np.maximum(thickness, 0.0)
+        result = self.integrate(thickness)
+        return result[0] if single and single_bottom else result
+
+
 class GridNotInShapeExc(Exception):
     pass
 
@@ -1003,16 +2893,19 @@ class GridSurface:
         vtx_00 = xy_points[0, 0:2]
         vtx_dv = xy_points[1, 0:2]
 
-        # detect grid shape
+        # detect grid shape, search for the first step different from v_step in blocks
         v_step = vtx_dv - vtx_00
         step_tolerance = self.tolerance * la.norm(v_step, np.inf)
-        for i in range(2, n_points):
-            step = xy_points[i,:] - xy_points[i - 1, :]
-            if la.norm(v_step - step, np.inf) > step_tolerance:
+        block_size = 4096
+        for i_begin in range(1, n_points - 1, block_size):
+            i_end = min(i_begin + block_size + 1, n_points)
+            steps = xy_points[i_begin + 1: i_end, :] - xy_points[i_begin: i_end - 1, :]
+            row_end = la.norm(v_step - steps, np.inf, axis=1) > step_tolerance
+            if np.any(row_end):
                 break
         else:
             raise GridNotInShapeExc("End of the first row not detected.")
-        nv = i
+        nv = i_begin + 1 + np.argmax(row_end)
         nu = int(n_points / nv)
         if not n_points == nu * nv:
             raise GridNotInShapeExc("Not a Nu x Nv grid.")
@@ -1039,15 +2932,20 @@ class GridSurface:
     def _check_grid_regularity(self, points_xy):
         # check regularity of the grid
         nu, nv = self.shape
-        for i in range(nu * nv):
-            pred_y = i - 1
-            pred_x = i - nv
-            if i%nv == 0:
-                pred_y = -1
-            if pred_x > 0 and not la.norm(points_xy[i, :] - points_xy[pred_x, :] - self._u_step) < self._point_tol:
-                raise IrregularGridExc("Irregular grid in X direction, point %d"%i)
-            if pred_y > 0 and not la.norm(points_xy[i, :] - points_xy[pred_y, :] - self._v_step) < self._point_tol:
-                raise IrregularGridExc("Irregular grid in Y direction, point %d"%i)
+        grid_xy = points_xy.reshape(nu, nv, 2)
+        # Index of the first irregular point in X and Y direction, nu * nv if there is none.
+        irregular_x = np.logical_not(la.norm(grid_xy[1:, :, :] - grid_xy[:-1, :, :] - self._u_step, axis=2) < self._point_tol)
+        i_x = np.argmax(irregular_x) + nv if np.any(irregular_x) else nu * nv
+        irregular_y = np.logical_not(la.norm(grid_xy[:, 1:, :] - grid_xy[:, :-1, :] - self._v_step, axis=2) < self._point_tol)
+        if np.any(irregular_y):
+            iu, iv = np.unravel_index(np.argmax(irregular_y), irregular_y.shape)
+            i_y = iu * nv + iv + 1
+        else:
+            i_y = nu * nv
+        if i_x < nu * nv and i_x <= i_y:
+            raise IrregularGridExc("Irregular grid in X direction, point %d"%i_x)
+        if i_y < nu * nv:
+            raise IrregularGridExc("Irregular grid in Y direction, point %d"%i_y)
 
     def _make_z_surface(self, points):
         nu, nv = self.shape
@@ -1145,19 +3043,16 @@ class GridSurface:
 
         assert uv_points.shape[1] == 2
 
-        result = np.zeros(uv_points.shape[0])
-        for i, uv in enumerate(uv_points):
-            iuv = np.floor(uv / self._uv_step)
-            iu = max(0, min(self.shape[0] - 2, int(iuv[0])))
-            iv = max(0, min(self.shape[1] - 2, int(iuv[1])))
-            iuv = np.array([iu, iv])
-
-            uv_loc = uv / self._uv_step - iuv
-            u_loc = np.array([1 - uv_loc[0], uv_loc[0]])
-            v_loc = np.array([1 - uv_loc[1], uv_loc[1]])
-            Z_mat = self.grid_uvz[iu: (iu + 2), iv: (iv + 2), 2]
-            result[i] = self.z_surface.z_mat[0]*(u_loc.dot(Z_mat).dot(v_loc)) + self.z_surface.z_mat[1]
-        return result
+        uv_grid = uv_points / np.array(self._uv_step)
+        iu = np.clip(np.floor(uv_grid[:, 0]), 0, self.shape[0] - 2).astype(int)
+        iv = np.clip(np.floor(uv_grid[:, 1]), 0, self.shape[1] - 2).astype(int)
+        u_loc = uv_grid[:, 0] - iu
+        v_loc = uv_grid[:, 1] - iv
+
+        z_grid = self.grid_uvz[:, :, 2]
+        z_values = (1 - u_loc) * ((1 - v_loc) * z_grid[iu, iv] + v_loc * z_grid[iu, iv + 1]) \
+                   + u_loc * ((1 - v_loc) * z_grid[iu + 1, iv] + v_loc * z_grid[iu + 1, iv + 1])
+        return self.z_surface.z_mat[0] * z_values + self.z_surface.z_mat[1]
 
 
     def center(self):
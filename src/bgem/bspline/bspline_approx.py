@@ -2,8 +2,14 @@
 Collection of functions to produce Bspline curves and surfaces as approximation of various analytical curves and surfaces.
 """
 
+import os
+import re
+import inspect
+import tempfile
+import warnings
 import logging
 import time
+import concurrent.futures
 #import math
 
 import numpy as np
@@ -13,7 +19,14 @@ import scipy.sparse.linalg
 import scipy.interpolate
 
 from bgem.bspline import bspline as bs
-import csv
+try:
+    import pyamg
+except ImportError:
+    # The 'amg' preconditioner of SurfaceApprox is not available.
+    pyamg = None
+
+_CG_TOL_ARG = 'rtol' if 'rtol' in inspect.signature(scipy.sparse.linalg.cg).parameters else 'tol'
+# Relative tolerance of scipy.sparse.linalg.cg, 'rtol' since SciPy 1.12, 'tol' before.
 
 #logging.basicConfig(level=logging.DEBUG)
 #logging.info("Test info mesg.")
@@ -136,6 +149,14 @@ def curve_from_grid(points, **kwargs):
 
 
 def convex_hull_2d(sample):
+    """
+    Convex hull of the 2D points (quickhull).
+    Points closer to a hull edge than the round-off tolerance (relative 8 eps) are not taken as outer,
+    so points on the edges (e.g. repeated or collinear hull points when the hulls of chunks are merged)
+    are dropped instead of recursing without end.
+    :param sample: Nx2 numpy array of points
+    :return: Mx2 numpy array, vertices of the hull, the first vertex is repeated at the end.
+    """
     link = lambda a, b: np.concatenate((a, b[1:]))
     edge = lambda a, b: np.concatenate(([a], [b]))
 
@@ -151,8 +172,10 @@ def convex_hull_2d(sample):
         normal = np.dot(((0,-1),(1,0)),(t-h))
         # Distances from the line.
         dists = np.dot(sample-h, normal)
+        # Round-off tolerance, avoids infinite recursion for points on the line (e.g. the end point t).
+        tol = 8 * np.finfo(float).eps * la.norm(normal) * np.max(np.abs(sample - h))
 
-        outer = np.repeat(sample, dists>0, 0)
+        outer = np.repeat(sample, dists>tol, 0)
         if len(outer):
             pivot = sample[np.argmax(dists)]
             return link(dome(outer, edge(h, pivot)),
@@ -251,18 +274,21 @@ class SurfaceApprox:
     """
 
     @staticmethod
-    def approx_from_file(filename):
+    def approx_from_file(filename, chunk_size=None):
         """
         Load a sequence of XYZ points on a surface to be approximated.
         Optionally points may have weights (i.e. four values per line: XYZW)
         :param filename: Path to the input text file.
+        :param chunk_size: If given, the file is not loaded, the points are read by chunks of given size
+            during the approximation, see SurfaceApproxStream.
         :return: The approximation object.
         """
-        with open(filename, 'r') as f:
-            point_seq = np.array([l for l in csv.reader(f, delimiter=' ')], dtype=float)
-
+        if chunk_size is not None:
+            return SurfaceApproxStream.from_file(filename, chunk_size)
         # too slow: alternatives: loadtxt (16s), csv.reader (1.6s), pandas. read_csv (0.6s)
-        #point_seq = np.loadtxt(filename)
+        # load_points parses by blocks through np.fromstring (C parser, about 5x faster than csv.reader)
+        # and caches the result in the binary sidecar file
+        point_seq = load_points(filename)
         return SurfaceApprox(point_seq)
 
 
@@ -296,18 +322,7 @@ class SurfaceApprox:
         # Degree of approximation in U anv V directions, fixed to 2.
         self._degree = np.array((2, 2))
 
-
-        assert( points.shape[1] >= 3 )
-        # XYZ points
-        self._n_points = points.shape[0]
-        self._xy_points = points[:, 0:2]
-        self._z_points = points[:, 2]
-
-        # point weights
-        if points.shape[1] > 3:
-            self._weights = points[:, 3]
-        else:
-            self._weights = None
+        self._set_points(points)
 
         ## Approximation parameters.
 
@@ -323,14 +338,59 @@ class SurfaceApprox:
         # Weight of the regularizing term.
         self.regularization_weight = 0.001
 
+        # Number of processes assembling the system of normal equations, see '_build_system_parallel'.
+        self.n_workers = 1
+
+        # Solver of the regularized system: 'direct' (spsolve) or 'cg' (preconditioned conjugate gradients).
+        self.solver = 'direct'
+
+        # Preconditioner of the 'cg' solver: 'jacobi', 'ilu' (incomplete LU), 'amg' (needs pyamg).
+        self.preconditioner = 'jacobi'
+
+        # Relative tolerance of the 'cg' solver.
+        self.solver_tol = 1e-10
+
+        # Initial guess of the 'cg' solver, e.g. a coarser approximation of the same points.
+        # If None, the previous result of the object is used, see '_initial_z_vec'.
+        self.initial_surface = None
+
         ## Approximation results
 
         # Approximationg BSSurface
         self.surface = None
 
-        # Error of the approximation
+        # Error of the approximation, max norm
         self.error = None
 
+        # Errors (approximation - z) in the points inside the quad, same order as self._uv_quad_points.
+        self.point_errors = None
+
+        # Max norm of the errors on the patches, array nu x nv.
+        self.patch_errors = None
+
+        # Number of iterations of the 'cg' solver.
+        self.solver_iterations = None
+
+        # Poles of the last approximation, warm start of the 'cg' solver.
+        self._z_vec = None
+
+    def _set_points(self, points):
+        """
+        Set the input points.
+        :param points: Nx3 (XYZ) or Nx4 (XYZW - points with weights)
+        """
+        assert( points.shape[1] >= 3 )
+        # XYZ points
+        self._n_points = points.shape[0]
+        self._xy_points = points[:, 0:2]
+        self._z_points = points[:, 2]
+
+        # point weights
+        if points.shape[1] > 3:
+            self._weights = points[:, 3]
+        else:
+            self._weights = None
+
     def set_quad(self, quad = None):
         if quad is None:
             quad = np.array([[0,1], [0,0], [1,0], [1,1]])
@@ -371,9 +431,8 @@ class SurfaceApprox:
         """
         if self.quad is None:
             self.quad = self.compute_default_quad()
-        self._compute_uv_points()
 
-        nuv = self._compute_default_nuv(len(self._z_quad_points))
+        nuv = self._compute_default_nuv(self._count_quad_points())
         self.nuv = nuv.astype(int)
         if self.nuv[0] < 1 or self.nuv[1] < 1:
             raise Exception("Two few points, {}, to make approximation, degree: {}".format(self._n_points, self._degree))
@@ -386,12 +445,24 @@ class SurfaceApprox:
         :param quad: [(x1,y1), .. , (x4,y4)] Set vertices of different quad for the point set.
         :param nuv: (nu, nv) Set number of intervals of the resulting B-spline, in U and V direction
         :param regularization_wight: Default 0.001, is scaled by the max singular value of B.
+        :param n_workers: Default 1, number of processes assembling the system of normal equations.
+        :param solver: Default 'direct', or 'cg' - iterative solver, see 'preconditioner'.
+        :param preconditioner: Preconditioner of the 'cg' solver: 'jacobi' (default), 'ilu' (incomplete LU,
+            scipy spilu) or 'amg' (smoothed aggregation multigrid), 'amg' requires the optional pyamg package,
+            ImportError is raised if it is not installed.
+        :param solver_tol: Default 1e-10, relative tolerance of the 'cg' solver.
+        :param initial_surface: Initial guess of the 'cg' solver, default is the previous result.
         :return: B-Spline surface
         """
 
         self.quad = kwargs.get("quad", self.quad)
         self.nuv = kwargs.get("nuv", self.nuv)
         self.regularization_weight = kwargs.get("regularization_weight", self.regularization_weight)
+        self.n_workers = kwargs.get("n_workers", self.n_workers)
+        self.solver = kwargs.get("solver", self.solver)
+        self.preconditioner = kwargs.get("preconditioner", self.preconditioner)
+        self.solver_tol = kwargs.get("solver_tol", self.solver_tol)
+        self.initial_surface = kwargs.get("initial_surface", self.initial_surface)
 
         logging.info('Transforming points (n={}) ...'.format(self._n_points))
         start_time = time.time()
@@ -438,18 +509,9 @@ class SurfaceApprox:
 
         logging.info('Solving for Z coordinates ...')
         start_time = time.time()
-        z_vec = scipy.sparse.linalg.spsolve(c_mat, btwb_vec)
+        z_vec = self._solve(c_mat, btwb_vec)
         assert not np.isnan(np.sum(z_vec)), "Singular matrix for approximation."
-        end_time = time.time()
-        logging.info('Computed in: {} s'.format(end_time - start_time))
-
-        logging.info('Computing error ...')
-        start_time = time.time()
-
-        diff = self._compute_errors(point_loc, z_vec)
-
-        self.error = max_diff = np.max(diff)
-        logging.info("Approximation error (max norm): {}".format(max_diff))
+        self._z_vec = z_vec
         end_time = time.time()
         logging.info('Computed in: {} s'.format(end_time - start_time))
 
@@ -460,9 +522,88 @@ class SurfaceApprox:
         surface_z = bs.Surface((self._u_basis, self._v_basis), poles_z[:, :, None])
         self.surface = bs.Z_Surface(self.quad[0:3], surface_z)
 
+        logging.info('Computing error ...')
+        start_time = time.time()
+
+        self._set_errors(surface_z, point_loc)
+        logging.info("Approximation error (max norm): {}".format(self.error))
+        end_time = time.time()
+        logging.info('Computed in: {} s'.format(end_time - start_time))
+
         return self.surface
 
 
+    def _solve(self, c_mat, rhs):
+        """
+        Solve the regularized system (SPD) by the selected solver.
+        :param c_mat: Sparse matrix of the system.
+        :param rhs: Right hand side.
+        :return: z_vec, poles of the approximation
+        """
+        if self.solver == 'direct':
+            return scipy.sparse.linalg.spsolve(c_mat, rhs)
+        if self.solver != 'cg':
+            raise Exception("Unknown solver: {}".format(self.solver))
+
+        iterations = [0]
+        def count(xk):
+            iterations[0] += 1
+
+        tol_args = {_CG_TOL_ARG: self.solver_tol, 'atol': 0.0}
+        z_vec, info = scipy.sparse.linalg.cg(c_mat, rhs, x0=self._initial_z_vec(), maxiter=10 * len(rhs),
+                                             M=self._preconditioner(c_mat), callback=count, **tol_args)
+        self.solver_iterations = iterations[0]
+        logging.info("CG iterations: {}".format(self.solver_iterations))
+        if info > 0:
+            logging.warning("CG not converged in {} iterations.".format(info))
+        return z_vec
+
+    def _preconditioner(self, c_mat):
+        """
+        Preconditioner of the 'cg' solver given by self.preconditioner.
+        :param c_mat: Sparse matrix of the system.
+        :return: LinearOperator approximating inverse of c_mat
+        """
+        shape = c_mat.shape
+        if self.preconditioner == 'jacobi':
+            inv_diag = 1.0 / c_mat.diagonal()
+            return scipy.sparse.linalg.LinearOperator(shape, matvec=lambda x: inv_diag * x)
+        elif self.preconditioner == 'ilu':
+            ilu = scipy.sparse.linalg.spilu(c_mat.tocsc(), drop_tol=1e-5, fill_factor=4)
+            return scipy.sparse.linalg.LinearOperator(shape, matvec=ilu.solve)
+        elif self.preconditioner == 'amg':
+            if pyamg is None:
+                raise ImportError("Preconditioner 'amg' requires the pyamg package.")
+            return pyamg.smoothed_aggregation_solver(c_mat.tocsr()).aspreconditioner(cycle='V')
+        raise Exception("Unknown preconditioner: {}".format(self.preconditioner))
+
+    def _initial_z_vec(self):
+        """
+        Initial guess of the 'cg' solver.
+        Use poles of the previous approximation if the number of poles is the same, otherwise
+        evaluate self.initial_surface or the previous surface in the Greville points of the actual basis
+        and use the values as poles (no interpolation system is solved).
+        :return: array of poles, or None (zero initial guess)
+        """
+        n_poles = self._u_basis.size * self._v_basis.size
+        surface = self.initial_surface
+        if surface is None:
+            if self._z_vec is not None and len(self._z_vec) == n_poles:
+                return self._z_vec
+            surface = self.surface
+        if surface is None:
+            return None
+
+        u_coord = np.array(self._u_basis.make_linear_poles())
+        v_coord = np.array(self._v_basis.make_linear_poles())
+        U, V = np.meshgrid(u_coord, v_coord)
+        uv_points = np.stack([U.ravel(), V.ravel()], axis=1)
+        u_vec = self.quad[2, :] - self.quad[1, :]
+        v_vec = self.quad[0, :] - self.quad[1, :]
+        xy_points = self.quad[1, :] + np.outer(uv_points[:, 0], u_vec) + np.outer(uv_points[:, 1], v_vec)
+        surf_uv = np.clip(surface.xy_to_uv(xy_points), 0.0, 1.0)
+        return surface.z_eval_array(surf_uv)
+
     def _compute_default_nuv(self, n_points):
         """
         Default nu and nv for given number of points inside of quad.
@@ -483,18 +624,26 @@ class SurfaceApprox:
 
 
 
-    def _compute_uv_points(self):
+    def _count_quad_points(self):
         """
-        Map XY points to quad, remove points out of quad.
-        Results: self._uv_quad_points, self._z_quad_points, self._w_quad_points
-        :return:
+        Number of the input points inside of the quad.
+        """
+        self._compute_uv_points()
+        return len(self._z_quad_points)
+
+    def _xy_to_quad_uv(self, xy_points):
+        """
+        Map XY points to quad, snap points close to the quad boundary.
+        :param xy_points: array N x 2
+        :return: (points_uv, in_idx); UV coordinates of the points inside of the quad,
+            in_idx - bool mask of these points.
         """
         xy_shift = self.quad[1, :]
         v_vec = self.quad[0, :] - self.quad[1, :]
         u_vec = self.quad[2, :] - self.quad[1, :]
         mat_uv_to_xy = np.column_stack((u_vec, v_vec))
         mat_xy_to_uv = la.inv(mat_uv_to_xy)
-        points_uv = np.dot((self._xy_points - xy_shift), mat_xy_to_uv.T)
+        points_uv = np.dot((xy_points - xy_shift), mat_xy_to_uv.T)
 
         # remove points far from unit square
         eps = 1.0e-15
@@ -503,129 +652,216 @@ class SurfaceApprox:
         in_idx = np.all(np.logical_and(cut_min < points_uv,  points_uv <= cut_max), axis=1)
         points_uv = points_uv[in_idx]
 
-        logging.debug("Number of points out of the grid domain: {}".format(len(points_uv) - np.sum(in_idx)))
+        logging.debug("Number of points out of the grid domain: {}".format(len(in_idx) - np.sum(in_idx)))
 
         # snap to unit square
         points_uv = np.maximum(points_uv, np.array([0.0, 0.0]))
-        self._uv_quad_points = np.minimum(points_uv, np.array([1.0, 1.0]))
+        return np.minimum(points_uv, np.array([1.0, 1.0])), in_idx
+
+    def _compute_uv_points(self):
+        """
+        Map XY points to quad, remove points out of quad.
+        Results: self._uv_quad_points, self._z_quad_points, self._w_quad_points
+        :return:
+        """
+        self._uv_quad_points, in_idx = self._xy_to_quad_uv(self._xy_points)
         self._z_quad_points = self._z_points[in_idx]
         if self._weights is not None:
             self._w_quad_points = self._weights[in_idx]
         else:
-            n = in_idx.shape[0]
-            self._w_quad_points = np.ones(n)
+            self._w_quad_points = np.ones(len(self._z_quad_points))
 
     def _init_coo_structure(self):
         """
-        Initialize coordinate structure of the system of normal equations
+        Initialize coordinate structure of the system of normal equations.
+        :return: row, col; arrays n_patches x n_loc**2, indices of the local n_loc x n_loc blocks of the patches,
+            n_loc = (u_degree + 1) * (v_degree + 1), patch order given by 'patch_pos2id',
+            local entry (a, b) at position a * n_loc + b.
         """
-
         u_n_basf = self._u_basis.size
-        u_n_int = self._u_basis.size - 2
-        v_n_int = self._v_basis.size - 2
-        point_loc = []
-
-        n_uv_loc_nz = ((self._u_basis.degree + 1) * (self._v_basis.degree + 1))**2
-        n_nz = u_n_int * v_n_int * n_uv_loc_nz
-
-        row = np.zeros(n_nz, dtype=int)
-        col = np.zeros(n_nz, dtype=int)
-        data = np.zeros(n_nz)
-        linsp = np.array([0, 1, 2], dtype=int)
-        #linsp_u = np.linspace(0, self._u_basis.degree, self._u_basis.degree + 1, dtype=int)
-        #linsp_v = np.linspace(0, self._v_basis.degree, self._v_basis.degree + 1, dtype=int)
-        linsp31 = np.repeat(linsp, 3) # linsp_v
-        linsp13 = np.tile(linsp, 3) # linsp_u
-
-        nnz_b = 0
-
-        for iu in range(0, u_n_int):
-            iu_shift = np.repeat(iu, 9) + linsp13
-            for iv in range(0, v_n_int):
-                col_item = (linsp31 + np.repeat(iv, 9)) * u_n_basf + iu_shift
-                col[nnz_b: nnz_b + 81] = np.tile(col_item, 9)
-                row[nnz_b: nnz_b + 81] = np.repeat(col_item, 9)
-                nnz_b += 81
-                point_loc.append([])
-
-        return row, col, data, point_loc
+        u_n_int = self._u_basis.n_intervals
+        v_n_int = self._v_basis.n_intervals
+        n_loc = _n_local(self._u_basis, self._v_basis)
+        u_linsp = np.arange(self._u_basis.degree + 1)
+        v_linsp = np.arange(self._v_basis.degree + 1)
+        linsp_v = np.repeat(v_linsp, len(u_linsp))
+        linsp_u = np.tile(u_linsp, len(v_linsp))
+
+        iu, iv = np.divmod(np.arange(u_n_int * v_n_int), v_n_int)
+        col_item = (linsp_v + iv[:, None]) * u_n_basf + iu[:, None] + linsp_u
+        row = np.repeat(col_item, n_loc, axis=1)
+        col = np.tile(col_item, (1, n_loc))
+        return row, col
 
     def patch_pos2id(self, iu, iv):
             id = iu * self._v_basis.n_intervals + iv
             return id
 
+    def _assemble_chunk(self, uv_points, z_points, w_points):
+        """
+        Contributions of the points to the system of normal equations, see '_assemble_patch_rows'.
+        :param uv_points, z_points, w_points: arrays N x 2, N, N
+        :return: (data, vec_BTb, patch_ids); data - array n_patches * n_loc**2 of the local blocks of B^TWB,
+            vec_BTb - B^TWb, patch_ids - patches of the points.
+        """
+        data, vec_BTb, patch_ids = _assemble_patch_rows(self._u_basis, self._v_basis, uv_points, z_points, w_points)
+        return data, vec_BTb.ravel(), patch_ids
+
+    def _quad_point_chunks(self):
+        """
+        Points inside of the quad by chunks of bs.EVAL_CHUNK_SIZE.
+        :return: Iterator over (uv_points, z_points, w_points) arrays.
+        """
+        chunk_size = bs.EVAL_CHUNK_SIZE
+        for begin in range(0, len(self._z_quad_points), chunk_size):
+            chunk = slice(begin, begin + chunk_size)
+            yield self._uv_quad_points[chunk], self._z_quad_points[chunk], self._w_quad_points[chunk]
+
     def _build_system_of_normal_equations(self):
         """
         Construction of the system B^TWBz=B^TWb
-        for control points of the 2th order B-spline surface
+        for control points of the 2th order B-spline surface.
+        :return: (mat_BTB, vec_BTb, point_loc); point_loc - array of patch ids of the points, see 'patch_pos2id'.
+        """
+        if self.n_workers > 1:
+            return self._build_system_parallel()
+        return self._build_system_serial()
+
+    def _build_system_serial(self):
+        """
+        Construction of the system B^TWBz=B^TWb in the current process, by chunks of points.
+        :return: (mat_BTB, vec_BTb, point_loc), see '_build_system_of_normal_equations'.
+        """
+        point_loc = [np.zeros(0, dtype=int)]
+        mat_BTB, vec_BTb = self._assemble_normal_equations(self._quad_point_chunks(), point_loc)
+        return mat_BTB, vec_BTb, np.concatenate(point_loc)
+
+    def _build_system_parallel(self):
+        """
+        Construction of the system B^TWBz=B^TWb in self.n_workers processes.
+        Points are sorted by the U interval (patch row) and split into tiles of consecutive patch rows
+        with about the same number of points. The sorted points are permuted directly into the shared memory,
+        which is their only copy passed to the processes. Every process returns just the blocks of the tile
+        patches and the B^TWb entries of the tile poles, see '_assemble_tile'.
+        Falls back to the serial assembly if shared memory is not available (Python < 3.8).
+        :return: (mat_BTB, vec_BTb, point_loc), see '_build_system_of_normal_equations'.
+        """
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            logging.warning("Parallel assembly needs multiprocessing.shared_memory (Python >= 3.8), using one process.")
+            return self._build_system_serial()
+
+        n_points = len(self._z_quad_points)
+        u_n_int, v_n_int = self._u_basis.n_intervals, self._v_basis.n_intervals
+        u_deg = self._u_basis.degree
+        iu = self._u_basis.find_knot_interval_array(self._uv_quad_points[:, 0])
+        iv = self._v_basis.find_knot_interval_array(self._uv_quad_points[:, 1])
+        point_loc = self.patch_pos2id(iu, iv)
+
+        # Tiles: ranges of patch rows, 4 tiles per process for load balancing.
+        order = np.argsort(iu, kind='stable')
+        row_begin = np.searchsorted(iu[order], np.arange(u_n_int + 1))
+        n_tiles = min(4 * self.n_workers, u_n_int)
+        tile_rows = np.searchsorted(row_begin, np.linspace(0, n_points, n_tiles + 1)[1:-1])
+        tile_rows = np.unique(np.concatenate(([0], tile_rows, [u_n_int])))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, n_points * 4 * 8))
+        try:
+            # rows: u, v, z, w
+            points = np.ndarray((4, n_points), dtype=float, buffer=shm.buf)
+            for i_row, values in enumerate([self._uv_quad_points[:, 0], self._uv_quad_points[:, 1],
+                                            self._z_quad_points, self._w_quad_points]):
+                # mode='clip' writes directly to 'out', indices are valid
+                np.take(values, order, out=points[i_row], mode='clip')
+            del points
+
+            block_size = _n_local(self._u_basis, self._v_basis) ** 2
+            data = np.zeros(u_n_int * v_n_int * block_size)
+            vec_BTb = np.zeros((self._v_basis.size, self._u_basis.size))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = [executor.submit(_assemble_tile, shm.name, n_points,
+                                           (row_begin[r_begin], row_begin[r_end]), (r_begin, r_end),
+                                           self._u_basis, self._v_basis, bs.EVAL_CHUNK_SIZE)
+                           for r_begin, r_end in zip(tile_rows[:-1], tile_rows[1:])]
+                for future, r_begin, r_end in zip(futures, tile_rows[:-1], tile_rows[1:]):
+                    tile_data, tile_BTb = future.result()
+                    data[r_begin * v_n_int * block_size: r_end * v_n_int * block_size] = tile_data
+                    vec_BTb[:, r_begin: r_end + u_deg] += tile_BTb
+        finally:
+            shm.close()
+            shm.unlink()
+        return self._normal_matrix(data), vec_BTb.ravel(), point_loc
+
+    def _assemble_normal_equations(self, chunks, point_loc=None):
+        """
+        Accumulate the system B^TWBz=B^TWb over chunks of points,
+        local blocks of the patches are accumulated by bincount.
+        Memory is proportional to the chunk size and the number of basis functions.
+        :param chunks: Iterable over (uv_points, z_points, w_points), see '_quad_point_chunks'.
+        :param point_loc: Optional list, patch ids of the chunks are appended.
+        :return: (mat_BTB, vec_BTb)
+        """
+        data, vec_BTb = self._accumulate_chunks(chunks, point_loc)
+        return self._normal_matrix(data), vec_BTb
+
+    def _accumulate_chunks(self, chunks, point_loc=None):
+        """
+        Sum contributions of the chunks of points, see '_assemble_normal_equations'.
+        :return: (data, vec_BTb); data - array n_patches * n_loc**2 of the local blocks of B^TWB,
+            see '_init_coo_structure'.
+        """
+        block_size = _n_local(self._u_basis, self._v_basis) ** 2
+        data = np.zeros(self._u_basis.n_intervals * self._v_basis.n_intervals * block_size)
+        vec_BTb = np.zeros(self._u_basis.size * self._v_basis.size)
+        for uv_points, z_points, w_points in chunks:
+            chunk_data, chunk_BTb, patch_ids = self._assemble_chunk(uv_points, z_points, w_points)
+            data += chunk_data
+            vec_BTb += chunk_BTb
+            if point_loc is not None:
+                point_loc.append(patch_ids)
+        return data, vec_BTb
+
+    def _normal_matrix(self, data):
+        """
+        Sparse matrix B^TWB from the local blocks of the patches.
+        :param data: array n_patches * n_loc**2, see '_init_coo_structure'.
+        :return: CSR matrix
         """
         normal_matrix_size = self._u_basis.size * self._v_basis.size
-        n_points = self._uv_quad_points.shape[0]
-        row, col, data, point_loc = self._init_coo_structure()
-        vec_BTb = np.zeros(normal_matrix_size)
-
-        for idx in range(n_points):
-            u, v = self._uv_quad_points[idx, 0:2]
-            b_entry = self._z_quad_points[idx]
-            iu = self._u_basis.find_knot_interval(u)
-            iv = self._v_basis.find_knot_interval(v)
-            idp = self.patch_pos2id(iu, iv)
-            u_base_vec = self._u_basis.eval_base_vector(iu, u)
-            v_base_vec = self._v_basis.eval_base_vector(iv, v)
-            data9 = np.kron(v_base_vec, u_base_vec)
-            b_row = col[idp * 81: idp * 81 + 9]
-            ##  B^TWBz=B^TWb
-            w_data9 = self._w_quad_points[idx] * data9
-            data[idp*81:(idp+1)*81] += np.kron(data9, w_data9)
-            vec_BTb[b_row.tolist()] += b_entry * w_data9
-            point_loc[idp].append(idx)
-
-        mat_BTB = scipy.sparse.csr_matrix((data, (row, col)), shape=(normal_matrix_size, normal_matrix_size))
-        return mat_BTB, vec_BTb, point_loc
-
-    def _compute_errors(self, point_loc, z_vec):
+        row, col = self._init_coo_structure()
+        return scipy.sparse.csr_matrix((data, (row.ravel(), col.ravel())), shape=(normal_matrix_size, normal_matrix_size))
+
+    def _set_errors(self, surface_z, point_loc):
+        """
+        Set self.point_errors, self.patch_errors and self.error.
+        :param surface_z: Approximating surface of Z coordinate in UV.
+        :param point_loc: array N, patch ids of the points, see '_build_system_of_normal_equations'.
+        """
+        self.point_errors = self._compute_errors(surface_z)
+        self.patch_errors = self._compute_patch_errors(point_loc, self.point_errors)
+        self.error = np.max(np.abs(self.point_errors), initial=0.0)
+
+    def _compute_errors(self, surface_z):
         """
         Compute errors in approximation of the surface with respect
-        differences in z-coordinate. Computation is performed individually
-        on every patch in order to avoid to store whole system of the
-        overdetermined matrix at one time.
-        point_loc[patch_id][point_id]:  as list of the list
-        z_vec: z-coordinates corresponding to the computed surface as numpy array of the size equal to n_points
+        differences in z-coordinate. The Z surface is evaluated in all points
+        at once (by chunks, see bs.Surface.eval_array).
+        :param surface_z: Approximating surface of Z coordinate in UV.
+        :return: array N, differences (approximation - z) in the points inside the quad.
         """
-        n_patches = (self._u_basis.size - 2) * (self._v_basis.size - 2)
-        u_n_basf = self._u_basis.size
-        v_n_basf = self._v_basis.size
+        return surface_z.eval_array(self._uv_quad_points)[:, 0] - self._z_quad_points
 
-        g_vec = self._z_quad_points[:]
-        n = g_vec.shape[0]
-        err = np.zeros([n])
-
-        linsp = np.array([0, 1, 2], dtype=int)
-        linsp31 = np.repeat(linsp, 3)  # linsp_v
-        linsp13 = np.tile(linsp, 3)  # linsp_u
-
-        for interval_id in range(0, n_patches):
-            n_loc_points = len(point_loc[interval_id])
-            n_uv_loc_nz = (self._u_basis.degree + 1) * (self._v_basis.degree + 1)
-            row = np.zeros(n_loc_points * n_uv_loc_nz, dtype=int)
-            col = np.zeros(n_loc_points * n_uv_loc_nz, dtype=int)
-            data = np.zeros(n_loc_points * n_uv_loc_nz)
-            nnz_b = 0
-            for idx in point_loc[interval_id]:
-                u, v = self._uv_quad_points[idx, 0:2]
-                iu = self._u_basis.find_knot_interval(u)
-                iv = self._v_basis.find_knot_interval(v)
-                u_base_vec = self._u_basis.eval_base_vector(iu, u)
-                v_base_vec = self._v_basis.eval_base_vector(iv, v)
-                data[nnz_b:nnz_b + 9] = np.kron(v_base_vec, u_base_vec)
-                col[nnz_b: nnz_b + 9] = (linsp31 + iv) * u_n_basf + iu + linsp13
-                row[nnz_b:nnz_b + 9] = idx
-                nnz_b += 9
-            if len(point_loc[interval_id]) > 0:
-                mat_b = scipy.sparse.csr_matrix((data, (row, col)), shape=(n, u_n_basf * v_n_basf))
-                err += mat_b.dot(z_vec)
-        err = err - g_vec
-        return err
+    def _compute_patch_errors(self, point_loc, point_errors):
+        """
+        Max norm of the errors on the patches.
+        :param point_loc: array N, patch ids of the points, see 'patch_pos2id'.
+        :param point_errors: array N, see '_compute_errors'.
+        :return: array nu x nv, zero for patches without points.
+        """
+        patch_errors = np.zeros(self._u_basis.n_intervals * self._v_basis.n_intervals)
+        np.maximum.at(patch_errors, point_loc, np.abs(point_errors))
+        return patch_errors.reshape(self._u_basis.n_intervals, self._v_basis.n_intervals)
 
     def _basis_in_q_points(self, basis):
         n_int = basis.n_intervals
@@ -718,4 +954,311 @@ class SurfaceApprox:
         #print("Assembled")
         mat_a = scipy.sparse.coo_matrix((data_m, (row_m, col_m)),
                                         shape=(u_n_basf * v_n_basf, u_n_basf * v_n_basf)).tocsr()
-        return mat_a
\ No newline at end of file
+        return mat_a
+
+def _n_local(u_basis, v_basis):
+    """
+    Number of the basis functions nonzero on a patch, size of the local blocks of B^TWB is its square.
+    """
+    return (u_basis.degree + 1) * (v_basis.degree + 1)
+
+
+def _assemble_patch_rows(u_basis, v_basis, uv_points, z_points, w_points, row_range=None):
+    """
+    Contributions of the points to the system of normal equations B^TWBz=B^TWb,
+    restricted to a range of patch rows (U intervals), which must contain all the points.
+    :param u_basis, v_basis: Bases of the approximation.
+    :param uv_points, z_points, w_points: arrays N x 2, N, N
+    :param row_range: (begin, end) patch rows, all rows by default.
+    :return: (data, vec_BTb, patch_ids);
+        data - array n_row_patches * n_loc**2, local blocks of B^TWB of the patches of the rows,
+            n_loc = (u_degree + 1) * (v_degree + 1), see 'SurfaceApprox._init_coo_structure',
+        vec_BTb - array v_size x (end - begin + u_degree), B^TWb entries of the poles with U index in
+            [begin, end + u_degree), i.e. whole B^TWb (reshaped) for all rows,
+        patch_ids - patches of the points, see 'SurfaceApprox.patch_pos2id'.
+    """
+    row_begin, row_end = (0, u_basis.n_intervals) if row_range is None else row_range
+    v_n_int = v_basis.n_intervals
+    u_points, v_points = uv_points[:, 0], uv_points[:, 1]
+    iu = u_basis.find_knot_interval_array(u_points)
+    iv = v_basis.find_knot_interval_array(v_points)
+    u_base_vec = u_basis.eval_vector_array(iu, u_points)
+    v_base_vec = v_basis.eval_vector_array(iv, v_points)
+    n_loc = _n_local(u_basis, v_basis)
+    block_size = n_loc ** 2
+    # data_loc is kron(v_base_vec, u_base_vec)
+    data_loc = (v_base_vec[:, :, None] * u_base_vec[:, None, :]).reshape(-1, n_loc)
+    w_data_loc = w_points[:, None] * data_loc
+
+    ##  B^TWBz=B^TWb, local n_loc x n_loc blocks: kron(data_loc, w_data_loc)
+    n_row_patches = (row_end - row_begin) * v_n_int
+    local_blocks = (data_loc[:, :, None] * w_data_loc[:, None, :]).reshape(-1, block_size)
+    i_entries = ((iu - row_begin) * v_n_int + iv)[:, None] * block_size + np.arange(block_size)
+    data = np.bincount(i_entries.ravel(), weights=local_blocks.ravel(), minlength=n_row_patches * block_size)
+
+    n_u_poles = row_end - row_begin + u_basis.degree
+    cols = ((iv[:, None] + np.arange(v_basis.degree + 1))[:, :, None] * n_u_poles
+            + (iu[:, None] - row_begin + np.arange(u_basis.degree + 1))[:, None, :]).reshape(-1, n_loc)
+    vec_BTb = np.bincount(cols.ravel(), weights=(z_points[:, None] * w_data_loc).ravel(),
+                          minlength=v_basis.size * n_u_poles)
+    return data, vec_BTb.reshape(v_basis.size, n_u_poles), iu * v_n_int + iv
+
+
+def _assemble_tile(shm_name, n_points, point_range, row_range, u_basis, v_basis, chunk_size):
+    """
+    Process worker of 'SurfaceApprox._build_system_parallel'.
+    :param shm_name: Name of the shared memory with the points, array [u, v, z, w] x n_points, sorted by patch rows.
+    :param n_points: Number of all points.
+    :param point_range: (begin, end) points of the tile.
+    :param row_range: (begin, end) patch rows (U intervals) of the tile.
+    :param u_basis, v_basis: Bases of the approximation.
+    :param chunk_size: Number of points assembled at once.
+    :return: (data, vec_BTb); local blocks of the tile patches and B^TWb entries of the tile poles,
+        see '_assemble_patch_rows'.
+    """
+    from multiprocessing import shared_memory
+    block_size = _n_local(u_basis, v_basis) ** 2
+    data = np.zeros((row_range[1] - row_range[0]) * v_basis.n_intervals * block_size)
+    vec_BTb = np.zeros((v_basis.size, row_range[1] - row_range[0] + u_basis.degree))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        points = np.ndarray((4, n_points), dtype=float, buffer=shm.buf)
+        for begin in range(point_range[0], point_range[1], chunk_size):
+            end = min(begin + chunk_size, point_range[1])
+            chunk_data, chunk_BTb, _ = _assemble_patch_rows(
+                u_basis, v_basis, points[0:2, begin:end].T, points[2, begin:end], points[3, begin:end], row_range)
+            data += chunk_data
+            vec_BTb += chunk_BTb
+        del points
+    finally:
+        shm.close()
+    return data, vec_BTb
+
+TEXT_BLOCK_SIZE = 2**24
+
+
+def _sidecar_name(filename):
+    """
+    Name of the binary cache of the text point file, keyed on the file size and modification time.
+    """
+    stat = os.stat(filename)
+    return "{}.{}-{}.npy".format(filename, stat.st_size, stat.st_mtime_ns)
+
+
+def _remove_old_sidecars(filename):
+    """
+    Remove sidecars of previous versions of the text file, i.e. exactly '<filename>.<size>-<mtime_ns>.npy'.
+    """
+    dir_name, base_name = os.path.split(os.path.abspath(filename))
+    pattern = re.compile(re.escape(base_name) + r"\.\d+-\d+\.npy")
+    for name in os.listdir(dir_name):
+        if pattern.fullmatch(name):
+            os.remove(os.path.join(dir_name, name))
+
+
+def _parse_point_blocks(filename, block_size=None):
+    """
+    Parse the text file of points by blocks of lines, every block is converted by a single np.fromstring call
+    (C parser of the text mode). The partial result of unparsable input (a warning in older numpy, an error
+    in newer) is turned into ValueError.
+    :param filename: Text file, whitespace separated values, same number of values on every line.
+    :param block_size: Approximate size of the blocks in bytes, default is TEXT_BLOCK_SIZE.
+    :return: Iterator over arrays N x n_cols.
+    :raises ValueError: For values that are not numbers or a block with wrong number of values.
+    """
+    if block_size is None:
+        block_size = TEXT_BLOCK_SIZE
+    with open(filename, 'rb') as f:
+        first_line = f.readline()
+        while first_line and not first_line.strip():
+            first_line = f.readline()
+        n_cols = len(first_line.split())
+        tail = first_line
+        offset = f.tell() - len(first_line)
+        # Offset of the next block in the file.
+        while True:
+            block = f.read(block_size)
+            if block:
+                block = tail + block
+                i_end = block.rfind(b'\n') + 1
+                tail = block[i_end:]
+                block = block[:i_end]
+            else:
+                block, tail = tail, b''
+            block_offset = offset
+            offset += len(block)
+            if not block.strip():
+                if tail:
+                    continue
+                break
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('error', DeprecationWarning)
+                    values = np.fromstring(block.decode('ascii'), sep=' ')
+            except (ValueError, DeprecationWarning, UnicodeDecodeError) as err:
+                raise ValueError("Invalid value in the point file: {}, block at byte {}: {}"
+                                 .format(filename, block_offset, err))
+            if len(values) % n_cols != 0:
+                raise ValueError("Wrong number of values in the point file: {}, block at byte {}: {} values, "
+                                 "expected a multiple of {}.".format(filename, block_offset, len(values), n_cols))
+            yield values.reshape(-1, n_cols)
+
+
+def load_points(filename, cache=True, mmap_mode='r'):
+    """
+    Load XYZ or XYZW points from the text file.
+    The parsed points are saved into the sidecar file '<filename>.<size>-<mtime>.npy',
+    following calls with unchanged text file just memory map the sidecar.
+    :param filename: Path to the input text file, see 'SurfaceApprox.approx_from_file'.
+    :param cache: Use and create the sidecar file.
+    :param mmap_mode: Passed to np.load of the sidecar, use None to read it into memory.
+    :return: array N x 3 (or N x 4)
+    """
+    sidecar = _sidecar_name(filename)
+    if cache and os.path.exists(sidecar):
+        return np.load(sidecar, mmap_mode=mmap_mode)
+
+    points = list(_parse_point_blocks(filename))
+    points = np.concatenate(points) if points else np.zeros((0, 3))
+    if not cache:
+        return points
+    try:
+        _remove_old_sidecars(filename)
+        # Write a unique temporary file and rename it, readers never see a partial sidecar.
+        fd, tmp_name = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(sidecar) + ".",
+                                        dir=os.path.dirname(os.path.abspath(sidecar)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, points)
+            os.replace(tmp_name, sidecar)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+    except OSError as err:
+        logging.warning("Can not write point cache {}: {}".format(sidecar, err))
+        return points
+    return np.load(sidecar, mmap_mode=mmap_mode)
+
+
+def read_point_chunks(filename, chunk_size):
+    """
+    Read XYZ or XYZW points from the text file by chunks.
+    If the sidecar of 'load_points' is valid, chunks are read from it, otherwise the text blocks
+    of '_parse_point_blocks' are split into chunks.
+    :param filename: Path to the input text file, see 'SurfaceApprox.approx_from_file'.
+    :param chunk_size: Maximal number of points (lines) in a chunk.
+    :return: Iterator over arrays chunk_size x 3 (or x 4).
+    """
+    sidecar = _sidecar_name(filename)
+    if os.path.exists(sidecar):
+        points = np.load(sidecar, mmap_mode='r')
+        for begin in range(0, len(points), chunk_size):
+            yield np.array(points[begin: begin + chunk_size])
+        return
+
+    for points in _parse_point_blocks(filename):
+        for begin in range(0, len(points), chunk_size):
+            yield points[begin: begin + chunk_size]
+
+
+class SurfaceApproxStream(SurfaceApprox):
+    """
+    Surface approximation of the point set given by a sequence of point chunks, e.g. read from a file
+    that does not fit into memory. The chunks are read several times (default quad, default nuv,
+    normal equations, errors), only the current chunk is kept in memory. Memory of the approximation itself
+    is proportional to the number of basis functions.
+
+    Differences to SurfaceApprox:
+    - the default quad is the minimal bounding rectangle of the convex hull merged over chunks,
+      the points are counted in the same pass, all of them are taken as inside of the default quad
+    - self.point_errors is not stored (None), only self.patch_errors and self.error are computed
+    - self.n_workers is not used, the chunks are assembled sequentially
+    """
+
+    @staticmethod
+    def from_file(filename, chunk_size=None):
+        """
+        Approximation of the points in the text file, see 'SurfaceApprox.approx_from_file'.
+        :param filename: Path to the input text file.
+        :param chunk_size: Number of points read at once, default is bs.EVAL_CHUNK_SIZE.
+        :return: SurfaceApproxStream
+        """
+        if chunk_size is None:
+            chunk_size = bs.EVAL_CHUNK_SIZE
+        return SurfaceApproxStream(lambda: read_point_chunks(filename, chunk_size))
+
+    def __init__(self, point_chunks):
+        """
+        :param point_chunks: Function without arguments, returns a new iterator over arrays of points,
+            Nx3 (XYZ) or Nx4 (XYZW - points with weights).
+        """
+        self._point_chunks = point_chunks
+        super().__init__(None)
+        self._counted_quad = None
+        # Quad of the last point count, the count is reused while the quad is not changed.
+
+    def _set_points(self, points):
+        # Points are read by chunks, number of points is set by '_count_quad_points'.
+        self._n_points = None
+
+    def compute_default_quad(self):
+        """
+        Compute and set boundary quad as a minimum area bounding box of the input XY points.
+        Convex hull of the chunk is merged with the hull of previous chunks, the points are counted
+        in the same pass, see '_count_quad_points'.
+        :return: The quadrilateral vertices.
+        """
+        hull = np.zeros((0, 2))
+        n_points = 0
+        for points in self._point_chunks():
+            hull = convex_hull_2d(np.concatenate((hull, points[:, 0:2])))
+            n_points += len(points)
+        self.quad = min_bounding_rect(hull)
+        self._n_points = self._n_quad_points = n_points
+        self._counted_quad = self.quad
+        return self.quad
+
+    def _count_quad_points(self):
+        # The default quad contains all points, their count is known from 'compute_default_quad'.
+        if self._counted_quad is not None and self._counted_quad is self.quad:
+            return self._n_quad_points
+        n_points, n_quad_points = 0, 0
+        for points in self._point_chunks():
+            n_points += len(points)
+            n_quad_points += np.sum(self._xy_to_quad_uv(points[:, 0:2])[1])
+        self._n_points, self._n_quad_points = n_points, n_quad_points
+        self._counted_quad = self.quad
+        return n_quad_points
+
+    def _compute_uv_points(self):
+        # Points are mapped to UV by chunks, see '_quad_point_chunks'.
+        pass
+
+    def _quad_point_chunks(self):
+        for points in self._point_chunks():
+            uv_points, in_idx = self._xy_to_quad_uv(points[:, 0:2])
+            z_points = points[in_idx, 2]
+            if points.shape[1] > 3:
+                w_points = points[in_idx, 3]
+            else:
+                w_points = np.ones(len(z_points))
+            yield uv_points, z_points, w_points
+
+    def _build_system_of_normal_equations(self):
+        mat_BTB, vec_BTb = self._assemble_normal_equations(self._quad_point_chunks())
+        return mat_BTB, vec_BTb, None
+
+    def _set_errors(self, surface_z, point_loc):
+        """
+        Set self.patch_errors and self.error by a pass over the chunks.
+        The errors of the individual points are not kept, self.point_errors stays None.
+        """
+        self.point_errors = None
+        self.patch_errors = np.zeros((self._u_basis.n_intervals, self._v_basis.n_intervals))
+        for uv_points, z_points, w_points in self._quad_point_chunks():
+            point_errors = surface_z.eval_array(uv_points)[:, 0] - z_points
+            iu = self._u_basis.find_knot_interval_array(uv_points[:, 0])
+            iv = self._v_basis.find_knot_interval_array(uv_points[:, 1])
+            chunk_errors = self._compute_patch_errors(self.patch_pos2id(iu, iv), point_errors)
+            np.maximum(self.patch_errors, chunk_errors, out=self.patch_errors)
+        self.error = np.max(self.patch_errors, initial=0.0)
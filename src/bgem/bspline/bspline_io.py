@@ -0,0 +1,177 @@
+"""
+Serialization of B-spline curves and surfaces.
+
+- bs_zsurface_read, bs_zsurface_write: conversion of Z_Surface from/to a serialization object
+  with plain attributes (e.g. geometry.SurfaceApproximation)
+- save, load: compact binary format, single flat float64 '.npy' array:
+
+    [ MAGIC, VERSION, kind, record ]
+
+  Curve record:
+    [ degree, n_knots, n_poles, pole_dim, rational ] + knots + poles
+  Surface record:
+    [ u_degree, n_u_knots, v_degree, n_v_knots, n_u_poles, n_v_poles, pole_dim, rational ] + u_knots + v_knots + poles
+  Z_Surface record:
+    Surface record of the Z surface + orig_quad (4 x 2) + xy_mat (2 x 3) + z_mat (2)
+
+  Files are read through np.load(mmap_mode='r'), poles of the loaded objects are read-only views
+  into the mapped file (zero copy, pages shared by processes loading the same file).
+"""
+
+import numpy as np
+
+from . import bspline as bs
+
+
+MAGIC = float(0x6267656d)
+# Identification of the bgem B-spline file, 'bgem' in ASCII.
+VERSION = 1
+
+KIND_CURVE = 0
+KIND_SURFACE = 1
+KIND_Z_SURFACE = 2
+
+
+def bs_zsurface_read(z_surface_io):
+    """
+    Make Z_Surface from its serialization object.
+    :param z_surface_io: Object with attributes: u_degree, v_degree, u_knots, v_knots, rational, poles,
+        orig_quad, xy_map, z_map; see geometry.SurfaceApproximation.
+    :return: Z_Surface
+    """
+    io = z_surface_io
+    u_basis = bs.SplineBasis(io.u_degree, io.u_knots)
+    v_basis = bs.SplineBasis(io.v_degree, io.v_knots)
+    z_surf = bs.Surface((u_basis, v_basis), io.poles, io.rational)
+    surf = bs.Z_Surface(io.orig_quad, z_surf)
+    _set_transform(surf, io.xy_map, io.z_map)
+    return surf
+
+
+def bs_zsurface_write(z_surface, z_surface_io):
+    """
+    Store Z_Surface into its serialization object.
+    :param z_surface: Z_Surface
+    :param z_surface_io: Object to fill, see 'bs_zsurface_read'.
+    :return: z_surface_io
+    """
+    io = z_surface_io
+    io.u_degree = z_surface.u_basis.degree
+    io.u_knots = z_surface.u_basis.knots.tolist()
+    io.v_degree = z_surface.v_basis.degree
+    io.v_knots = z_surface.v_basis.knots.tolist()
+    io.rational = z_surface.z_surface.rational
+    io.poles = z_surface.z_surface.poles.tolist()
+    io.orig_quad = np.array(z_surface.orig_quad).tolist()
+    xy_map, z_map = z_surface.get_transform()
+    io.xy_map = np.array(xy_map).tolist()
+    io.z_map = np.array(z_map).tolist()
+    return io
+
+
+def _set_transform(z_surface, xy_map, z_map):
+    """
+    Apply the transform of the saved Z_Surface, identities are skipped.
+    """
+    xy_map = np.array(xy_map, dtype=float)
+    z_map = np.array(z_map, dtype=float)
+    if np.array_equal(xy_map, np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])):
+        xy_map = None
+    if np.array_equal(z_map, np.array([1.0, 0.0])):
+        z_map = None
+    z_surface.transform(xy_map, z_map)
+
+
+def _curve_record(curve):
+    head = [curve.basis.degree, len(curve.basis.knots), curve.poles.shape[0], curve.poles.shape[1], curve.rational]
+    return [np.array(head, dtype=float), curve.basis.knots, curve.poles.ravel()]
+
+
+def _surface_record(surface):
+    u_basis, v_basis = surface.u_basis, surface.v_basis
+    n_u, n_v, pole_dim = surface.poles.shape
+    head = [u_basis.degree, len(u_basis.knots), v_basis.degree, len(v_basis.knots), n_u, n_v, pole_dim, surface.rational]
+    return [np.array(head, dtype=float), u_basis.knots, v_basis.knots, surface.poles.ravel()]
+
+
+def save(file_name, obj):
+    """
+    Save Curve, Surface or Z_Surface into the binary file.
+    :param file_name: Output file, the name is used as is (no '.npy' suffix is added).
+    :param obj: Curve, Surface or Z_Surface object.
+    :return: None
+    """
+    if isinstance(obj, bs.Curve):
+        kind, record = KIND_CURVE, _curve_record(obj)
+    elif isinstance(obj, bs.Surface):
+        kind, record = KIND_SURFACE, _surface_record(obj)
+    elif isinstance(obj, bs.Z_Surface):
+        xy_map, z_map = obj.get_transform()
+        kind = KIND_Z_SURFACE
+        record = _surface_record(obj.z_surface) + [np.ravel(obj.orig_quad), np.ravel(xy_map), np.ravel(z_map)]
+    else:
+        raise TypeError("Can not save object of type: {}".format(type(obj)))
+    data = np.concatenate([np.array([MAGIC, VERSION, kind], dtype=float)] + [np.asarray(a, dtype=float) for a in record])
+    with open(file_name, 'wb') as f:
+        np.save(f, data)
+
+
+class _Reader:
+    """
+    Sequential reading of the flat array.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        self.pos += n
+        return self.data[self.pos - n: self.pos]
+
+    def take_int(self, n):
+        return [int(x) for x in self.take(n)]
+
+
+def _read_curve(reader):
+    degree, n_knots, n_poles, pole_dim, rational = reader.take_int(5)
+    basis = bs.SplineBasis(degree, reader.take(n_knots))
+    poles = reader.take(n_poles * pole_dim).reshape(n_poles, pole_dim)
+    return bs.Curve(basis, poles, bool(rational), copy=False)
+
+
+def _read_surface(reader):
+    u_degree, n_u_knots, v_degree, n_v_knots, n_u, n_v, pole_dim, rational = reader.take_int(8)
+    u_basis = bs.SplineBasis(u_degree, reader.take(n_u_knots))
+    v_basis = bs.SplineBasis(v_degree, reader.take(n_v_knots))
+    poles = reader.take(n_u * n_v * pole_dim).reshape(n_u, n_v, pole_dim)
+    return bs.Surface((u_basis, v_basis), poles, bool(rational), copy=False)
+
+
+def load(file_name, mmap_mode='r'):
+    """
+    Load Curve, Surface or Z_Surface from the binary file.
+    :param file_name: Input file, see 'save'.
+    :param mmap_mode: Passed to np.load, use None to read the whole file at once.
+    :return: Curve, Surface or Z_Surface object.
+    """
+    data = np.load(file_name, mmap_mode=mmap_mode)
+    if data.ndim != 1 or len(data) < 3 or data[0] != MAGIC:
+        raise ValueError("Not a B-spline file: {}".format(file_name))
+    if data[1] != VERSION:
+        raise ValueError("Unsupported B-spline file version {}: {}".format(data[1], file_name))
+    kind = int(data[2])
+    reader = _Reader(data)
+    reader.pos = 3
+    if kind == KIND_CURVE:
+        return _read_curve(reader)
+    elif kind == KIND_SURFACE:
+        return _read_surface(reader)
+    elif kind == KIND_Z_SURFACE:
+        z_surf = _read_surface(reader)
+        orig_quad = np.array(reader.take(8)).reshape(4, 2)
+        xy_map = np.array(reader.take(6)).reshape(2, 3)
+        z_map = np.array(reader.take(2))
+        surf = bs.Z_Surface(orig_quad, z_surf)
+        _set_transform(surf, xy_map, z_map)
+        return surf
+    raise ValueError("Unknown object kind {}: {}".format(kind, file_name))
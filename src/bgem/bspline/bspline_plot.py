@@ -13,6 +13,8 @@ from mpl_toolkits.mplot3d import Axes3D
 
 import numpy as np
 
+from . import tessellate
+
 
 
 
@@ -44,6 +46,12 @@ class PlottingPlotly:
         colorscale = [[0.0, 'hsv({}, 50%, 10%)'.format(hue)], [1.0, 'hsv({}, 50%, 90%)'.format(hue)]]
         self.data_3d.append( go.Surface(x=X, y=Y, z=Z, colorscale=colorscale))
 
+    def add_mesh_3d(self, points, triangles, **kwargs):
+        hue = (120*(len(self.data_3d)))%360
+        colorscale = [[0.0, 'hsl({}, 50%, 10%)'.format(hue)], [1.0, 'hsl({}, 50%, 80%)'.format(hue)]]
+        X, Y, Z = points.T
+        i, j, k = triangles.T
+        self.data_3d.append( go.Mesh3d(x=X, y=Y, z=Z, i=i, j=j, k=k, intensity=Z, colorscale=colorscale))
 
     def add_points_3d(self, X, Y, Z, **kwargs):
         marker = dict(
@@ -94,6 +102,10 @@ class PlottingMatplot:
         plt.figure(2)
         self.ax_3d.plot_surface(X, Y, Z, **kwargs)
 
+    def add_mesh_3d(self, points, triangles, **kwargs):
+        plt.figure(2)
+        self.ax_3d.plot_trisurf(points[:, 0], points[:, 1], points[:, 2], triangles=triangles, **kwargs)
+
     def add_points_3d(self, X, Y, Z, **kwargs):
         plt.figure(2)
         return self.ax_3d.scatter(X, Y, Z, color='red', **kwargs)
@@ -138,19 +150,23 @@ class Plotting:
         """
         self.backend.add_surface_3d(X, Y, Z)
 
-    def plot_curve_2d(self, curve, n_points=100, poles=False):
+    def plot_curve_2d(self, curve, n_points=100, poles=False, tolerance=None):
         """
         Add plot of a 2d Bspline curve.
         :param curve: Curve t -> x,y
         :param n_points: Number of evaluated points.
+        :param tolerance: If given, adaptive polyline with this chordal deviation is plotted instead
+            of 'n_points' uniform samples, see tessellate.curve_polyline.
         :param: kwargs: Additional parameters passed to the mtplotlib plot command.
         """
 
-        basis = curve.basis
-        t_coord = np.linspace(basis.domain[0], basis.domain[1], n_points)
-
-        coords = [curve.eval(t) for t in t_coord]
-        x_coord, y_coord = zip(*coords)
+        if tolerance is None:
+            basis = curve.basis
+            t_coord = np.linspace(basis.domain[0], basis.domain[1], n_points)
+            coords = curve.eval_array(t_coord)
+        else:
+            t_coord, coords = tessellate.curve_polyline(curve, tolerance)
+        x_coord, y_coord = coords[:, 0], coords[:, 1]
 
         self.backend.add_curve_2d(x_coord, y_coord)
         if poles:
@@ -175,7 +191,7 @@ class Plotting:
         self.backend.add_points_3d(X, Y, Z)
 
 
-    def plot_surface_3d(self, surface, n_points=(100, 100), poles=False):
+    def plot_surface_3d(self, surface, n_points=(100, 100), poles=False, tolerance=None):
         """
         Plot a surface in 3d.
         Usage:
@@ -186,22 +202,24 @@ class Plotting:
 
         :param surface: Parametric surface in 3d.
         :param n_points: (nu, nv), nu*nv - number of evaluation point
+        :param tolerance: If given, adaptive triangulation with this chordal deviation is plotted instead
+            of the uniform grid, see tessellate.surface_triangles.
         """
+        if tolerance is not None:
+            uv_points, xyz, triangles = tessellate.surface_triangles(surface, tolerance)
+            self.backend.add_mesh_3d(xyz, triangles)
+            if poles:
+                self.plot_surface_poles_3d(surface)
+            return
 
         u_basis, v_basis = surface.u_basis, surface.v_basis
 
         u_coord = np.linspace(u_basis.domain[0], u_basis.domain[1], n_points[0])
         v_coord = np.linspace(v_basis.domain[0], v_basis.domain[1], n_points[1])
 
-        U, V = np.meshgrid(u_coord, v_coord)
-        points = np.stack( [U.ravel(), V.ravel()], axis = 1 )
-
-        xyz = surface.eval_array(points)
-        X, Y, Z = xyz.T
-
-        X = X.reshape(U.shape)
-        Y = Y.reshape(U.shape)
-        Z = Z.reshape(U.shape)
+        # Evaluate on the tensor grid, shape (nv, nu) as given by meshgrid.
+        xyz = surface.eval_grid(u_coord, v_coord)
+        X, Y, Z = xyz.transpose(2, 1, 0)
 
         # Plot the surface.
         self.backend.add_surface_3d(X, Y,  Z)
@@ -2,6 +2,7 @@
 import numpy as np
 import numpy.linalg as la
 
+from . import bspline as bs
 from . import curve_point as CP, surface_point as SP, isec_curv_surf_point as ICSP
 
 
@@ -23,26 +24,14 @@ class IsecCurveSurf:
         :return: J: jacobian matrix (array 3x3) , deltaXYZ: vector of deltas in R^3 space (array 3x1)
         """
 
-        surf = self.surf
-        curv = self.curv
         iu, iv, it = iuvt
-        surf_poles = surf.poles[iu:iu + 3, iv:iv + 3, :]
-        t_poles = curv.poles[it:it + 3, :]
-
-        uf = surf.u_basis.eval_vector(iu, uvt[0])
-        vf = surf.v_basis.eval_vector(iv, uvt[1])
-        ufd = surf.u_basis.eval_diff_vector(iu, uvt[0])
-        vfd = surf.v_basis.eval_diff_vector(iv, uvt[1])
-        tf = curv.basis.eval_vector(it, uvt[2])
-        tfd = curv.basis.eval_diff_vector(it, uvt[2])
-
-        dxyz2t = t_poles.T @ tfd
-        # surf_poles have shape (Nu, Nv, 3)
-        dxyz1u = surf_poles.T @ ufd @ vf
-        dxyz1v = surf_poles.T @ uf @ vfd
-        J = np.column_stack((dxyz1u, dxyz1v, -dxyz2t))
-        xyz1 = surf_poles.T  @ uf @ vf
-        xyz2 = t_poles.T @ tf
+        # surf_ders have shape (2, 2, 3), curv_ders have shape (2, 3)
+        surf_ders = self.surf.eval_derivs_local(np.array([uvt[0:2]]), np.array([[iu, iv]]), 1)[0]
+        curv_ders = self.curv.eval_derivs_local(np.array([uvt[2]]), np.array([it]), 1)[0]
+
+        J = np.column_stack((surf_ders[1, 0], surf_ders[0, 1], -curv_ders[1]))
+        xyz1 = surf_ders[0, 0]
+        xyz2 = curv_ders[0]
 
         return J, xyz1, xyz2
 
@@ -93,24 +82,36 @@ class IsecCurveSurf:
         return uvt, conv, xyz
 
 
-    def get_intersections(self, surf, curv, tree):
+    def get_intersections(self, surf, curv, tree=None):
         """
         Tries to compute intersection of the main curves from surface1 and patches of the surface2 which have a
          non-empty intersection of corresponding bonding boxes
         :param surf1: Surface used to construction of the main threads
         :param surf2: Intersected surface
-        :param tree2: Bih tree of the patches of the surface 2
+        :param tree: Box tree of the patches of the surface 2, 'surf.patch_index' by default;
+            PatchIndex (vectorized query) or any tree with 'find_box' (e.g. bih.BIH of 3d boxes)
         :return: point_list as list of points of intersection
         """
+        if tree is None:
+            tree = surf.patch_index
 
         point_list = []
         crossing = np.zeros([curv.basis.n_intervals + 1])
 
+        if hasattr(tree, 'find_boxes'):
+            # candidate patches of all curve intervals at once
+            isec_ptr, isec_patches = tree.find_boxes(curv.box_array)
+            interval_patches = lambda it: isec_patches[isec_ptr[it]:isec_ptr[it + 1]]
+        else:
+            # single query per curve interval, boxes embedded into 3d
+            boxes = np.zeros((curv.basis.n_intervals, 2, 3))
+            boxes[:, :, 0:curv.dim] = curv.box_array
+            interval_patches = lambda it: tree.find_box(bs.bih.AABB(boxes[it].tolist()))
         for it in range(curv.basis.n_intervals):
             if self._already_found(crossing, it) == 1:  # ?
                 print('continue')
                 continue
-            intersectioned_patches2 = tree.find_box(curv.boxes[it])
+            intersectioned_patches2 = interval_patches(it)
             for ipatch2 in intersectioned_patches2:
                 iu2, iv2 = surf.patch_id2pos(ipatch2)
                 uvt,  conv, xyz = self.get_intersection(iu2, iv2, it, self.max_it, self.rel_tol, self.abs_tol)
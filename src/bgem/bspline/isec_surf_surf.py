@@ -100,7 +100,7 @@ class IsecSurfSurf:
         TODO: possibly rename to "_raw_intersection_points"
         """
 
-        tree2 = other_surf.tree
+        patch_index2 = other_surf.patch_index
 
         point_list = []
         crossing = np.zeros([own_surf.u_basis.n_intervals + 1, own_surf.v_basis.n_intervals + 1])
@@ -113,9 +113,11 @@ class IsecSurfSurf:
             for curve in curves:
                 curve_id += 1
                 #interval_intersections = 0
+                # candidate patches of all curve intervals at once
+                isec_ptr, isec_patches = patch_index2.find_boxes(curve.box_array)
                 for it in range(curve.basis.n_intervals):
                     curv_surf_isec = ICS.IsecCurveSurf(other_surf, curve)
-                    intersectioned_patches2 = tree2.find_box(curve.boxes[it])
+                    intersectioned_patches2 = isec_patches[isec_ptr[it]:isec_ptr[it + 1]]
                     lpoint_list = []
                     for ipatch2 in intersectioned_patches2:
                         iu2, iv2 = other_surf.patch_id2pos(ipatch2)
@@ -0,0 +1,166 @@
+"""
+Static lookup of axes aligned bounding boxes (AABB) of curve intervals and surface patches.
+Pure numpy replacement of the BIH tree, used when the 'bih' package is not available.
+
+Implementation:
+- sparse uniform grid, cell size given by the median box size,
+  only the nonempty cells are stored as sorted cell ids with CSR lists of boxes
+- all queries are vectorized, many boxes are processed in a single call,
+  results are returned as CSR candidate lists
+"""
+import numpy as np
+
+
+def _expand_ranges(starts, counts):
+    """
+    Concatenate integer ranges [start, start + count).
+    :param starts: array N x int
+    :param counts: array N x int
+    :return: (owners, values); owners[i] is the index of the range containing values[i].
+    """
+    counts = np.asarray(counts, dtype=int)
+    owners = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    values = np.arange(len(owners)) - offsets[owners] + np.asarray(starts, dtype=int)[owners]
+    return owners, values
+
+
+class PatchIndex:
+    """
+    Lookup of boxes intersecting given boxes or points.
+    Box IDs are positions in the input box array, e.g. patch IDs of a surface (see Surface.patch_pos2id).
+    """
+
+    def __init__(self, box_array, cells_per_box=4):
+        """
+        Construct the index for given boxes.
+        :param box_array: array N x 2 x D; [:, 0, :] min corners, [:, 1, :] max corners.
+        :param cells_per_box: Limit of the total number of grid cells relative to the number of boxes.
+        """
+        self.boxes = np.asarray(box_array, dtype=float)
+        n_boxes, _, self.dim = self.boxes.shape
+        # Boxes, N x 2 x D
+
+        if n_boxes == 0:
+            self.origin = np.zeros(self.dim)
+            extent = np.zeros(self.dim)
+            box_size = np.zeros(self.dim)
+        else:
+            self.origin = np.amin(self.boxes[:, 0, :], axis=0)
+            extent = np.amax(self.boxes[:, 1, :], axis=0) - self.origin
+            box_size = np.median(self.boxes[:, 1, :] - self.boxes[:, 0, :], axis=0)
+        # Grid origin.
+
+        # Desired cells of the median box size, total number of cells limited.
+        default_n = int(np.ceil(max(n_boxes, 1) ** (1.0 / self.dim)))
+        n_cells = np.ones(self.dim, dtype=int)
+        for axis in range(self.dim):
+            if extent[axis] > 0:
+                if box_size[axis] > 0:
+                    n_cells[axis] = int(min(np.ceil(extent[axis] / box_size[axis]), 2 ** 20))
+                else:
+                    n_cells[axis] = default_n
+        max_cells = max(cells_per_box * n_boxes, 1)
+        while np.prod(n_cells) > max_cells:
+            i_max = np.argmax(n_cells)
+            n_cells[i_max] = (n_cells[i_max] + 1) // 2
+        self.n_cells = n_cells
+        # Number of grid cells along axes.
+
+        self.cell_size = np.where(extent > 0, extent / n_cells, 1.0)
+        # Size of the grid cells.
+
+        box_owners, cell_ids = self._box_cells(self.boxes)
+        order = np.argsort(cell_ids, kind='stable')
+        self._cell_ids, i_starts = np.unique(cell_ids[order], return_index=True)
+        # Sorted IDs of nonempty cells.
+        self._cell_ptr = np.append(i_starts, len(order))
+        self._cell_boxes = box_owners[order]
+        # CSR lists of boxes of the nonempty cells.
+
+    def _box_cells(self, boxes):
+        """
+        All grid cells intersecting given boxes.
+        :param boxes: array N x 2 x D
+        :return: (owners, cell_ids); owners[i] is the box intersecting the cell 'cell_ids[i]'.
+        """
+        top = self.n_cells - 1
+        i_min = np.floor((boxes[:, 0, :] - self.origin) / self.cell_size).astype(int)
+        i_max = np.floor((boxes[:, 1, :] - self.origin) / self.cell_size).astype(int)
+        outside = np.any(np.logical_or(i_max < 0, i_min > top), axis=1)
+        i_min = np.clip(i_min, 0, top)
+        i_max = np.clip(i_max, 0, top)
+        sizes = i_max - i_min + 1
+        counts = np.where(outside, 0, np.prod(sizes, axis=1))
+        owners, local = _expand_ranges(np.zeros_like(counts), counts)
+
+        # decompose local index into offsets along axes
+        cell_idx = []
+        for axis in reversed(range(self.dim)):
+            size = sizes[owners, axis]
+            cell_idx.append(i_min[owners, axis] + local % size)
+            local = local // size
+        cell_ids = np.ravel_multi_index(tuple(reversed(cell_idx)), self.n_cells)
+        return owners, cell_ids
+
+    def find_boxes(self, query_boxes):
+        """
+        Vectorized lookup of boxes intersecting the query boxes, touching boxes are included.
+        :param query_boxes: array Q x 2 x D
+        :return: (indptr, indices); IDs of boxes intersecting the query 'i' are indices[indptr[i]:indptr[i+1]],
+            sorted in ascending order.
+        """
+        query_boxes = np.asarray(query_boxes, dtype=float).reshape(-1, 2, self.dim)
+        n_queries = len(query_boxes)
+        query_owners, cell_ids = self._box_cells(query_boxes)
+
+        i_cells = np.searchsorted(self._cell_ids, cell_ids)
+        i_cells = np.minimum(i_cells, len(self._cell_ids) - 1)
+        found = self._cell_ids[i_cells] == cell_ids if len(self._cell_ids) > 0 else np.zeros(len(cell_ids), dtype=bool)
+        query_owners, i_cells = query_owners[found], i_cells[found]
+
+        starts = self._cell_ptr[i_cells]
+        owners, i_entries = _expand_ranges(starts, self._cell_ptr[i_cells + 1] - starts)
+        query_ids = query_owners[owners]
+        box_ids = self._cell_boxes[i_entries]
+
+        # remove duplicities (boxes in more cells), sort by query and box
+        keys = np.unique(query_ids * len(self.boxes) + box_ids)
+        query_ids, box_ids = np.divmod(keys, max(len(self.boxes), 1))
+
+        # exact test of the candidates
+        q_boxes, c_boxes = query_boxes[query_ids], self.boxes[box_ids]
+        intersect = np.all(np.logical_and(q_boxes[:, 0, :] <= c_boxes[:, 1, :], c_boxes[:, 0, :] <= q_boxes[:, 1, :]), axis=1)
+        query_ids, box_ids = query_ids[intersect], box_ids[intersect]
+
+        indptr = np.zeros(n_queries + 1, dtype=int)
+        indptr[1:] = np.cumsum(np.bincount(query_ids, minlength=n_queries))
+        return indptr, box_ids
+
+    def find_points(self, points):
+        """
+        Vectorized lookup of boxes containing given points.
+        :param points: array Q x D
+        :return: (indptr, indices), see 'find_boxes'.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, self.dim)
+        return self.find_boxes(np.stack((points, points), axis=1))
+
+    def find_box(self, box):
+        """
+        Same as BIH.find_box.
+        :param box: array 2 x D, min and max corner; or bih.AABB, coordinates above D are ignored.
+        :return: List of IDs of intersecting boxes.
+        """
+        if not isinstance(box, (np.ndarray, list, tuple)):
+            box = [box.min(), box.max()]
+        box = np.asarray(box, dtype=float)[:, 0:self.dim]
+        return self.find_boxes(box)[1].tolist()
+
+    def find_point(self, point):
+        """
+        Same as BIH.find_point.
+        :param point: array D, coordinates above D are ignored.
+        :return: List of IDs of boxes containing the point.
+        """
+        return self.find_points(np.asarray(point, dtype=float)[0:self.dim])[1].tolist()
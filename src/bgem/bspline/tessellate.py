@@ -0,0 +1,263 @@
+"""
+Adaptive tessellation of B-spline curves and surfaces.
+
+- curve_polyline: Curve -> polyline with bounded chordal deviation
+- surface_triangles: Surface, Z_Surface -> triangle mesh with bounded chordal deviation
+
+Implementation:
+- every nonempty knot interval (patch) is refined by a binary tree (quadtree), all cells
+  of a single level are tested and split at once, points are evaluated by a single 'eval_array' call per level
+- vertices are identified by integer coordinates on the lattice of the finest level, so
+  the points shared by neighbouring cells are evaluated just once
+- cells with hanging vertices (finer neighbours) are triangulated by a fan from the cell center,
+  so the surface mesh is conforming
+"""
+import numpy as np
+
+from .patch_index import _expand_ranges
+
+
+def _breaks(basis):
+    """
+    Distinct knots of the basis domain, i.e. bounds of the nonempty intervals.
+    """
+    i_begin, i_end = basis.knots_idx_range
+    return np.unique(basis.knots[i_begin: i_end + 1])
+
+
+def _lattice_to_param(breaks, coords, scale):
+    """
+    Parameters of the lattice coordinates.
+    :param breaks: Bounds of the intervals, array n + 1.
+    :param coords: Integer lattice coordinates in [0, n * scale].
+    :param scale: Number of lattice steps per interval.
+    :return: array of parameters, same shape as 'coords'.
+    """
+    i_int = np.minimum(coords // scale, len(breaks) - 2)
+    return breaks[i_int] + (breaks[i_int + 1] - breaks[i_int]) * (coords - i_int * scale) / scale
+
+
+def _chord_distance(points, a, b):
+    """
+    Distance of the points from the segments (chords).
+    :param points: array N x D
+    :param a, b: Segment end points, arrays N x D.
+    :return: array N
+    """
+    ab = b - a
+    ab_norm2 = np.sum(ab * ab, axis=1)
+    t = np.sum((points - a) * ab, axis=1) / np.where(ab_norm2 > 0, ab_norm2, 1.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.linalg.norm(points - a - t[:, None] * ab, axis=1)
+
+
+class _PointCache:
+    """
+    Points evaluated at integer keys, missing points are evaluated in batches.
+    """
+    def __init__(self, eval_keys):
+        """
+        :param eval_keys: Function: array of keys -> array of points N x D.
+        """
+        self.eval_keys = eval_keys
+        self.keys = np.zeros(0, dtype=np.int64)
+        # Sorted keys.
+        self.points = None
+        # Points of the keys.
+
+    def __call__(self, keys):
+        """
+        Points for given keys.
+        :param keys: array of keys
+        :return: array of points, shape keys.shape + (D,)
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        new_keys = np.setdiff1d(keys, self.keys)
+        if len(new_keys) > 0:
+            new_points = np.asarray(self.eval_keys(new_keys), dtype=float)
+            if self.points is None:
+                self.keys, self.points = new_keys, new_points
+            else:
+                all_keys = np.concatenate((self.keys, new_keys))
+                order = np.argsort(all_keys, kind='stable')
+                self.keys = all_keys[order]
+                self.points = np.concatenate((self.points, new_points))[order]
+        return self.points[np.searchsorted(self.keys, keys)]
+
+
+def curve_polyline(curve, tolerance, max_level=10, min_level=0):
+    """
+    Approximate the curve by a polyline with given chordal deviation.
+    Every knot interval is bisected until the distance of the curve midpoint and quarter points from the chord
+    is within the tolerance.
+    :param curve: Curve object (or any object with 'basis' and 'eval_array').
+    :param tolerance: Maximal chordal deviation.
+    :param max_level: Maximal number of bisections of a knot interval.
+    :param min_level: Minimal number of bisections of a knot interval.
+    :return: (t_points, points); parameters N, points of the polyline N x D.
+    """
+    assert 0 <= min_level <= max_level
+    breaks = _breaks(curve.basis)
+    scale = 2 ** max_level
+    n_intervals = len(breaks) - 1
+
+    def eval_keys(keys):
+        return curve.eval_array(_lattice_to_param(breaks, keys, scale))
+
+    cache = _PointCache(eval_keys)
+    vertices = [np.arange(n_intervals + 1) * scale]
+    # Lattice coordinates of the polyline vertices.
+    segments = np.arange(n_intervals) * scale
+    # Start of the active segments, all of the same size.
+    size = scale
+    level = 0
+    while len(segments) > 0 and size > 1:
+        mid = segments + size // 2
+        if level < min_level:
+            split = np.ones(len(segments), dtype=bool)
+        else:
+            # Quarter points and the midpoint, the midpoint of a symmetric S-shaped span lies on the chord.
+            quarter = size // 4
+            points = cache(np.stack((segments, segments + quarter, mid, mid + quarter, segments + size), axis=1))
+            dev = _chord_distance(points[:, 2], points[:, 0], points[:, 4])
+            for i_inner in (1, 3):
+                dev = np.maximum(dev, _chord_distance(points[:, i_inner], points[:, 0], points[:, 4]))
+            split = dev > tolerance
+        vertices.append(mid[split])
+        segments = np.concatenate((segments[split], mid[split]))
+        size //= 2
+        level += 1
+
+    vertices = np.unique(np.concatenate(vertices))
+    return _lattice_to_param(breaks, vertices, scale), cache(vertices)
+
+
+def surface_triangles(surface, tolerance, max_level=8, min_level=0):
+    """
+    Approximate the surface by a conforming triangle mesh with given chordal deviation.
+    Every patch is refined by a quadtree, the cell is split if the surface point in the cell center deviates from
+    the cell diagonal or any edge midpoint deviates from the edge chord more then the tolerance.
+    :param surface: Surface, Z_Surface (or any object with 'u_basis', 'v_basis' and 'eval_array').
+    :param tolerance: Maximal chordal deviation.
+    :param max_level: Maximal quadtree depth within a patch.
+    :param min_level: Minimal quadtree depth within a patch.
+    :return: (uv_points, points, triangles); UV parameters N x 2, points N x D,
+        triangles M x 3 - indices of the points, counterclockwise in UV.
+    """
+    assert 0 <= min_level <= max_level
+    u_breaks, v_breaks = _breaks(surface.u_basis), _breaks(surface.v_basis)
+    scale = 2 ** max_level
+    n_u, n_v = len(u_breaks) - 1, len(v_breaks) - 1
+    width_u, width_v = n_u * scale + 1, n_v * scale + 1
+    # Lattice: a in [0, n_u * scale], b in [0, n_v * scale], vertex key = a * width_v + b.
+
+    def key_to_uv(keys):
+        a, b = np.divmod(keys, width_v)
+        return np.stack((_lattice_to_param(u_breaks, a, scale), _lattice_to_param(v_breaks, b, scale)), axis=1)
+
+    cache = _PointCache(lambda keys: surface.eval_array(key_to_uv(keys)))
+
+    # Quadtree, all active cells have the same size.
+    a_grid, b_grid = np.meshgrid(np.arange(n_u) * scale, np.arange(n_v) * scale, indexing='ij')
+    cells = np.stack((a_grid.ravel(), b_grid.ravel()), axis=1)
+    size = scale
+    leaves = []
+    # List of (cells, size).
+    level = 0
+    while len(cells) > 0:
+        if size == 1:
+            leaves.append((cells, size))
+            break
+        half = size // 2
+        if level < min_level:
+            split = np.ones(len(cells), dtype=bool)
+        else:
+            # corners, edge midpoints, center
+            offsets = np.array([[0, 0], [size, 0], [size, size], [0, size],
+                                [half, 0], [size, half], [half, size], [0, half],
+                                [half, half]])
+            ab = cells[:, None, :] + offsets[None, :, :]
+            pts = cache(ab[:, :, 0] * width_v + ab[:, :, 1])
+            corners = pts[:, 0:4]
+            # center against the diagonal of the two triangles
+            dev = _chord_distance(pts[:, 8], corners[:, 0], corners[:, 2])
+            for i_edge in range(4):
+                edge_dev = _chord_distance(pts[:, 4 + i_edge], corners[:, i_edge], corners[:, (i_edge + 1) % 4])
+                dev = np.maximum(dev, edge_dev)
+            split = dev > tolerance
+        leaves.append((cells[~split], size))
+        cells = cells[split]
+        cells = np.concatenate([cells + np.array(shift) for shift in [[0, 0], [half, 0], [0, half], [half, half]]])
+        size = half
+        level += 1
+
+    leaf_cells = np.concatenate([c for c, s in leaves])
+    leaf_size = np.concatenate([np.full(len(c), s, dtype=np.int64) for c, s in leaves])
+    triangles = _triangulate_leaves(leaf_cells, leaf_size, width_u, width_v)
+
+    vertices, triangles = np.unique(triangles, return_inverse=True)
+    triangles = triangles.reshape(-1, 3)
+    return key_to_uv(vertices), cache(vertices), triangles
+
+
+def _triangulate_leaves(cells, size, width_u, width_v):
+    """
+    Conforming triangulation of the quadtree leaves.
+    Leaves without hanging vertices are split into two triangles, other leaves are triangulated by the fan from
+    the center through all vertices on the leaf boundary.
+    :param cells: Lower left corners of the leaves, lattice coordinates, array N x 2.
+    :param size: Sizes of the leaves, array N.
+    :param width_u, width_v: Lattice sizes.
+    :return: array M x 3, triangles given by vertex keys (a * width_v + b).
+    """
+    a0, b0 = cells[:, 0], cells[:, 1]
+    a1, b1 = a0 + size, b0 + size
+    corner_a = np.stack((a0, a1, a1, a0), axis=1)
+    corner_b = np.stack((b0, b0, b1, b1), axis=1)
+    # Counterclockwise corners.
+
+    a_vtx, b_vtx = np.divmod(np.unique(corner_a * width_v + corner_b), width_v)
+    # All vertices of the mesh are leaf corners.
+    v_keys = a_vtx * width_v + b_vtx
+    # Vertices sorted along vertical lines.
+    h_keys = np.sort(b_vtx * width_u + a_vtx)
+    # Vertices sorted along horizontal lines.
+    h_sorted = (h_keys % width_u) * width_v + h_keys // width_u
+
+    # Hanging vertices on the edges: bottom, right (forward), top, left (reversed).
+    lo = np.stack((b0 * width_u + a0, a1 * width_v + b0, b1 * width_u + a0, a0 * width_v + b0), axis=1)
+    hi = lo + size[:, None]
+    horizontal = np.array([True, False, True, False])
+    reverse = np.array([False, False, True, True])
+    start = np.where(horizontal, np.searchsorted(h_keys, lo, side='right'), np.searchsorted(v_keys, lo, side='right'))
+    end = np.where(horizontal, np.searchsorted(h_keys, hi, side='left'), np.searchsorted(v_keys, hi, side='left'))
+    n_hanging = end - start
+    n_boundary = 4 + np.sum(n_hanging, axis=1)
+
+    corner_keys = corner_a * width_v + corner_b
+    simple = n_boundary == 4
+    triangles = [corner_keys[simple][:, [0, 1, 2]], corner_keys[simple][:, [0, 2, 3]]]
+
+    # Fans of the leaves with hanging vertices.
+    fan = ~simple
+    if np.any(fan):
+        f_start, f_end = start[fan].ravel(), end[fan].ravel()
+        f_corner = corner_keys[fan].ravel()
+        f_horizontal = np.tile(horizontal, np.sum(fan))
+        f_reverse = np.tile(reverse, np.sum(fan))
+        edges, local = _expand_ranges(np.zeros(len(f_start)), 1 + f_end - f_start)
+        # local == 0 is the starting corner of the edge
+        i_hanging = np.where(f_reverse[edges], f_end[edges] - local, f_start[edges] + local - 1)
+        i_hanging = np.clip(i_hanging, 0, len(v_keys) - 1)
+        boundary = np.where(local == 0, f_corner[edges],
+                            np.where(f_horizontal[edges], h_sorted[i_hanging], v_keys[i_hanging]))
+
+        leaf = edges // 4
+        leaf_begin = np.cumsum(n_boundary[fan]) - n_boundary[fan]
+        next_pos = np.arange(len(boundary)) + 1
+        last = np.append(leaf[1:] != leaf[:-1], True)
+        next_pos[last] = leaf_begin[leaf[last]]
+        half = size[fan] // 2
+        center = (a0[fan] + half) * width_v + b0[fan] + half
+        triangles.append(np.stack((center[leaf], boundary, boundary[next_pos]), axis=1))
+    return np.concatenate(triangles)
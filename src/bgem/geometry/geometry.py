@@ -43,6 +43,7 @@ import math
 
 import bgem.bspline.bspline as bs
 import bgem.bspline.bspline_approx as bs_approx
+import bgem.bspline.bspline_io as bspline_io
 import bgem.bspline.brep_writer as bw
 # def import_plotting():
 # global plt
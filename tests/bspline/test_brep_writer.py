@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from bgem.bspline import brep_writer as bw
 
@@ -144,9 +146,10 @@ class TestPlanarGeomeries(unittest.TestCase):
         loc2=bw.Location([[0,0,1,0],[1,0,0,0],[0,1,0,0]]) #dej tam tu druhou z prikladu
         cloc=bw.ComposedLocation([(loc1,1),(loc2,1)])
 
-        with open("_out_test_prism.brep", "w") as f:
-            bw.write_model(f, c1, cloc)
-            #bw.write_model(sys.stdout, c1, cloc)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "_out_test_prism.brep"), "w") as f:
+                bw.write_model(f, c1, cloc)
+                #bw.write_model(sys.stdout, c1, cloc)
         print(c1)
 
 
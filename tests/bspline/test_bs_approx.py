@@ -1,6 +1,11 @@
 import numpy as np
 from bgem.bspline import bspline as bs, bspline_plot as bs_plot, bspline_approx as bs_approx
 import math
+import pytest
+import scipy.sparse
+import os
+import re
+import sys
 #import matplotlib.pyplot as plt
 #from mpl_toolkits.mplot3d import Axes3D
 import time
@@ -188,6 +193,215 @@ class TestSurfaceApprox:
         print("Approx error: ", approx.error)
         grid_cmp(xyz_func, xyz_grid, 0.02)
 
+    def test_approx_errors(self):
+        np.random.seed(seed=123)
+        xy = np.random.rand(2000, 2)
+        z = np.array([function_sin_cos([u, v]) for u, v in xy])
+        xyz = np.concatenate((xy, z[:, None]), axis=1)
+        approx = bs_approx.SurfaceApprox(xyz)
+        approx.set_quad(None)
+        surface = approx.compute_approximation(nuv=np.array([6, 5]))
+
+        diff = surface.z_eval_xy_array(xy) - z
+        assert approx.point_errors.shape == (len(xy),)
+        assert np.allclose(approx.point_errors, diff)
+        assert np.isclose(approx.error, np.max(np.abs(diff)))
+
+        assert approx.patch_errors.shape == (6, 5)
+        assert np.isclose(np.max(approx.patch_errors), approx.error)
+        iu = np.minimum((xy[:, 0] * 6).astype(int), 5)
+        iv = np.minimum((xy[:, 1] * 5).astype(int), 4)
+        ref_patch_errors = np.zeros((6, 5))
+        np.maximum.at(ref_patch_errors, (iu, iv), np.abs(diff))
+        assert np.allclose(approx.patch_errors, ref_patch_errors)
+
+    def test_approx_stream(self, tmp_path):
+        np.random.seed(seed=123)
+        xy_mat = np.array([[1.0, -1.0, 10], [1.0, 1.0, 20]])
+        uv = np.random.rand(3000, 2)
+        xy = xy_mat[:2, :2].dot(uv.T).T + xy_mat[:, 2]
+        z = np.array([function_sin_cos([u, v]) for u, v in uv])
+        w = 0.5 + np.random.rand(len(z))
+        xyzw = np.concatenate((xy, z[:, None], w[:, None]), axis=1)
+        file_name = str(tmp_path / "points.xyz")
+        np.savetxt(file_name, xyzw)
+
+        approx = bs_approx.SurfaceApprox(xyzw)
+        surface = approx.compute_approximation()
+        stream = bs_approx.SurfaceApprox.approx_from_file(file_name, chunk_size=700)
+        assert isinstance(stream, bs_approx.SurfaceApproxStream)
+        stream_surface = stream.compute_approximation()
+
+        assert np.allclose(stream.quad, approx.quad)
+        assert np.all(stream.nuv == approx.nuv)
+        # regularization weight is estimated by eigsh with a low tolerance
+        assert np.allclose(stream_surface.z_surface.poles, surface.z_surface.poles, atol=1e-5)
+        assert stream.point_errors is None
+        assert np.allclose(stream.patch_errors, approx.patch_errors, atol=1e-5)
+        assert np.isclose(stream.error, approx.error, atol=1e-5)
+
+        # chunks parsed from the text, passes: hull and count, normal equations, errors
+        chunks = list(bs_approx.read_point_chunks(file_name, 700))
+        assert max(len(chunk) for chunk in chunks) <= 700
+        assert np.allclose(np.concatenate(chunks), xyzw)
+        n_passes = [0]
+        def point_chunks():
+            n_passes[0] += 1
+            return iter(chunks)
+        bs_approx.SurfaceApproxStream(point_chunks).compute_approximation()
+        assert n_passes[0] == 3
+
+    def test_load_points(self, tmp_path):
+        np.random.seed(seed=123)
+        points = np.random.rand(500, 4)
+        file_name = str(tmp_path / "points.xyz")
+        np.savetxt(file_name, points)
+
+        # small blocks, lines split between blocks
+        blocks = list(bs_approx._parse_point_blocks(file_name, block_size=1000))
+        assert len(blocks) > 10
+        assert np.array_equal(np.concatenate(blocks), points)
+
+        loaded = bs_approx.load_points(file_name)
+        assert np.array_equal(loaded, points)
+        sidecar = bs_approx._sidecar_name(file_name)
+        assert os.path.exists(sidecar)
+        loaded = bs_approx.load_points(file_name)
+        assert isinstance(loaded, np.memmap)
+        assert np.array_equal(loaded, points)
+        chunks = list(bs_approx.read_point_chunks(file_name, 200))
+        assert [len(c) for c in chunks] == [200, 200, 100]
+        assert np.array_equal(np.concatenate(chunks), points)
+
+        # changed file, the stale sidecar is replaced, unrelated files are kept
+        unrelated = [file_name + suffix for suffix in [".backup-1.npy", ".1-2.npy.bak", ".x.1-2.npy"]]
+        for name in unrelated:
+            with open(name, "wb") as f:
+                np.save(f, points)
+        np.savetxt(file_name, points[:300, :3], fmt="%.10f")
+        loaded = bs_approx.load_points(file_name)
+        assert np.allclose(loaded, points[:300, :3])
+        assert not os.path.exists(sidecar)
+        assert os.path.exists(bs_approx._sidecar_name(file_name))
+        assert all(os.path.exists(name) for name in unrelated)
+        assert not [name for name in os.listdir(str(tmp_path)) if name.endswith(".tmp")]
+
+        approx = bs_approx.SurfaceApprox.approx_from_file(file_name)
+        assert approx._n_points == 300
+
+        # malformed files, error reports the block
+        bad_name = str(tmp_path / "bad.xyz")
+        with open(bad_name, "w") as f:
+            f.write("1 2 3\n" * 100 + "4 5\n")
+        with pytest.raises(ValueError, match="block at byte 0"):
+            list(bs_approx._parse_point_blocks(bad_name))
+        with pytest.raises(ValueError) as err:
+            list(bs_approx._parse_point_blocks(bad_name, block_size=10))
+        # the block containing the last line
+        block_offset = int(re.search(r"block at byte (\d+)", str(err.value)).group(1))
+        assert 580 < block_offset <= 600
+        with open(bad_name, "w") as f:
+            f.write("1 2 3\n4 x 6\n")
+        with pytest.raises(ValueError, match="Invalid value"):
+            bs_approx.load_points(bad_name)
+
+    def test_approx_parallel(self, monkeypatch):
+        np.random.seed(seed=123)
+        xy = np.random.rand(5000, 2)
+        z = np.array([function_sin_cos([u, v]) for u, v in xy])
+        w = 0.5 + np.random.rand(len(z))
+        xyzw = np.concatenate((xy, z[:, None], w[:, None]), axis=1)
+        monkeypatch.setattr(bs, "EVAL_CHUNK_SIZE", 700)
+
+        approx = bs_approx.SurfaceApprox(xyzw)
+        approx.set_quad(None)
+        approx.nuv = np.array([12, 9])
+        approx._compute_uv_points()
+        approx._u_basis = bs.SplineBasis.make_equidistant(2, 12)
+        approx._v_basis = bs.SplineBasis.make_equidistant(2, 9)
+        mat, vec, point_loc = approx._build_system_of_normal_equations()
+        approx.n_workers = 3
+        par_mat, par_vec, par_point_loc = approx._build_system_of_normal_equations()
+        assert np.allclose(par_mat.toarray(), mat.toarray(), rtol=0, atol=1e-12)
+        assert np.allclose(par_vec, vec, rtol=0, atol=1e-12)
+        assert np.array_equal(par_point_loc, point_loc)
+
+        # no shared memory (Python < 3.8), serial fallback
+        with monkeypatch.context() as m:
+            m.setitem(sys.modules, "multiprocessing.shared_memory", None)
+            fallback_mat, fallback_vec, fallback_point_loc = approx._build_system_of_normal_equations()
+        assert np.allclose(fallback_mat.toarray(), mat.toarray(), rtol=0, atol=1e-12)
+        assert np.allclose(fallback_vec, vec, rtol=0, atol=1e-12)
+        assert np.array_equal(fallback_point_loc, point_loc)
+
+        surface = approx.compute_approximation(n_workers=2)
+        assert np.allclose(surface.z_eval_xy_array(xy) - z, approx.point_errors)
+
+    @pytest.mark.parametrize("degrees", [(3, 1), (1, 2)])
+    def test_normal_equations_degree(self, degrees):
+        # local blocks sized by the degrees of the bases
+        np.random.seed(seed=123)
+        xyzw = np.concatenate((np.random.rand(2000, 3), 0.5 + np.random.rand(2000, 1)), axis=1)
+        approx = bs_approx.SurfaceApprox(xyzw)
+        approx.set_quad(None)
+        approx._compute_uv_points()
+        approx._u_basis = bs.SplineBasis.make_equidistant(degrees[0], 5)
+        approx._v_basis = bs.SplineBasis.make_equidistant(degrees[1], 4)
+        uv, z, w = approx._uv_quad_points, approx._z_quad_points, approx._w_quad_points
+        u_mat = approx._u_basis.collocation_matrix(uv[:, 0]).toarray()
+        v_mat = approx._v_basis.collocation_matrix(uv[:, 1]).toarray()
+        b_mat = (v_mat[:, :, None] * u_mat[:, None, :]).reshape(len(uv), -1)
+        for n_workers in [1, 2]:
+            approx.n_workers = n_workers
+            mat, vec, point_loc = approx._build_system_of_normal_equations()
+            assert np.allclose(mat.toarray(), b_mat.T @ (w[:, None] * b_mat))
+            assert np.allclose(vec, b_mat.T @ (w * z))
+
+    def test_approx_solver(self):
+        np.random.seed(seed=123)
+        xy = np.random.rand(5000, 2)
+        z = np.array([function_sin_cos([u, v]) for u, v in xy])
+        xyz = np.concatenate((xy, z[:, None]), axis=1)
+        nuv = np.array([20, 15])
+        approx = bs_approx.SurfaceApprox(xyz)
+        approx.set_quad(None)
+        ref_poles = approx.compute_approximation(nuv=nuv).z_surface.poles
+
+        preconditioners = ['jacobi', 'ilu']
+        if bs_approx.pyamg is not None:
+            preconditioners.append('amg')
+        cold_iterations = {}
+        for preconditioner in preconditioners:
+            approx = bs_approx.SurfaceApprox(xyz)
+            approx.set_quad(None)
+            surface = approx.compute_approximation(nuv=nuv, solver='cg', preconditioner=preconditioner)
+            assert np.allclose(surface.z_surface.poles, ref_poles, atol=1e-5)
+            cold_iterations[preconditioner] = approx.solver_iterations
+
+            # warm start from the previous result
+            approx.compute_approximation(regularization_weight=0.0012)
+            assert approx.solver_iterations < cold_iterations[preconditioner]
+
+        # warm start from a coarser approximation
+        approx = bs_approx.SurfaceApprox(xyz)
+        approx.set_quad(None)
+        coarse = approx.compute_approximation(nuv=nuv // 2)
+        approx.compute_approximation(nuv=nuv, solver='cg', preconditioner='jacobi', initial_surface=coarse)
+        assert approx.solver_iterations < cold_iterations['jacobi']
+        assert np.allclose(approx.surface.z_surface.poles, ref_poles, atol=1e-5)
+
+        with pytest.raises(Exception):
+            approx.compute_approximation(solver='unknown')
+
+        # relative tolerance only, a tiny right hand side is solved as well
+        c_mat = scipy.sparse.diags([-1.0, 2.5, -1.0], [-1, 0, 1], shape=(50, 50), format='csr')
+        rhs = 1e-12 * np.random.rand(50)
+        approx.solver, approx.preconditioner, approx.solver_tol = 'cg', 'jacobi', 1e-10
+        approx.initial_surface = None
+        approx.surface, approx._z_vec = None, None
+        z_vec = approx._solve(c_mat, rhs)
+        assert np.linalg.norm(c_mat @ z_vec - rhs) <= 1e-10 * np.linalg.norm(rhs)
+
 
     # def test_transformed_quad(self):
     #     xy_mat = np.array( [ [1.0, -1.0, 0 ], [1.0, 1.0, 0 ]])    # rotate left pi/4 and blow up 1.44
@@ -229,6 +443,27 @@ class TestSurfaceApprox:
     #     # B matrix 3.6 sec, A matrix 0.7 sec, SVD + Z solve 0.7 sec
 
 class TestBoundingBox:
+    def test_hull_degenerate(self):
+        # points on the hull edges, repeated points, merged hulls
+        square = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+        t = np.linspace(0, 1, 11)[:, None]
+        edges = np.concatenate([a + t * (b - a) for a, b in zip(square, np.roll(square, -1, axis=0))])
+        points = np.concatenate((edges, edges, 0.1 + 0.8 * np.random.rand(100, 2)))
+        hull = bs_approx.convex_hull_2d(points)
+        assert len(hull) == 5
+        assert np.array_equal(np.unique(hull, axis=0), np.unique(square, axis=0))
+        merged = bs_approx.convex_hull_2d(np.concatenate((hull, hull, points[:50])))
+        assert np.array_equal(np.unique(merged, axis=0), np.unique(square, axis=0))
+        # tiny coordinates
+        assert len(bs_approx.convex_hull_2d(1e-12 * points)) == 5
+
+        # hull merged with itself and inner points (streaming), recursed without end before the tolerance
+        np.random.seed(0)
+        points = np.random.randn(1000, 2)
+        hull = bs_approx.convex_hull_2d(points)
+        merged = bs_approx.convex_hull_2d(np.concatenate((hull, hull, points[:50])))
+        assert np.array_equal(np.unique(merged, axis=0), np.unique(hull, axis=0))
+
     def test_hull_and_box(self):
         points = np.random.randn(1000000,2)
 
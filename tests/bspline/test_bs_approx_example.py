@@ -62,11 +62,10 @@ def verify_approximation(func, surf):
     plt.scatter_3d(xyz_func[:,0], xyz_func[:,1], xyz_func[:,2])
     plt.show()
 
-def test_grid_approx_example():
+def test_grid_approx_example(tmp_path):
     nuv = (50, 50)
-    os.chdir(script_dir)
     # Create an input grid file.
-    grid_path = "_grid_data.xyz"
+    grid_path = os.path.join(str(tmp_path), "_grid_data.xyz")
     make_a_test_grid(grid_path, function_sin_cos, nuv)
 
     # Make an approximation.
@@ -95,7 +94,7 @@ def test_grid_approx_example():
 
 # Replace call through the pytest, allow execution as a script.
 if __name__ == "__main__":
-    test_grid_approx_example()
+    test_grid_approx_example(script_dir)
 
 
     # def gen_uv_grid(nu, nv):
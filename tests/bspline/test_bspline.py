@@ -1,6 +1,7 @@
-from bgem.bspline import bspline as bs, bspline_plot as bp
+from bgem.bspline import bspline as bs, bspline_plot as bp, brep_writer as bw
 import numpy as np
 import math
+import pytest
 
 import matplotlib.pyplot as plt
 
@@ -117,7 +118,7 @@ class TestSplineBasis:
     def check_eval_vec(self, basis, i, t):
         vec = basis.eval_vector(i, t)
         for j in range(basis.degree + 1):
-            assert vec[j] == basis.eval(i + j, t)
+            assert np.abs(vec[j] - basis.eval(i + j, t)) < 1e-15
 
     def plot_basis_vec(self, basis):
         n_points = 401
@@ -153,6 +154,49 @@ class TestSplineBasis:
 
 
 
+    def test_eval_vector_array(self):
+        knots = np.array([0, 0, 0, 0.1880192, 0.24545785, 0.51219762, 0.82239001, 1., 1. , 1.])
+        bases = [bs.SplineBasis(2, knots)] + [bs.SplineBasis.make_equidistant(deg, 5) for deg in range(0, 5)]
+        for basis in bases:
+            t_points = np.linspace(basis.domain[0], basis.domain[1], 33)
+            i_base = basis.find_knot_interval_array(t_points)
+            assert np.all(i_base == [basis.find_knot_interval(t) for t in t_points])
+            values = basis.eval_vector_array(i_base, t_points)
+            assert values.shape == (len(t_points), basis.degree + 1)
+            for i, t, vec in zip(i_base, t_points, values):
+                ref = [basis.eval(i + j, t) for j in range(basis.degree + 1)]
+                assert np.allclose(vec, ref, rtol=0, atol=1e-14)
+
+        basis = bs.SplineBasis.make_equidistant(2, 4)
+        assert np.allclose(basis.check_array([-1e-15, 0.5, 1.0 + 1e-15]), [0.0, 0.5, 1.0])
+        with pytest.raises(IndexError):
+            basis.check_array([0.5, 1.1])
+
+    def test_eval_ders_vector(self):
+        knots = np.array([0, 0, 0, 0, 0.1880192, 0.24545785, 0.51219762, 0.82239001, 1., 1., 1., 1.])
+        bases = [bs.SplineBasis(3, knots)] + [bs.SplineBasis.make_equidistant(deg, 4) for deg in range(0, 6)]
+        for basis in bases:
+            t_points = np.linspace(basis.domain[0], basis.domain[1], 17)
+            i_base = basis.find_knot_interval_array(t_points)
+            ders_array = basis.eval_ders_vector_array(i_base, t_points, 3)
+            h = 1e-6
+            for i, t, ders_arr in zip(i_base, t_points, ders_array):
+                ders = basis.eval_ders_vector(i, t, 3)
+                assert ders.shape == (4, basis.degree + 1)
+                assert np.allclose(ders, ders_arr, rtol=0, atol=1e-12)
+                ref = [basis.eval(i + j, t) for j in range(basis.degree + 1)]
+                assert np.allclose(ders[0], ref, rtol=0, atol=1e-14)
+                if basis.degree > 0:
+                    ref_diff = [basis.eval_diff(i + j, t) for j in range(basis.degree + 1)]
+                    assert np.allclose(ders[1], ref_diff, rtol=0, atol=1e-12)
+                else:
+                    assert np.all(ders[1:] == 0.0)
+                # higher derivatives by central differences of the lower ones, inside of the interval
+                t_min, t_max = basis.knot_interval_bounds(i)
+                if basis.degree > 1 and t_min + h < t < t_max - h:
+                    fd = (basis.eval_ders_vector(i, t + h, 3) - basis.eval_ders_vector(i, t - h, 3)) / (2 * h)
+                    assert np.allclose(ders[2:], fd[1:3], rtol=1e-5, atol=1e-4)
+
     def check_diff_vec(self, basis, i, t):
         vec = basis.eval_diff_vector(i, t)
         for j in range(basis.degree + 1):
@@ -216,6 +260,164 @@ class TestCurve:
 
         pass
 
+    def test_eval_array(self):
+        poles = [ [0., 0.], [1.0, 0.5], [2., -2.], [3., 1.], [4., 0.] ]
+        for degree in [1, 2, 3]:
+            basis = bs.SplineBasis.make_equidistant(degree, 5 - degree)
+            curve = bs.Curve(basis, poles)
+            t_points = np.linspace(0, 1, 41)
+            ref = np.array([curve.eval(t) for t in t_points])
+            assert np.allclose(curve.eval_array(t_points), ref, rtol=0, atol=1e-14)
+        assert curve.eval_array(np.array([])).shape == (0, 2)
+
+        # quarter of the unit circle as a rational curve
+        w = np.sqrt(2) / 2
+        poles = [ [1., 0., 1.], [1., 1., w], [0., 1., 1.] ]
+        basis = bs.SplineBasis.make_equidistant(2, 1)
+        curve = bs.Curve(basis, poles, rational=True)
+        t_points = np.linspace(0, 1, 21)
+        xy = curve.eval_array(t_points)
+        assert np.allclose(np.linalg.norm(xy, axis=1), 1.0)
+        assert np.allclose(xy, np.array([curve.eval(t) for t in t_points]))
+
+        # chunks in parallel threads
+        t_points = np.random.RandomState(2).rand(1000)
+        ref = curve.eval_array(t_points)
+        assert np.array_equal(curve.eval_array(t_points, n_workers=3, chunk_size=77), ref)
+        assert np.array_equal(curve.eval_array(t_points, n_workers=1, chunk_size=100), ref)
+
+    def test_eval_derivs(self):
+        poles = [ [0., 0.], [1.0, 0.5], [2., -2.], [3., 1.], [4., 0.] ]
+        weights = [ [1.0], [0.7], [1.5], [1.2], [0.8] ]
+        basis = bs.SplineBasis.make_equidistant(3, 2)
+        # avoid knots, where the third derivative jumps
+        t_points = np.linspace(0.03, 0.97, 12)
+        h = 1e-5
+        for rational in [False, True]:
+            curve_poles = np.concatenate((poles, weights), axis=1) if rational else poles
+            curve = bs.Curve(basis, curve_poles, rational=rational)
+            ders = curve.eval_derivs(t_points, 2)
+            assert ders.shape == (12, 3, 2)
+            assert np.allclose(ders[:, 0, :], curve.eval_array(t_points))
+            fd = (curve.eval_derivs(t_points + h, 1) - curve.eval_derivs(t_points - h, 1)) / (2 * h)
+            assert np.allclose(ders[:, 1:, :], fd, rtol=1e-5, atol=1e-4)
+
+        # tangent of the circle is perpendicular to the radius
+        w = np.sqrt(2) / 2
+        curve = bs.Curve(bs.SplineBasis.make_equidistant(2, 1), [ [1., 0., 1.], [1., 1., w], [0., 1., 1.] ], rational=True)
+        xy = curve.eval_array(t_points)
+        tangents = curve.eval_tangents(t_points)
+        assert np.allclose(np.sum(xy * tangents, axis=1), 0.0)
+        assert np.allclose(np.linalg.norm(tangents, axis=1), 1.0)
+
+    def test_bezier(self):
+        poles = [ [0., 0., 1.0], [1.0, 0.5, 0.7], [2., -2., 1.5], [3., 1., 1.2], [4., 0., 0.8], [5., 1., 1.0], [6., 0., 1.0] ]
+        # double knot at 0.5
+        basis = bs.SplineBasis.make_from_packed_knots(3, [(0.0, 4), (0.25, 1), (0.5, 2), (1.0, 4)])
+        t_points = np.random.RandomState(6).rand(40)
+        it_points = basis.find_knot_interval_array(t_points)
+        for rational in [False, True]:
+            curve_poles = np.array(poles) if rational else np.array(poles)[:, 0:2]
+            curve = bs.Curve(basis, curve_poles, rational=rational)
+            # empty interval (0.5, 0.5) included
+            assert curve.bezier_poles.shape == (4, 4, 2 + rational)
+            xy = curve.eval_array(t_points)
+            assert np.allclose(curve.eval_bezier_local(t_points, it_points), xy, rtol=0, atol=1e-14)
+            # segment ends interpolate the curve
+            assert np.allclose(curve.bezier_poles[[0, 1, 3], 0, 0:2], curve.eval_array([0.0, 0.25, 0.5]))
+            boxes = curve.bezier_boxes[it_points]
+            assert np.all(boxes[:, 0, :] <= xy) and np.all(xy <= boxes[:, 1, :])
+        # Bezier segment boxes are within the pole window boxes
+        for it in range(basis.n_intervals):
+            window = curve.poles[it: it + 4, 0:2]
+            assert np.all(curve.bezier_boxes[it, 0] >= np.amin(window, axis=0))
+            assert np.all(curve.bezier_boxes[it, 1] <= np.amax(window, axis=0))
+
+    def test_knot_insertion(self):
+        poles = [ [0., 0., 1.0], [1.0, 0.5, 0.7], [2., -2., 1.5], [3., 1., 1.2], [4., 0., 0.8], [5., 1., 1.0] ]
+        basis = bs.SplineBasis.make_from_packed_knots(2, [(0.0, 3), (0.3, 1), (0.6, 2), (1.0, 3)])
+        t_points = np.linspace(0, 1, 41)
+        for rational in [False, True]:
+            curve_poles = np.array(poles) if rational else np.array(poles)[:, 0:2]
+            curve = bs.Curve(basis, curve_poles, rational=rational)
+            xy = curve.eval_array(t_points)
+
+            curve_ins = curve.insert_knot(0.45, 2)
+            assert curve_ins.basis.pack_knots() == [(0.0, 3), (0.3, 1), (0.45, 2), (0.6, 2), (1.0, 3)]
+            assert np.allclose(curve_ins.eval_array(t_points), xy, rtol=0, atol=1e-14)
+
+            curve_ref = curve.refine([0.8, 0.1, 0.3, 0.8])
+            assert curve_ref.basis.size == basis.size + 4
+            assert np.allclose(curve_ref.eval_array(t_points), xy, rtol=0, atol=1e-14)
+
+            curve_elev = curve.elevate_degree(2)
+            assert curve_elev.basis.degree == 4
+            assert curve_elev.basis.pack_knots() == [(0.0, 5), (0.3, 3), (0.6, 4), (1.0, 5)]
+            assert np.allclose(curve_elev.eval_array(t_points), xy, rtol=0, atol=1e-13)
+
+            # interior knot of multiplicity degree + 1
+            with pytest.raises(AssertionError):
+                bs.SplineBasis(1, [0, 0, 0.2, 0.5, 0.5, 0.7, 1, 1]).elevate_degree(np.zeros(6))
+
+            for t_split in [0.3, 0.6, 0.75]:
+                left, right = curve.split(t_split)
+                assert np.allclose(left.basis.domain, [0.0, t_split])
+                assert np.allclose(right.basis.domain, [t_split, 1.0])
+                i_split = np.searchsorted(t_points, t_split)
+                assert np.allclose(left.eval_array(t_points[:i_split]), xy[:i_split], rtol=0, atol=1e-14)
+                assert np.allclose(right.eval_array(t_points[i_split:]), xy[i_split:], rtol=0, atol=1e-14)
+
+    def test_arc_length(self):
+        # straight line with nonuniform parametrization
+        basis = bs.SplineBasis.make_equidistant(2, 3)
+        poles = np.outer([0.0, 0.1, 0.2, 1.5, 2.0], [3.0, 4.0])
+        line = bs.Curve(basis, poles)
+        assert np.isclose(line.length(), 10.0)
+        t_points = line.equal_length_params(11)
+        points = line.eval_array(t_points)
+        assert np.allclose(np.linalg.norm(np.diff(points, axis=0), axis=1), 1.0)
+        assert np.allclose(line.arc_length(t_points), np.linspace(0, 10, 11))
+
+        # quarter of a circle
+        circle = bs.Curve(bs.SplineBasis(2, [0, 0, 0, 1, 1, 1]),
+                          np.array([[1, 0, 1], [1, 1, np.sqrt(0.5)], [0, 1, 1]]), rational=True)
+        assert np.isclose(circle.length(), np.pi / 2, rtol=1e-10)
+        t_points = circle.equal_length_params(7)
+        angles = np.arctan2(*circle.eval_array(t_points).T[::-1])
+        assert np.allclose(angles, np.linspace(0, np.pi / 2, 7))
+
+        # wiggly curve, inverse mapping
+        random = np.random.RandomState(3)
+        basis = bs.SplineBasis.make_equidistant(3, 6)
+        curve = bs.Curve(basis, random.rand(basis.size, 3))
+        t_points = np.sort(random.rand(50))
+        s_points = curve.arc_length(t_points)
+        assert np.all(np.diff(s_points) > 0)
+        assert np.allclose(curve.t_at_length(s_points), t_points, atol=1e-10)
+        fine_t = np.linspace(0, 1, 100001)
+        polyline_length = np.sum(np.linalg.norm(np.diff(curve.eval_array(fine_t), axis=0), axis=1))
+        assert np.isclose(curve.length(), polyline_length, rtol=1e-8)
+
+    def test_project_points(self):
+        # quarter of the unit circle
+        w = np.sqrt(2) / 2
+        curve = bs.Curve(bs.SplineBasis.make_equidistant(2, 1), [ [1., 0., 1.], [1., 1., w], [0., 1., 1.] ], rational=True)
+        curve = curve.refine([0.3, 0.6])
+        angles = np.random.RandomState(12).rand(30) * np.pi / 2
+        radii = 0.5 + np.random.RandomState(13).rand(30)
+        points = radii[:, None] * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+        t_points, dist, intervals = curve.project_points(points)
+        assert np.allclose(dist, np.abs(radii - 1.0))
+        xy = curve.eval_array(t_points)
+        assert np.allclose(xy, points / radii[:, None])
+        assert np.all(intervals == curve.basis.find_knot_interval_array(t_points))
+
+        # points outside of the arc project to its ends
+        t_points, dist, intervals = curve.project_points([[2.0, -1.0], [-1.0, 3.0]])
+        assert np.allclose(t_points, [0.0, 1.0])
+        assert np.allclose(dist, [np.sqrt(2), np.sqrt(5)])
+        assert intervals.tolist() == [0, 2]
+
     def test_aabb(self):
         poles = [ [0., 0.], [1.0, 0.5], [2., -2.], [3., 1.] ]
         basis = bs.SplineBasis.make_equidistant(2, 2)
@@ -231,6 +433,66 @@ class TestCurve:
 
 
 
+class TestCurveSet:
+
+    def test_eval_array(self):
+        random = np.random.RandomState(5)
+        # common basis
+        basis = bs.SplineBasis.make_equidistant(2, 5)
+        curves = [bs.Curve(basis, random.rand(basis.size, 3)) for k in range(4)]
+        curve_set = bs.CurveSet.from_curves(curves)
+        assert curve_set.basis is not None
+        t_points = np.linspace(0, 1, 23)
+        points = curve_set.eval_array(t_points)
+        assert points.shape == (4, 23, 3)
+        for curve, curve_points in zip(curves, points):
+            assert np.allclose(curve_points, curve.eval_array(t_points))
+
+        # different knots and number of poles, rational curves, parameters per curve
+        knot_vectors = [[0, 0, 0, 0.5, 1, 1, 1], [0, 0, 0, 0.2, 0.2, 0.7, 1, 1, 1], [1, 1, 1, 2, 3, 4, 4, 4]]
+        curves = []
+        for k, knots in enumerate(knot_vectors):
+            basis = bs.SplineBasis(2, knots)
+            rational = (k == 1)
+            poles = random.rand(basis.size, 2 + rational) + rational
+            curves.append(bs.Curve(basis, poles, rational))
+        curve_set = bs.CurveSet.from_curves(curves)
+        assert curve_set.basis is None and curve_set.rational
+        assert curve_set.poles.shape == (3, 6, 3)
+        t_points = curve_set.domain[:, 0, None] + np.linspace(0, 1, 17) * np.diff(curve_set.domain, axis=1)
+        points = curve_set.eval_array(t_points)
+        for curve, curve_t, curve_points in zip(curves, t_points, points):
+            assert np.allclose(curve_points, curve.eval_array(curve_t))
+        with pytest.raises(IndexError):
+            curve_set.eval_array(np.full((3, 2), 2.5))
+        # spans of the points, including the points at the knots
+        t_points = np.concatenate((t_points, curve_set.knots), axis=1)
+        spans = curve_set._find_spans(t_points)
+        for knots, curve_t, curve_spans in zip(curve_set.knots, t_points, spans):
+            assert np.all(curve_spans == np.searchsorted(knots, curve_t, side='right') - 1)
+
+        # packed construction with a shared knot vector
+        poles = random.rand(10, 4, 2)
+        curve_set = bs.CurveSet(3, [0, 0, 0, 0, 1, 1, 1, 1], poles)
+        assert np.allclose(curve_set.eval_array([0.0, 1.0]), poles[:, [0, 3], :])
+
+    def test_export(self):
+        random = np.random.RandomState(6)
+        basis = bs.SplineBasis.make_equidistant(2, 3)
+        for dim, bw_curve_cls in [(2, bw.Curve2D), (3, bw.Curve3D)]:
+            curves = [bs.Curve(basis, random.rand(basis.size, dim)) for k in range(3)]
+            curve_set = bs.CurveSet.from_curves(curves)
+            for curve, set_curve in zip(curves, curve_set.curves()):
+                assert np.allclose(set_curve.poles, curve.poles)
+                assert np.allclose(set_curve.basis.knots, curve.basis.knots)
+            bw_curves = bw.curves_from_bs_set(curve_set)
+            assert len(bw_curves) == 3
+            for curve, bw_curve in zip(curves, bw_curves):
+                assert isinstance(bw_curve, bw_curve_cls)
+                assert bw_curve.knots == curve.basis.pack_knots()
+                assert np.allclose(bw_curve.poles, curve.poles)
+
+
 class TestSurface:
 
     def plot_extrude(self):
@@ -267,6 +529,182 @@ class TestSurface:
         pass
 
 
+    def test_eval_array(self):
+        def function(x):
+            return math.sin(x[0] * 4) * math.cos(x[1] * 4)
+
+        poles = bs.make_function_grid(function, 5, 6)
+        for u_deg, v_deg in [(2, 2), (1, 3), (3, 2)]:
+            u_basis = bs.SplineBasis.make_equidistant(u_deg, 5 - u_deg)
+            v_basis = bs.SplineBasis.make_equidistant(v_deg, 6 - v_deg)
+            surface = bs.Surface((u_basis, v_basis), poles)
+            uv_points = np.random.RandomState(1).rand(50, 2)
+            uv_points[0:4] = [[0, 0], [1, 0], [0, 1], [1, 1]]
+            ref = np.array([surface.eval(u, v) for u, v in uv_points])
+            assert np.allclose(surface.eval_array(uv_points), ref, rtol=0, atol=1e-14)
+            assert np.allclose(surface.eval_array(uv_points, n_workers=4, chunk_size=7), ref, rtol=0, atol=1e-14)
+
+        # quarter of the unit cylinder as a rational surface
+        w = np.sqrt(2) / 2
+        poles = [ [ [1., 0., z, 1.] for z in (0., 1.) ],
+                  [ [1., 1., z, w] for z in (0., 1.) ],
+                  [ [0., 1., z, 1.] for z in (0., 1.) ] ]
+        u_basis = bs.SplineBasis.make_equidistant(2, 1)
+        v_basis = bs.SplineBasis.make_equidistant(1, 1)
+        surface = bs.Surface((u_basis, v_basis), poles, rational=True)
+        uv_points = np.random.RandomState(2).rand(30, 2)
+        xyz = surface.eval_array(uv_points)
+        assert np.allclose(np.linalg.norm(xyz[:, 0:2], axis=1), 1.0)
+        assert np.allclose(xyz[:, 2], uv_points[:, 1])
+        assert np.allclose(xyz, np.array([surface.eval(u, v) for u, v in uv_points]))
+
+    def test_eval_derivs(self):
+        def function(x):
+            return math.sin(x[0] * 4) * math.cos(x[1] * 4)
+
+        poles = bs.make_function_grid(function, 5, 6)
+        weights = 1.0 + 0.5 * np.random.RandomState(4).rand(5, 6, 1)
+        u_basis = bs.SplineBasis.make_equidistant(3, 2)
+        v_basis = bs.SplineBasis.make_equidistant(2, 4)
+        uv_points = 0.05 + 0.9 * np.random.RandomState(5).rand(20, 2)
+        h = 1e-5
+        du, dv = np.array([h, 0]), np.array([0, h])
+        for rational in [False, True]:
+            surf_poles = np.concatenate((poles, weights), axis=2) if rational else poles
+            surface = bs.Surface((u_basis, v_basis), surf_poles, rational=rational)
+            ders = surface.eval_derivs(uv_points, 2)
+            assert ders.shape == (20, 3, 3, 3)
+            assert np.allclose(ders[:, 0, 0, :], surface.eval_array(uv_points))
+            fd_u = (surface.eval_derivs(uv_points + du, 1) - surface.eval_derivs(uv_points - du, 1)) / (2 * h)
+            fd_v = (surface.eval_derivs(uv_points + dv, 1) - surface.eval_derivs(uv_points - dv, 1)) / (2 * h)
+            assert np.allclose(ders[:, 1:, 0:2, :], fd_u, rtol=1e-5, atol=1e-4)
+            assert np.allclose(ders[:, 0:2, 1:, :], fd_v, rtol=1e-5, atol=1e-4)
+
+        # normals of the cylinder are radial
+        w = np.sqrt(2) / 2
+        poles = [ [ [1., 0., z, 1.] for z in (0., 1.) ],
+                  [ [1., 1., z, w] for z in (0., 1.) ],
+                  [ [0., 1., z, 1.] for z in (0., 1.) ] ]
+        surface = bs.Surface((bs.SplineBasis.make_equidistant(2, 1), bs.SplineBasis.make_equidistant(1, 1)),
+                             poles, rational=True)
+        normals = surface.eval_normals(uv_points)
+        xyz = surface.eval_array(uv_points)
+        assert np.allclose(normals[:, 2], 0.0)
+        assert np.allclose(np.abs(np.sum(normals[:, 0:2] * xyz[:, 0:2], axis=1)), 1.0)
+
+    def test_eval_grid(self):
+        def function(x):
+            return math.sin(x[0] * 4) * math.cos(x[1] * 4)
+
+        poles = bs.make_function_grid(function, 5, 6)
+        u_basis = bs.SplineBasis.make_equidistant(3, 2)
+        v_basis = bs.SplineBasis.make_equidistant(2, 4)
+        u_points = np.linspace(0, 1, 7)
+        v_points = np.linspace(0, 1, 9)
+        V, U = np.meshgrid(v_points, u_points)
+        uv_points = np.stack([U.ravel(), V.ravel()], axis=1)
+        for rational in [False, True]:
+            surf_poles = poles
+            if rational:
+                weights = 1.0 + 0.5 * np.random.RandomState(3).rand(5, 6, 1)
+                surf_poles = np.concatenate((poles, weights), axis=2)
+            surface = bs.Surface((u_basis, v_basis), surf_poles, rational=rational)
+            xyz = surface.eval_grid(u_points, v_points)
+            assert xyz.shape == (7, 9, 3)
+            assert np.allclose(xyz, surface.eval_array(uv_points).reshape(7, 9, 3), rtol=0, atol=1e-14)
+
+    def test_bezier(self):
+        def function(x):
+            return math.sin(x[0] * 4) * math.cos(x[1] * 4)
+
+        poles = bs.make_function_grid(function, 5, 6)
+        weights = 1.0 + 0.5 * np.random.RandomState(7).rand(5, 6, 1)
+        u_basis = bs.SplineBasis.make_equidistant(3, 2)
+        v_basis = bs.SplineBasis.make_from_packed_knots(2, [(0.0, 3), (0.3, 1), (0.6, 2), (1.0, 3)])
+        uv_points = np.random.RandomState(8).rand(50, 2)
+        iuv_points = np.stack((u_basis.find_knot_interval_array(uv_points[:, 0]),
+                               v_basis.find_knot_interval_array(uv_points[:, 1])), axis=1)
+        for rational in [False, True]:
+            surf_poles = np.concatenate((poles, weights), axis=2) if rational else poles
+            surface = bs.Surface((u_basis, v_basis), surf_poles, rational=rational)
+            assert surface.bezier_poles.shape == (2 * 4, 4, 3, 3 + rational)
+            xyz = surface.eval_array(uv_points)
+            assert np.allclose(surface.eval_bezier_local(uv_points, iuv_points), xyz, rtol=0, atol=1e-14)
+            boxes = surface.bezier_boxes[surface.patch_pos2id(iuv_points[:, 0], iuv_points[:, 1])]
+            assert np.all(boxes[:, 0, :] <= xyz + 1e-14) and np.all(xyz <= boxes[:, 1, :] + 1e-14)
+        # patch corners interpolate the surface
+        iu, iv = surface.patch_id2pos(4)
+        u_min = u_basis.knot_interval_bounds(iu)[0]
+        v_min = v_basis.knot_interval_bounds(iv)[0]
+        assert np.allclose(surface.bezier_poles[4, 0, 0, 0:3], surface.eval(u_min, v_min))
+
+    def test_knot_insertion(self):
+        def function(x):
+            return math.sin(x[0] * 4) * math.cos(x[1] * 4)
+
+        poles = bs.make_function_grid(function, 5, 6)
+        weights = 1.0 + 0.5 * np.random.RandomState(9).rand(5, 6, 1)
+        u_basis = bs.SplineBasis.make_equidistant(3, 2)
+        v_basis = bs.SplineBasis.make_equidistant(2, 4)
+        uv_points = np.random.RandomState(10).rand(50, 2)
+        for rational in [False, True]:
+            surf_poles = np.concatenate((poles, weights), axis=2) if rational else poles
+            surface = bs.Surface((u_basis, v_basis), surf_poles, rational=rational)
+            xyz = surface.eval_array(uv_points)
+
+            surf_ins = surface.insert_knot(0.4, axis=1, mult=2)
+            assert surf_ins.poles.shape == (5, 8, 3 + rational)
+            assert np.allclose(surf_ins.eval_array(uv_points), xyz, rtol=0, atol=1e-14)
+
+            surf_ref = surface.refine([0.2, 0.7], [0.1])
+            assert surf_ref.poles.shape == (7, 7, 3 + rational)
+            assert np.allclose(surf_ref.eval_array(uv_points), xyz, rtol=0, atol=1e-14)
+
+            surf_elev = surface.elevate_degree(1, 2)
+            assert (surf_elev.u_basis.degree, surf_elev.v_basis.degree) == (4, 4)
+            assert np.allclose(surf_elev.eval_array(uv_points), xyz, rtol=0, atol=1e-13)
+
+            for axis in [0, 1]:
+                low, high = surface.split(0.6, axis)
+                is_low = uv_points[:, axis] <= 0.6
+                assert np.allclose(low.eval_array(uv_points[is_low]), xyz[is_low], rtol=0, atol=1e-14)
+                assert np.allclose(high.eval_array(uv_points[~is_low]), xyz[~is_low], rtol=0, atol=1e-14)
+
+    def test_project_points(self):
+        def function(x):
+            return math.sin(x[0] * 4) * math.cos(x[1] * 4)
+
+        poles = bs.make_function_grid(function, 8, 7)
+        surface = bs.Surface((bs.SplineBasis.make_equidistant(2, 6), bs.SplineBasis.make_equidistant(3, 4)), poles)
+        uv_points = 0.05 + 0.9 * np.random.RandomState(14).rand(200, 2)
+        points = surface.eval_array(uv_points) + 0.05 * surface.eval_normals(uv_points)
+        uv_proj, dist, patch_ids = surface.project_points(points)
+        assert np.allclose(uv_proj, uv_points, atol=1e-8)
+        assert np.allclose(dist, 0.05)
+        iu = surface.u_basis.find_knot_interval_array(uv_proj[:, 0])
+        iv = surface.v_basis.find_knot_interval_array(uv_proj[:, 1])
+        assert np.all(patch_ids == surface.patch_pos2id(iu, iv))
+
+        # general points, compare with fine sampling
+        points = np.random.RandomState(15).rand(100, 3) * [1.4, 1.4, 2.0] - [0.2, 0.2, 1.0]
+        uv_proj, dist, patch_ids = surface.project_points(points)
+        assert np.allclose(np.linalg.norm(surface.eval_array(uv_proj) - points, axis=1), dist)
+        t = np.linspace(0, 1, 300)
+        samples = surface.eval_grid(t, t).reshape(-1, 3)
+        sample_dist = np.min(np.linalg.norm(samples[None, :, :] - points[:, None, :], axis=2), axis=1)
+        assert np.all(dist <= sample_dist + 1e-10)
+
+        # points far from the surface, small chunks, candidates limited to the nearest patches
+        points = 10 * np.random.RandomState(16).randn(200, 3)
+        uv_proj, dist, patch_ids = surface.project_points(points, chunk_size=37)
+        assert np.allclose(np.linalg.norm(surface.eval_array(uv_proj) - points, axis=1), dist)
+        sample_dist = np.min(np.linalg.norm(samples[None, :, :] - points[:, None, :], axis=2), axis=1)
+        assert np.all(dist <= sample_dist + 1e-10)
+        # just the patch of the nearest sample
+        one_uv, one_dist, _ = surface.project_points(points, max_candidates=1)
+        assert np.all(one_dist >= dist - 1e-10)
+        assert np.allclose(one_dist, dist, rtol=1e-2)
+
     def test_aabb(self):
         # function surface
         def function(x):
@@ -279,6 +717,31 @@ class TestSurface:
         box = surface_func.aabb()
         assert np.allclose( box, np.array([ [0,0, 3], [1, 1, 5]]) )
 
+    def test_bounding_boxes(self):
+        poles = np.random.RandomState(11).rand(6, 5, 4)
+        poles[:, :, 3] += 0.5
+        u_basis = bs.SplineBasis.make_equidistant(3, 3)
+        v_basis = bs.SplineBasis.make_equidistant(1, 4)
+        surface = bs.Surface((u_basis, v_basis), poles, rational=True)
+        box_array = surface.box_array
+        assert box_array.shape == (3 * 4, 2, 3)
+        for iu in range(3):
+            for iv in range(4):
+                window = poles[iu: iu + 4, iv: iv + 2, 0:3].reshape(-1, 3)
+                box = box_array[surface.patch_pos2id(iu, iv)]
+                assert np.allclose(box, [np.amin(window, axis=0), np.amax(window, axis=0)])
+
+        # BIH tree of the boxes
+        assert len(surface.boxes) == 12
+        query = bs.bih.AABB([box_array[5, 0].tolist(), box_array[5, 1].tolist()])
+        assert 5 in surface.tree.find_box(query)
+
+        # curve boxes, 2d boxes are embedded into 3d
+        curve = bs.Curve(u_basis, poles[:, 0, 0:2])
+        assert curve.box_array.shape == (3, 2, 2)
+        assert np.allclose(curve.box_array[1], [np.amin(poles[1:5, 0, 0:2], axis=0), np.amax(poles[1:5, 0, 0:2], axis=0)])
+        assert 1 in curve.tree.find_box(curve.boxes[1])
+
 
 
 class TestZ_Surface:
@@ -312,6 +775,21 @@ class TestZ_Surface:
         #self.plot_function_uv()
         pass
 
+    def test_eval_grid(self):
+        def function(x):
+            return math.sin(x[0]*4) * math.cos(x[1]*4)
+
+        quad = np.array([[1., 3.5], [1., 2.], [2., 2.2], [2, 3.7]])
+        z_surf = self.make_z_surf(function, quad)
+        z_surf.transform(None, np.array([2.0, 1.0]))
+        u_points = np.linspace(0, 1, 5)
+        v_points = np.linspace(0, 1, 4)
+        V, U = np.meshgrid(v_points, u_points)
+        uv_points = np.stack([U.ravel(), V.ravel()], axis=1)
+        xyz = z_surf.eval_grid(u_points, v_points)
+        assert np.allclose(xyz, z_surf.eval_array(uv_points).reshape(5, 4, 3))
+        assert np.allclose(xyz, z_surf.eval_array(uv_points, n_workers=2, chunk_size=3).reshape(5, 4, 3))
+
     def test_aabb(self):
         # function surface
         def function(x):
@@ -327,6 +805,24 @@ class TestZ_Surface:
         box = z_surf.aabb()
         assert np.allclose(box, np.array([[0, 0, 3.25], [1.1, 1.1, 7.25]]))
 
+    def test_bilinear_mapping(self):
+        def function(x):
+            return math.sin(x[0]*4) * math.cos(x[1]*4)
+
+        quads = [ np.array([[0., 1.], [0., 0.], [1., 0.], [1.5, 2.]]),
+                  np.array([[1., 3.5], [1., 2.], [2., 2.2], [2.2, 3.1]]),
+                  np.array([[0., 1.], [0., 0.], [2., 0.], [1., 1.]]) ]      # trapezoid
+        uv_points = np.random.RandomState(8).rand(100, 2)
+        uv_points[0:4] = [[0, 1], [0, 0], [1, 0], [1, 1]]
+        for quad in quads:
+            z_surf = self.make_z_surf(function, quad)
+            xy_points = z_surf.uv_to_xy(uv_points)
+            assert np.allclose(xy_points[0:4], quad)
+            ref_xy = np.array([ quad.T.dot([(1-u)*v, (1-u)*(1-v), u*(1-v), u*v]) for u, v in uv_points ])
+            assert np.allclose(xy_points, ref_xy)
+            assert np.allclose(z_surf.xy_to_uv(xy_points), uv_points, rtol=0, atol=1e-12)
+            assert np.allclose(z_surf.z_eval_xy_array(xy_points), z_surf.z_eval_array(uv_points))
+
     # def test_reset_transform(self):
     #     def function(x):
     #         return math.sin(x[0]*4) * math.cos(x[1]*4)
@@ -360,6 +856,164 @@ class TestZ_Surface:
 
 
 
+class TestSurfaceEvalPlan:
+
+    def test_eval(self):
+        def function(x):
+            return math.sin(x[0]*4) * math.cos(x[1]*4)
+
+        u_basis = bs.SplineBasis.make_equidistant(2, 3)
+        v_basis = bs.SplineBasis.make_equidistant(3, 2)
+        poles = bs.make_function_grid(function, 5, 5)
+        surf_a = bs.Surface((u_basis, v_basis), poles)
+        surf_b = bs.Surface((u_basis, v_basis), 2 * poles + 1)
+        weights = 1.0 + np.random.RandomState(6).rand(5, 5, 1)
+        surf_c = bs.Surface((u_basis, v_basis), np.concatenate((poles, weights), axis=2), rational=True)
+        uv_points = np.random.RandomState(7).rand(40, 2)
+        plan = bs.SurfaceEvalPlan((u_basis, v_basis), uv_points)
+        assert plan.matrix.shape == (40, 25)
+
+        assert np.allclose(plan.eval(poles), surf_a.eval_array(uv_points))
+        xyz = plan.eval_surfaces([surf_a, surf_b])
+        assert xyz.shape == (2, 40, 3)
+        assert np.allclose(xyz[1], surf_b.eval_array(uv_points))
+        xyz = plan.eval_surfaces([surf_a, surf_c])
+        assert np.allclose(xyz[0], surf_a.eval_array(uv_points))
+        assert np.allclose(xyz[1], surf_c.eval_array(uv_points))
+
+        quad = np.array([[1., 3.5], [1., 2.], [2., 2.2]])
+        z_surfs = [bs.Z_Surface(quad, bs.Surface((u_basis, v_basis), poles[:, :, 2:] * k)) for k in range(3)]
+        z_surfs[1].transform(None, np.array([2.0, 1.0]))
+        xy_points = z_surfs[0].uv_to_xy(uv_points)
+        plan = bs.SurfaceEvalPlan.make_xy(z_surfs[0], xy_points)
+        z_values = plan.z_eval_surfaces(z_surfs)
+        for z_surf, z in zip(z_surfs, z_values):
+            assert np.allclose(z, z_surf.z_eval_xy_array(xy_points))
+
+        plan = bs.SurfaceEvalPlan((u_basis, v_basis), uv_points, derivatives=True)
+        u_ders, v_ders = plan.eval_diff(poles)
+        derivs = surf_a.eval_derivs(uv_points, order=1)
+        assert np.allclose(u_ders, derivs[:, 1, 0, :])
+        assert np.allclose(v_ders, derivs[:, 0, 1, :])
+
+
+class TestZSurfaceQuadrature:
+
+    def make_z_surf(self, quad, fn, degree=2, n_intervals=(4, 3)):
+        u_basis = bs.SplineBasis.make_equidistant(degree, n_intervals[0])
+        v_basis = bs.SplineBasis.make_equidistant(degree, n_intervals[1])
+        # interpolation of a linear or bilinear function is exact
+        u_grev, v_grev = u_basis.greville_points(), v_basis.greville_points()
+        poles = np.array([[fn(u, v) for v in v_grev] for u in u_grev])[:, :, None]
+        return bs.Z_Surface(quad, bs.Surface((u_basis, v_basis), poles))
+
+    def test_integrals(self):
+        # unit square, z = u * v = x * y
+        unit_quad = np.array([[0, 1], [0, 0], [1, 0], [1, 1]], dtype=float)
+        z_surf = self.make_z_surf(unit_quad, lambda u, v: u * v)
+        quadrature = bs.ZSurfaceQuadrature(z_surf)
+        assert np.isclose(quadrature.area(), 1.0)
+        assert np.isclose(quadrature.z_integral(z_surf), 0.25)
+
+        # mask aligned with the patches
+        mask = np.array([[0.25, 1.0 / 3], [0.75, 1.0 / 3], [0.75, 1.0], [0.25, 1.0]])
+        masked = bs.ZSurfaceQuadrature(z_surf, polygon=mask)
+        assert np.isclose(masked.area(), 0.5 * 2.0 / 3)
+        assert np.isclose(masked.z_integral(z_surf), 0.25 * (1 - 1.0 / 9) / 2)
+
+        # general quad, z = a x + b y + c, plane area and volume are exact
+        quad = np.array([[0.5, 3.0], [1.0, 1.0], [4.0, 0.0], [3.0, 4.0]])
+        a, b, c = 0.3, -0.5, 2.0
+        plane = self.make_z_surf(quad, lambda u, v: 0.0)
+        diag_a, diag_b = quad[2] - quad[0], quad[3] - quad[1]
+        xy_area = 0.5 * abs(diag_a[0] * diag_b[1] - diag_a[1] * diag_b[0])
+        quadrature = bs.ZSurfaceQuadrature(plane)
+        assert np.isclose(quadrature.area(), xy_area)
+        # linear in XY is bilinear in UV
+        fn = lambda u, v: np.dot(plane.uv_to_xy(np.array([[u, v]]))[0], [a, b]) + c
+        tilted = self.make_z_surf(quad, fn, degree=3)
+        quadrature = bs.ZSurfaceQuadrature(tilted)
+        assert np.allclose(tilted.z_eval_xy_array(quadrature.xy_points), quadrature.xy_points @ [a, b] + c)
+        centroid_z = quadrature.integrate(quadrature.xy_points @ [a, b] + c)
+        assert np.isclose(quadrature.z_integral(tilted), centroid_z)
+        assert np.isclose(quadrature.surface_area(tilted), xy_area * np.sqrt(1 + a * a + b * b))
+        assert np.isclose(quadrature.volume(tilted, plane), centroid_z)
+        assert np.isclose(quadrature.volume(plane, tilted), 0.0)
+        assert np.isclose(quadrature.volume(plane, tilted, clip=False), -centroid_z)
+
+    def test_polygon_mask(self):
+        # nonconvex polygon not aligned with the patches, clockwise
+        mask = np.array([[0.1, 0.2], [0.45, 0.9], [0.5, 0.5], [0.95, 0.35]])[::-1]
+
+        def triangle_integrals(fn):
+            # signed fan triangles, the edge midpoint rule is exact for quadratic functions
+            a, b, c = mask[0], mask[1:-1], mask[2:]
+            area = 0.5 * ((b - a)[:, 0] * (c - a)[:, 1] - (b - a)[:, 1] * (c - a)[:, 0])
+            mids = [(a + b) / 2, (b + c) / 2, (c + a) / 2]
+            return abs(np.sum(area * sum(fn(m) for m in mids) / 3))
+
+        # unit square, z = x * y
+        unit_quad = np.array([[0, 1], [0, 0], [1, 0], [1, 1]], dtype=float)
+        z_surf = self.make_z_surf(unit_quad, lambda u, v: u * v)
+        quadrature = bs.ZSurfaceQuadrature(z_surf, polygon=mask)
+        assert np.isclose(quadrature.area(), triangle_integrals(lambda p: np.ones(len(p))), rtol=1e-12)
+        assert np.isclose(quadrature.z_integral(z_surf), triangle_integrals(lambda p: p[:, 0] * p[:, 1]), rtol=1e-12)
+
+        # general quad, z = a x + b y + c
+        quad = np.array([[0.0, 1.2], [0.1, 0.0], [1.1, 0.1], [1.0, 1.0]])
+        a, b, c = 0.3, -0.5, 2.0
+        plane = self.make_z_surf(quad, lambda u, v: 0.0)
+        fn = lambda u, v: np.dot(plane.uv_to_xy(np.array([[u, v]]))[0], [a, b]) + c
+        tilted = self.make_z_surf(quad, fn, degree=3)
+        quadrature = bs.ZSurfaceQuadrature(tilted, polygon=mask)
+        assert np.isclose(quadrature.area(), triangle_integrals(lambda p: np.ones(len(p))), rtol=1e-10)
+        assert np.isclose(quadrature.z_integral(tilted), triangle_integrals(lambda p: p @ [a, b] + c), rtol=1e-10)
+        assert np.isclose(quadrature.volume(tilted, plane), quadrature.z_integral(tilted))
+
+    def test_realizations(self):
+        def function(x):
+            return math.sin(x[0]*4) * math.cos(x[1]*4)
+
+        quad = np.array([[1., 3.5], [1., 2.], [2., 2.2], [2.5, 3.0]])
+        u_basis = bs.SplineBasis.make_equidistant(2, 3)
+        v_basis = bs.SplineBasis.make_equidistant(2, 4)
+        poles = bs.make_function_grid(function, 5, 6)[:, :, 2:]
+        random = np.random.RandomState(3)
+        z_surfs = [bs.Z_Surface(quad, bs.Surface((u_basis, v_basis), poles + random.rand(5, 6, 1)))
+                   for k in range(5)]
+        z_surfs[2].transform(None, np.array([2.0, 1.0]))
+        bottom = bs.Z_Surface(quad, bs.Surface((u_basis, v_basis), poles - 1.0))
+        mask = np.array([[1.2, 2.3], [2.0, 2.4], [1.5, 3.3]])
+        quadrature = bs.ZSurfaceQuadrature(z_surfs[0], polygon=mask, n_sub=4)
+
+        # batch integrals same as individual and fallback ones
+        z_int = quadrature.z_integral(z_surfs)
+        areas = quadrature.surface_area(z_surfs)
+        volumes = quadrature.volume(z_surfs, bottom)
+        assert z_int.shape == areas.shape == volumes.shape == (5,)
+        for k, z_surf in enumerate(z_surfs):
+            assert np.isclose(quadrature.z_integral(z_surf), z_int[k])
+            assert np.isclose(quadrature.surface_area(z_surf), areas[k])
+            assert np.isclose(quadrature.volume(z_surf, bottom), volumes[k])
+            # same geometry, other basis -> evaluation in XY points
+            refined = z_surf.get_copy()
+            refined.z_surface = z_surf.z_surface.refine(u_knots=[0.5], v_knots=[0.1])
+            refined.u_basis, refined.v_basis = refined.z_surface.u_basis, refined.z_surface.v_basis
+            assert not quadrature.plan.has_basis(refined)
+            assert np.isclose(quadrature.z_integral(refined), z_int[k])
+            assert np.isclose(quadrature.surface_area(refined), areas[k])
+
+        # reference values by a fine quadrature
+        fine = bs.ZSurfaceQuadrature(z_surfs[0], polygon=mask, n_sub=64, order=2)
+        assert np.allclose(quadrature.area(), fine.area(), rtol=1e-2)
+        assert np.allclose(z_int, fine.z_integral(z_surfs), rtol=2e-2)
+        assert np.allclose(volumes, fine.volume(z_surfs, bottom), rtol=2e-2)
+        edge_a, edge_b = mask[1] - mask[0], mask[2] - mask[0]
+        triangle_area = 0.5 * abs(edge_a[0] * edge_b[1] - edge_a[1] * edge_b[0])
+        assert np.isclose(fine.area(), triangle_area, rtol=1e-12)
+        assert np.isclose(quadrature.area(), triangle_area, rtol=1e-12)
+
+
 class TestPointGrid:
 
     @staticmethod
@@ -464,6 +1118,23 @@ class TestPointGrid:
         # assert np.allclose(v_min, np.array([-3.0/math.sqrt(2) -2, 0.0 + 5, 1.3]))
         # assert np.allclose(v_max, np.array([3.0 / math.sqrt(2) - 2, 4.0 / math.sqrt(2) + 5, math.sin(1.0) + 1.3]))
 
+    def test_grid_regularity(self):
+        nu, nv = 5, 6
+        grid = bs.make_function_grid(TestPointGrid.function, nu, nv).reshape(nu * nv, 3)
+        surface = bs.GridSurface(grid)
+        assert surface.shape == (nu, nv)
+        uv_points = np.random.RandomState(9).rand(50, 2)
+        assert np.allclose(surface.z_eval_array(uv_points), surface.z_surface.z_eval_array(uv_points))
+
+        for i_point, direction in [(8, "X"), (27, "X")]:
+            irregular = grid.copy()
+            irregular[i_point, 0] += 0.01
+            with pytest.raises(bs.IrregularGridExc, match="{} direction, point {}$".format(direction, i_point)):
+                bs.GridSurface(irregular)
+
+        with pytest.raises(bs.GridNotInShapeExc):
+            bs.GridSurface(grid[:-1, :])
+
     def test_grid_surface_transform(self):
         surface = self.make_point_grid()
         xy_mat = np.array([ [3.0, 0.0], [0.0, 2.0] ])
@@ -0,0 +1,140 @@
+import types
+import pytest
+import numpy as np
+
+from bgem.bspline import bspline as bs
+from bgem.bspline import bspline_io
+
+
+def function(x):
+    return np.sin(x[0] * 4) * np.cos(x[1] * 4)
+
+
+def make_surface(rational=False):
+    poles = bs.make_function_grid(function, 5, 6)
+    if rational:
+        weights = 1.0 + 0.5 * np.random.rand(5, 6, 1)
+        poles = np.concatenate((poles, weights), axis=2)
+    return bs.Surface((bs.SplineBasis.make_equidistant(2, 3), bs.SplineBasis.make_equidistant(2, 4)), poles, rational)
+
+
+def make_z_surface():
+    poles = bs.make_function_grid(function, 5, 6)
+    z_surf = bs.Surface((bs.SplineBasis.make_equidistant(2, 3), bs.SplineBasis.make_equidistant(2, 4)), poles[:, :, [2]])
+    quad = np.array([[1, 0], [3, 1], [2, 3], [0, 2]], dtype=float)
+    return bs.Z_Surface(quad, z_surf)
+
+
+def uv_points():
+    return np.random.rand(50, 2)
+
+
+def test_save_load_curve(tmp_path):
+    np.random.seed(1)
+    basis = bs.SplineBasis(3, [0, 0, 0, 0, 0.2, 0.5, 0.5, 1, 1, 1, 1])
+    for rational in [False, True]:
+        poles = np.random.rand(basis.size, 3 + rational) + rational
+        curve = bs.Curve(basis, poles, rational)
+        file_name = str(tmp_path / "curve.npy")
+        bspline_io.save(file_name, curve)
+        loaded = bspline_io.load(file_name)
+        assert isinstance(loaded, bs.Curve)
+        assert loaded.rational == rational
+        assert loaded.basis.degree == 3
+        assert np.allclose(loaded.basis.knots, basis.knots)
+        t_points = np.random.rand(30)
+        assert np.allclose(loaded.eval_array(t_points), curve.eval_array(t_points))
+
+
+@pytest.mark.parametrize("rational", [False, True])
+def test_save_load_surface(tmp_path, rational):
+    np.random.seed(2)
+    surface = make_surface(rational)
+    file_name = str(tmp_path / "surface.npy")
+    bspline_io.save(file_name, surface)
+    loaded = bspline_io.load(file_name)
+    assert isinstance(loaded, bs.Surface)
+    assert loaded.rational == rational
+    assert loaded.poles.shape == surface.poles.shape
+    uv = uv_points()
+    assert np.allclose(loaded.eval_array(uv), surface.eval_array(uv))
+
+    # poles are read-only views into the mapped file
+    base = loaded.poles
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap)
+    assert not loaded.poles.flags.writeable
+    in_memory = bspline_io.load(file_name, mmap_mode=None)
+    assert np.allclose(in_memory.eval_array(uv), surface.eval_array(uv))
+
+
+def test_save_load_z_surface(tmp_path):
+    np.random.seed(3)
+    z_surface = make_z_surface()
+    z_surface.transform(np.array([[1.0, 0.5, 0.1], [0.0, 2.0, -0.3]]), np.array([2.0, 0.5]))
+    file_name = str(tmp_path / "z_surface.npy")
+    bspline_io.save(file_name, z_surface)
+    loaded = bspline_io.load(file_name)
+    assert isinstance(loaded, bs.Z_Surface)
+    assert np.allclose(loaded.quad, z_surface.quad)
+    uv = uv_points()
+    assert np.allclose(loaded.eval_array(uv), z_surface.eval_array(uv))
+
+    # no transform
+    z_surface = make_z_surface()
+    bspline_io.save(file_name, z_surface)
+    loaded = bspline_io.load(file_name)
+    assert np.allclose(loaded.eval_array(uv), z_surface.eval_array(uv))
+
+
+def test_load_invalid(tmp_path):
+    file_name = str(tmp_path / "other.npy")
+    np.save(file_name, np.zeros(10))
+    with pytest.raises(ValueError):
+        bspline_io.load(file_name)
+    with pytest.raises(TypeError):
+        bspline_io.save(file_name, "not a spline")
+
+
+def test_zsurface_read_write():
+    np.random.seed(4)
+    z_surface = make_z_surface()
+    z_surface.transform(None, np.array([1.5, -0.2]))
+    z_surface_io = bspline_io.bs_zsurface_write(z_surface, types.SimpleNamespace())
+    loaded = bspline_io.bs_zsurface_read(z_surface_io)
+    uv = uv_points()
+    assert np.allclose(loaded.eval_array(uv), z_surface.eval_array(uv))
+
+
+def test_constructors_copy():
+    np.random.seed(5)
+    basis = bs.SplineBasis.make_equidistant(2, 3)
+    poles = np.random.rand(basis.size, 3)
+    curve = bs.Curve(basis, poles)
+    t_points = np.random.rand(20)
+    xyz = curve.eval_array(t_points)
+    poles[:] = 0.0
+    assert np.allclose(curve.eval_array(t_points), xyz)
+
+    surface = make_surface()
+    poles = np.array(surface.poles)
+    surface = bs.Surface((surface.u_basis, surface.v_basis), poles)
+    uv = uv_points()
+    xyz = surface.eval_array(uv)
+    poles[:] = 0.0
+    assert np.allclose(surface.eval_array(uv), xyz)
+
+    curves = [bs.Curve(basis, np.random.rand(basis.size, 2)) for _ in range(3)]
+    knots, poles = np.array(basis.knots), np.stack([c.poles for c in curves])
+    curve_set = bs.CurveSet(2, knots, poles)
+    xy = curve_set.eval_array(t_points)
+    knots[:], poles[:] = 0.5, 0.0
+    assert np.allclose(curve_set.eval_array(t_points), xy)
+
+    # Z coordinates of the grid points
+    points = bs.make_function_grid(function, 5, 4).reshape(-1, 3)
+    grid_surface = bs.GridSurface(points)
+    xyz = grid_surface.eval_array(uv)
+    points[:, 2] = 0.0
+    assert np.allclose(grid_surface.eval_array(uv), xyz)
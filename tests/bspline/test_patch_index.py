@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+
+from bgem.bspline import bspline as bs
+from bgem.bspline.patch_index import PatchIndex
+
+
+def brute_force(boxes, query):
+    return np.nonzero(np.all(np.logical_and(query[0] <= boxes[:, 1], boxes[:, 0] <= query[1]), axis=1))[0].tolist()
+
+
+@pytest.mark.parametrize("seed", list(range(5)))
+def test_find_boxes(seed):
+    np.random.seed(seed)
+    corners = np.random.rand(1000, 3)
+    boxes = np.stack((corners, corners + 0.05 * np.random.rand(1000, 3)), axis=1)
+    # flat boxes, zero extent in Z
+    boxes[:100, :, 2] = 0.5
+    index = PatchIndex(boxes)
+
+    corners = 1.4 * np.random.rand(200, 3) - 0.2
+    queries = np.stack((corners, corners + 0.1 * np.random.rand(200, 3)), axis=1)
+    indptr, indices = index.find_boxes(queries)
+    assert len(indptr) == 201
+    for query, i_begin, i_end in zip(queries, indptr[:-1], indptr[1:]):
+        assert indices[i_begin:i_end].tolist() == brute_force(boxes, query)
+    assert index.find_box(queries[7]) == brute_force(boxes, queries[7])
+
+    points = np.random.rand(50, 3)
+    indptr, indices = index.find_points(points)
+    for point, i_begin, i_end in zip(points, indptr[:-1], indptr[1:]):
+        assert indices[i_begin:i_end].tolist() == brute_force(boxes, np.array([point, point]))
+
+
+def test_degenerate():
+    # all boxes in a single point
+    index = PatchIndex(np.zeros((3, 2, 2)))
+    assert index.find_box(np.array([[-1, -1], [1, 1]])) == [0, 1, 2]
+    assert index.find_point(np.array([0.5, 0.0])) == []
+
+    index = PatchIndex(np.zeros((0, 2, 3)))
+    indptr, indices = index.find_boxes(np.zeros((4, 2, 3)))
+    assert indptr.tolist() == [0, 0, 0, 0, 0]
+    assert len(indices) == 0
+
+
+def test_surface_patch_index():
+    def function(x):
+        return np.sin(x[0] * 4) * np.cos(x[1] * 4)
+
+    poles = bs.make_function_grid(function, 8, 7)
+    surface = bs.Surface((bs.SplineBasis.make_equidistant(2, 6), bs.SplineBasis.make_equidistant(2, 5)), poles)
+    box_array = surface.box_array
+    indptr, indices = surface.patch_index.find_boxes(box_array)
+    for i_patch in range(len(box_array)):
+        candidates = indices[indptr[i_patch]:indptr[i_patch + 1]].tolist()
+        assert i_patch in candidates
+        assert candidates == brute_force(box_array, box_array[i_patch])
+
+
+@pytest.mark.skipif(bs.bih is None, reason="bih not available")
+def test_bih_compatibility():
+    poles = np.random.RandomState(3).rand(6, 2)
+    curve = bs.Curve(bs.SplineBasis.make_equidistant(2, 4), poles)
+    # the tree of the curve is the PatchIndex, queries by 3d bih.AABB boxes
+    assert curve.tree is curve.patch_index
+    box = curve.box_array[2]
+    query = bs.bih.AABB([box[0].tolist() + [-1.0], box[1].tolist() + [1.0]])
+    assert curve.tree.find_box(query) == brute_force(curve.box_array, box)
+    point = np.mean(box, axis=0)
+    assert curve.tree.find_point(point.tolist() + [0.0]) == brute_force(curve.box_array, np.stack((point, point)))
@@ -0,0 +1,112 @@
+import pytest
+import numpy as np
+
+from bgem.bspline import bspline as bs
+from bgem.bspline import tessellate
+
+
+def function(x):
+    return np.sin(x[0] * 4) * np.cos(x[1] * 4)
+
+
+def make_surface():
+    poles = bs.make_function_grid(function, 8, 7)
+    return bs.Surface((bs.SplineBasis.make_equidistant(2, 6), bs.SplineBasis.make_equidistant(2, 5)), poles)
+
+
+def check_mesh(uv_points, triangles, domain_area):
+    # positive orientation, covering the domain
+    a = uv_points[triangles[:, 1]] - uv_points[triangles[:, 0]]
+    b = uv_points[triangles[:, 2]] - uv_points[triangles[:, 0]]
+    area = 0.5 * (a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0])
+    assert np.all(area > 0)
+    assert np.isclose(np.sum(area), domain_area)
+
+    # conforming: inner edges shared by two triangles, other edges on the boundary
+    edges = np.sort(np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]])), axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    assert np.all(counts <= 2)
+    mid = np.mean(uv_points[edges[counts == 1]], axis=1)
+    lo, hi = np.min(uv_points, axis=0), np.max(uv_points, axis=0)
+    assert np.all(np.any(np.logical_or(np.isclose(mid, lo), np.isclose(mid, hi)), axis=1))
+
+
+def test_curve_polyline():
+    # straight line, just knots
+    basis = bs.SplineBasis.make_equidistant(2, 4)
+    poles = np.stack((np.linspace(0, 1, basis.size), np.linspace(0, 2, basis.size)), axis=1)
+    t_points, points = tessellate.curve_polyline(bs.Curve(basis, poles), 1e-6)
+    assert np.allclose(t_points, [0, 0.25, 0.5, 0.75, 1.0])
+    assert np.allclose(points, bs.Curve(basis, poles).eval_array(t_points))
+
+    poles = np.array([[0, 0], [1, 2], [2, -1], [3, 3], [4, 0], [5, 1]], dtype=float)
+    curve = bs.Curve(basis, poles)
+    n_points = []
+    for tolerance in [1e-2, 1e-3, 1e-4]:
+        t_points, points = tessellate.curve_polyline(curve, tolerance)
+        n_points.append(len(t_points))
+        assert np.all(np.diff(t_points) > 0)
+        assert t_points[0] == 0 and t_points[-1] == 1
+        # deviation of the curve from the polyline segments
+        t_fine = np.linspace(t_points[:-1], t_points[1:], 9)[1:-1].T
+        fine = curve.eval_array(t_fine.ravel()).reshape(len(t_points) - 1, 7, 2)
+        dev = tessellate._chord_distance(fine.reshape(-1, 2),
+                                         np.repeat(points[:-1], 7, axis=0), np.repeat(points[1:], 7, axis=0))
+        assert np.max(dev) < 2 * tolerance
+    assert n_points[0] < n_points[1] < n_points[2]
+    # square root convergence of the chordal deviation for smooth curves
+    assert n_points[2] < 4 * n_points[1]
+
+    # S-shaped span, the midpoint lies on the chord
+    basis = bs.SplineBasis.make_equidistant(3, 1)
+    curve = bs.Curve(basis, np.array([[0, 0], [1, 1], [2, -1], [3, 0]], dtype=float))
+    assert np.allclose(curve.eval(0.5), [1.5, 0])
+    t_points, points = tessellate.curve_polyline(curve, 1e-2)
+    assert len(t_points) > 3
+    t_fine = np.linspace(0, 1, 101)
+    fine = curve.eval_array(t_fine)
+    i_seg = np.minimum(np.searchsorted(t_points, t_fine, side='right') - 1, len(t_points) - 2)
+    dev = tessellate._chord_distance(fine, points[i_seg], points[i_seg + 1])
+    assert np.max(dev) < 2 * 1e-2
+
+    # min level
+    basis = bs.SplineBasis.make_equidistant(2, 4)
+    curve = bs.Curve(basis, np.array([[0, 0], [1, 2], [2, -1], [3, 3], [4, 0], [5, 1]], dtype=float))
+    t_points, points = tessellate.curve_polyline(curve, 1.0, min_level=2)
+    assert len(t_points) == 4 * 4 + 1
+
+
+@pytest.mark.parametrize("tolerance", [1e-1, 1e-2, 1e-3])
+def test_surface_triangles(tolerance):
+    surface = make_surface()
+    uv_points, points, triangles = tessellate.surface_triangles(surface, tolerance)
+    assert np.allclose(points, surface.eval_array(uv_points))
+    assert len(np.unique(triangles)) == len(uv_points)
+    check_mesh(uv_points, triangles, 1.0)
+
+    # deviation at the edge midpoints, only the cell edges and a diagonal are tested
+    edges = np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]))
+    mid = surface.eval_array(np.mean(uv_points[edges], axis=1))
+    dev = tessellate._chord_distance(mid, points[edges[:, 0]], points[edges[:, 1]])
+    assert np.max(dev) < 3 * tolerance
+
+
+def test_surface_triangles_flat():
+    # planar patches, two triangles per patch
+    poles = bs.make_function_grid(lambda x: 0.3 * x[0] - x[1], 5, 4)
+    surface = bs.Surface((bs.SplineBasis.make_equidistant(1, 4), bs.SplineBasis.make_equidistant(1, 3)), poles)
+    uv_points, points, triangles = tessellate.surface_triangles(surface, 1e-6)
+    assert len(uv_points) == 5 * 4
+    assert len(triangles) == 2 * 4 * 3
+    check_mesh(uv_points, triangles, 1.0)
+
+
+def test_z_surface_triangles():
+    poles = bs.make_function_grid(function, 5, 6)
+    z_surf = bs.Surface((bs.SplineBasis.make_equidistant(2, 3), bs.SplineBasis.make_equidistant(2, 4)), poles[:, :, [2]])
+    quad = np.array([[1, 0], [3, 1], [2, 3], [0, 2]], dtype=float)
+    surface = bs.Z_Surface(quad, z_surf)
+    uv_points, points, triangles = tessellate.surface_triangles(surface, 1e-2, min_level=1)
+    assert points.shape[1] == 3
+    assert np.allclose(points, surface.eval_array(uv_points))
+    check_mesh(uv_points, triangles, 1.0)